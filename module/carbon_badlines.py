@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+Accounting of the malformed lines.
+
+The parser validates the lines without raising: a bad line is classified,
+skipped, and counted by category and by source (the peer address). A few
+lines are kept as samples (reservoir sampling) and logged, with the counts,
+in the periodic report.
+"""
+
+from random import randrange
+
+#############################################################################
+
+TOO_FEW_FIELDS = 'too few fields'
+NON_NUMERIC_VALUE = 'non-numeric value'
+BAD_TIMESTAMP = 'bad timestamp'
+WRONG_PATH_DEPTH = 'wrong path depth'
+OVERSIZE_LINE = 'oversize line'
+INVALID_NAME = 'invalid name'
+UNSUPPORTED_TYPE = 'unsupported type'
+
+# https://github.com/graphite-project/carbon/blob/master/lib/carbon/protocols.py#L122-L124
+MAX_LINE_LENGTH = 400
+"""Longer lines are oversize, carbon truncates them"""
+
+DEFAULT_SAMPLES = 3
+"""Default number of bad lines logged per report"""
+
+_MAX_SOURCES = 1000
+_TOP_SOURCES = 5
+_SAMPLE_LENGTH = 120
+
+
+#############################################################################
+
+
+class BadLines(object):
+
+    def __init__(self, samples=DEFAULT_SAMPLES):
+        """
+        :param samples: The number of bad lines logged per report.
+        """
+        self.samples = samples
+        self.count = 0
+        self.by_category = {}
+        self.by_source = {}
+        self._samples = []
+
+    def __len__(self):
+        return self.count
+
+    def add(self, category, source, line):
+        """
+        :param category: The category of the bad line, e.g. NON_NUMERIC_VALUE.
+        :param source: The peer address the line was received from, or None.
+        :param line: The line (or its metric name).
+        """
+        self.count += 1
+        by_category = self.by_category
+        by_category[category] = by_category.get(category, 0) + 1
+        by_source = self.by_source
+        if source in by_source:
+            by_source[source] += 1
+        elif len(by_source) < _MAX_SOURCES:
+            by_source[source] = 1
+        samples = self._samples
+        if len(samples) < self.samples:
+            samples.append((category, source, line))
+        elif self.samples:
+            idx = randrange(self.count)
+            if idx < self.samples:
+                samples[idx] = (category, source, line)
+
+    def report(self):
+        """
+        :return: The lines to log for the bad lines since the last report.
+        """
+        count, by_category, by_source, samples = (
+            self.count, self.by_category, self.by_source, self._samples)
+        self.count = 0
+        self.by_category = {}
+        self.by_source = {}
+        self._samples = []
+        if not count:
+            return []
+        top = sorted(by_source.iteritems(), key=lambda item: item[1], reverse=True)
+        res = ['%d bad lines: %s; top sources: %s' % (
+            count,
+            ', '.join('%d %s' % (num, category)
+                      for category, num in sorted(by_category.iteritems())),
+            ', '.join('%s (%d)' % (source or 'local', num)
+                      for source, num in top[:_TOP_SOURCES]))]
+        for category, source, line in samples:
+            res.append('%s from %s: %r' % (category, source or 'local', line[:_SAMPLE_LENGTH]))
+        return res
+
+
+bad_lines = BadLines()
+"""The module-level accounting of the malformed lines"""
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""
+Cardinality tracking of the series, with fixed memory sketches.
+
+- the live series of each host and of each plugin are counted in a
+  count-min sketch (incremented when a series is created, decremented when
+  it's purged), used for the per host limit and for the top offenders,
+- the series created during the report period are counted in a second
+  count-min sketch (the churn) and in a HyperLogLog (the distinct series).
+
+The sketches are only updated when a series is created or purged, never
+for an update of an existing series.
+"""
+
+import math
+import struct
+from array import array
+from hashlib import md5
+
+#############################################################################
+
+DEFAULT_TOP = 10
+"""Default number of top offenders reported"""
+
+DEFAULT_WIDTH = 16384
+DEFAULT_DEPTH = 4
+DEFAULT_HLL_PRECISION = 12
+
+_HASHES = struct.Struct('<QQ')
+
+
+#############################################################################
+
+
+def _hashes(key):
+    """
+    :return: Two 64 bits hashes of a key.
+    """
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return _HASHES.unpack(md5(key).digest())
+
+
+class CountMinSketch(object):
+    """
+    Count-min sketch, with increments and decrements (counts stay >= 0).
+    """
+
+    def __init__(self, width=DEFAULT_WIDTH, depth=DEFAULT_DEPTH):
+        self.width = width
+        self.depth = depth
+        self.clear()
+
+    def _indexes(self, key):
+        h1, h2 = _hashes(key)
+        width = self.width
+        return [(h1 + idx * h2) % width for idx in xrange(self.depth)]
+
+    def add(self, key, count=1):
+        """
+        :return: The estimate of the key count after the update.
+        """
+        res = None
+        for row, idx in zip(self._rows, self._indexes(key)):
+            value = max(row[idx] + count, 0)
+            row[idx] = value
+            if res is None or value < res:
+                res = value
+        return res
+
+    def estimate(self, key):
+        return min(row[idx] for row, idx in zip(self._rows, self._indexes(key)))
+
+    def clear(self):
+        self._rows = [array('l', [0]) * self.width for _ in xrange(self.depth)]
+
+
+class HyperLogLog(object):
+    """
+    HyperLogLog distinct count estimator.
+    """
+
+    def __init__(self, precision=DEFAULT_HLL_PRECISION):
+        self.precision = precision
+        self.size = 1 << precision
+        self._registers = bytearray(self.size)
+        self._alpha = 0.7213 / (1 + 1.079 / self.size)
+
+    def add(self, key):
+        hash_value = _hashes(key)[0]
+        bits = 64 - self.precision
+        idx = hash_value >> bits
+        rank = bits - (hash_value & ((1 << bits) - 1)).bit_length() + 1
+        if rank > self._registers[idx]:
+            self._registers[idx] = rank
+
+    def count(self):
+        registers = self._registers
+        size = self.size
+        estimate = self._alpha * size * size / sum(2.0 ** -reg for reg in registers)
+        if estimate <= 2.5 * size:
+            zeros = registers.count(b'\x00')
+            if zeros:
+                estimate = size * math.log(float(size) / zeros)
+        return int(estimate)
+
+    def clear(self):
+        self._registers = bytearray(self.size)
+
+
+class TopN(object):
+    """
+    The N keys with the highest count estimates.
+    """
+
+    def __init__(self, size=DEFAULT_TOP):
+        self.size = size
+        self._top = {}
+
+    def update(self, key, estimate):
+        top = self._top
+        if key in top or len(top) < self.size:
+            top[key] = estimate
+        else:
+            smallest = min(top, key=top.get)
+            if estimate > top[smallest]:
+                del top[smallest]
+                top[key] = estimate
+
+    def items(self):
+        return sorted(self._top.iteritems(), key=lambda item: item[1], reverse=True)
+
+
+def plugin_of(sdesc):
+    """
+    :return: The plugin part of a service description.
+    """
+    return sdesc.split('-', 1)[0]
+
+
+class CardinalityTracker(object):
+    """
+    Track the series per host and per plugin, and enforce the series limits.
+    """
+
+    def __init__(self, max_series_per_host=0, max_series_per_service=0, top=DEFAULT_TOP,
+                 width=DEFAULT_WIDTH, depth=DEFAULT_DEPTH):
+        """
+        :param max_series_per_host: The max number of live series of a host, 0 for no limit.
+        :param max_series_per_service: The max number of series of a service, 0 for no limit.
+        :param top: The number of top offenders reported.
+        """
+        self.max_series_per_host = max_series_per_host
+        self.max_series_per_service = max_series_per_service
+        self.live = CountMinSketch(width, depth)
+        self.new = CountMinSketch(width, depth)
+        self.distinct = HyperLogLog()
+        self.top_hosts = TopN(top)
+        self.top_plugins = TopN(top)
+        self.n_new = 0
+        self.n_rejected = 0
+        self.rejected_hosts = TopN(top)
+
+    def allow(self, host, n_service_series):
+        """
+        :param host: The host of the new series.
+        :param n_service_series: The number of series of its service (element).
+        :return: True if the series can be created.
+        """
+        if self.max_series_per_service and n_service_series >= self.max_series_per_service:
+            return False
+        if self.max_series_per_host and \
+                self.live.estimate('h:' + host) >= self.max_series_per_host:
+            return False
+        return True
+
+    def reject(self, host):
+        """
+        A new series of the host is rejected by the limits.
+        """
+        self.n_rejected += 1
+        self.rejected_hosts.update(host, self.new.add('r:' + host))
+
+    def add_series(self, host, sdesc, mname):
+        """
+        A new series is created.
+        """
+        plugin = plugin_of(sdesc)
+        self.top_hosts.update(host, self.live.add('h:' + host))
+        self.top_plugins.update(plugin, self.live.add('p:' + plugin))
+        self.new.add('h:' + host)
+        self.new.add('p:' + plugin)
+        self.distinct.add(u'%s;%s;%s' % (host, sdesc, mname))
+        self.n_new += 1
+
+    def remove_series(self, host, sdesc):
+        """
+        A series is purged.
+        """
+        plugin = plugin_of(sdesc)
+        self.top_hosts.update(host, self.live.add('h:' + host, -1))
+        self.top_plugins.update(plugin, self.live.add('p:' + plugin, -1))
+
+    def report(self):
+        """
+        :return: The report of the period (as a list of strings), the period counters are reset.
+        """
+        res = ['%d new series (~%d distinct), %d rejected' % (
+                   self.n_new, self.distinct.count(), self.n_rejected),
+               'top hosts (live series): %s' % ', '.join(
+                   '%s (%d, %d new)' % (host, count, self.new.estimate('h:' + host))
+                   for host, count in self.top_hosts.items()),
+               'top plugins (live series): %s' % ', '.join(
+                   '%s (%d, %d new)' % (plugin, count, self.new.estimate('p:' + plugin))
+                   for plugin, count in self.top_plugins.items())]
+        if self.n_rejected:
+            res.append('rejected hosts: %s' % ', '.join(
+                '%s (%d)' % item for item in self.rejected_hosts.items()))
+        self.new.clear()
+        self.distinct.clear()
+        self.n_new = 0
+        self.n_rejected = 0
+        self.rejected_hosts = TopN(self.rejected_hosts.size)
+        return res
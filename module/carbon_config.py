@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+"""
+Read the module definition from a Shinken configuration file, to reload the
+module configuration while it's running.
+"""
+
+from shinken.objects.module import Module
+
+#############################################################################
+
+
+def read_module_config(path, module_name):
+    """
+    :param path: A Shinken configuration file, with `define module {...}´ blocks.
+    :param module_name: The module_name of the block to read.
+    :return: A Module built from the block.
+    :raise ValueError: If there is no such module in the file.
+    """
+    block = None
+    with open(path) as config:
+        for line in config:
+            line = line.strip()
+            if not line or line[0] in '#;':
+                continue
+            if block is None:
+                if line.replace('{', ' ').split()[:2] == ['define', 'module']:
+                    block = {}
+                continue
+            if line.startswith('}'):
+                if block.get('module_name') == module_name:
+                    return Module(block)
+                block = None
+                continue
+            elems = line.split(None, 1)
+            block[elems[0]] = elems[1] if len(elems) > 1 else ''
+    raise ValueError('No module %s in %s' % (module_name, path))
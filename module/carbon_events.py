@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+Lifecycle events of the elements (created, new perfdata, purged...).
+
+They are counted by kind, with a few samples (reservoir sampling), and
+summarized in one line per kind with the commands report, instead of a log
+line per event. With the detail switch, each event is also logged.
+
+Only the element names are kept: the distinct elements are estimated with a
+HyperLogLog, so the purged elements aren't held until the report.
+"""
+
+from random import randrange
+
+from shinken.log import logger
+
+from .carbon_cardinality import HyperLogLog
+
+#############################################################################
+
+DEFAULT_SAMPLES = 5
+"""Default number of samples per kind of event in a report"""
+
+_HLL_PRECISION = 10
+
+
+#############################################################################
+
+
+class LifecycleLog(object):
+
+    def __init__(self, samples=DEFAULT_SAMPLES, detail=False):
+        """
+        :param samples: The number of samples per kind of event in a report.
+        :param detail: Log each event too.
+        """
+        self.samples = samples
+        self.detail = detail
+        self._events = {}
+
+    def event(self, kind, element, detail=None):
+        """
+        :param kind: The kind of event, e.g. 'new perfdata'.
+        :param element: The Element.
+        :param detail: An optional detail, e.g. the metric name.
+        """
+        if self.detail:
+            logger.info('[Carbon] %s %s%s' % (
+                kind, element, '' if detail is None else ' %s' % detail))
+        stats = self._events.get(kind, None)
+        if stats is None:
+            stats = self._events[kind] = [0, HyperLogLog(_HLL_PRECISION), []]
+        name = str(element)
+        stats[0] += 1
+        stats[1].add(name)
+        samples = stats[2]
+        if len(samples) < self.samples:
+            samples.append((name, detail))
+        elif self.samples:
+            idx = randrange(stats[0])
+            if idx < self.samples:
+                samples[idx] = (name, detail)
+
+    def report(self):
+        """
+        :return: A line per kind of event since the last report.
+        """
+        events, self._events = self._events, {}
+        res = []
+        for kind, (count, elements, samples) in sorted(events.iteritems()):
+            res.append('%d %s across %d elements%s' % (
+                count, kind, elements.count(), ', samples: %s' % ', '.join(
+                    name if detail is None else '%s %s' % (name, detail)
+                    for name, detail in samples) if samples else ''))
+        return res
+
+
+lifecycle_log = LifecycleLog()
+"""The module-level lifecycle events of the elements"""
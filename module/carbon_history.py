@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+Recent history of the metrics, kept in memory to be queried locally.
+
+Each series (host, service, metric) has a fixed size ring buffer of its last
+points, in two arrays (times and values). The number of series is bounded:
+beyond max_series, the oldest created series are evicted. The series are
+also removed when their element purges them.
+
+A small HTTP server (on localhost) answers the queries:
+GET /history?pattern=<glob on host/service/metric>[&since=<timestamp>]
+with a JSON object {"host/service/metric": [[time, value], ...], ...}.
+The queries run in the server thread: they only copy the arrays, and the
+series table is read with a dict copy (atomic), no lock is needed.
+"""
+
+import json
+import threading
+from array import array
+from collections import deque
+from fnmatch import fnmatchcase
+from urlparse import urlparse, parse_qs
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+from shinken.log import logger
+
+from .carbon_parser import to_float
+
+#############################################################################
+
+DEFAULT_MAX_SERIES = 10000
+"""Default max number of series in the history"""
+
+DEFAULT_HOST = '127.0.0.1'
+"""Default address of the history queries server"""
+
+_MAX_RESULTS = 10000
+
+
+#############################################################################
+
+
+class RingBuffer(object):
+    __slots__ = ('size', 'times', 'values', 'count', 'end')
+
+    def __init__(self, size):
+        """
+        :param size: The number of points kept.
+        """
+        self.size = size
+        self.times = array('d', [0.0]) * size
+        self.values = array('d', [0.0]) * size
+        self.count = 0
+        self.end = 0  # the slot of the next point
+
+    def __len__(self):
+        return self.count
+
+    def add(self, mtime, value):
+        end = self.end
+        self.times[end] = mtime
+        try:
+            self.values[end] = value
+        except OverflowError:
+            # a long out of the float range
+            self.values[end] = to_float(value)
+        self.end = (end + 1) % self.size
+        if self.count < self.size:
+            self.count += 1
+
+    def points(self, since=None):
+        """
+        :return: The (time, value) of the points (newer than since), in arrival order.
+        """
+        size, end, count = self.size, self.end, self.count
+        times, values = self.times, self.values
+        start = (end - count) % size
+        if start < end:
+            res = zip(times[start:end], values[start:end])
+        else:
+            res = zip(times[start:] + times[:end], values[start:] + values[:end])
+        if since is not None:
+            res = [point for point in res if point[0] > since]
+        return res
+
+
+class History(object):
+    """
+    The ring buffers of the series, by (host, service, metric).
+    """
+
+    def __init__(self, points, max_series=DEFAULT_MAX_SERIES):
+        """
+        :param points: The number of points kept per series.
+        :param max_series: The max number of series.
+        """
+        self.points = points
+        self.max_series = max_series
+        self.series = {}
+        # the eviction order, the (key, ring) of the series removed (or re-created) since are stale
+        self._created = deque()
+
+    def __len__(self):
+        return len(self.series)
+
+    def add(self, key, mtime, value):
+        """
+        :param key: The (host, service, metric) of the series.
+        """
+        ring = self.series.get(key, None)
+        if ring is None:
+            ring = self._create(key)
+        ring.add(mtime, value)
+
+    def _create(self, key):
+        series = self.series
+        created = self._created
+        while len(series) >= self.max_series and created:
+            old_key, old_ring = created.popleft()
+            if series.get(old_key, None) is old_ring:
+                del series[old_key]
+        if len(created) > 2 * self.max_series:
+            # forget the removed series
+            self._created = created = deque(
+                (old_key, old_ring) for old_key, old_ring in created
+                if series.get(old_key, None) is old_ring)
+        ring = series[key] = RingBuffer(self.points)
+        created.append((key, ring))
+        return ring
+
+    def discard(self, key):
+        self.series.pop(key, None)
+
+    def query(self, pattern, since=None, max_results=_MAX_RESULTS):
+        """
+        :param pattern: A glob on 'host/service/metric'.
+        :param since: Only the points newer than this time.
+        :return: A dict {'host/service/metric': [(time, value), ...]}.
+        """
+        res = {}
+        for key, ring in self.series.items():
+            path = '/'.join(key)
+            if fnmatchcase(path, pattern):
+                res[path] = ring.points(since)
+                if len(res) >= max_results:
+                    break
+        return res
+
+
+class _HistoryHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        if url.path != '/history' or 'pattern' not in params:
+            self.send_error(404, 'Use /history?pattern=host/service/metric[&since=timestamp]')
+            return
+        try:
+            since = float(params['since'][0]) if 'since' in params else None
+        except ValueError:
+            self.send_error(400, 'Invalid since')
+            return
+        body = json.dumps(self.server.history.query(params['pattern'][0], since))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        logger.debug('[Carbon] History query: %s' % (fmt % args))
+
+
+class HistoryServer(object):
+    """
+    The HTTP server of the history queries, in its own thread.
+    """
+
+    def __init__(self, history, host=DEFAULT_HOST, port=0):
+        self.server = HTTPServer((host, port), _HistoryHandler)
+        self.server.history = history
+        self.address = self.server.server_address
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever,
+                                        name='carbon-history')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self.server.shutdown()
+            self._thread.join()
+            self._thread = None
+        self.server.server_close()
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+Intern pool for the host, service and metric names.
+
+The same names are read on every line and stored as keys of the carbon
+elements table and of each element perf datas. Interning them keeps a single
+string object per distinct name, and the dict lookups hit pointer-equal keys.
+
+The strings stored by an element are acquired (reference counted) and
+released when the element or the perf data is purged. The other interned
+strings (parser results not, or not yet, stored by an element) are dropped
+when the pool is full.
+"""
+
+#############################################################################
+
+DEFAULT_MAX_SIZE = 2000000
+"""Max number of strings in the pool before dropping the unreferenced ones"""
+
+
+#############################################################################
+
+
+class InternPool(object):
+    """
+    A bounded pool of interned strings.
+    """
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE):
+        self.max_size = max_size
+        self._strings = {}
+        self._refs = {}
+
+    def __len__(self):
+        return len(self._strings)
+
+    def __contains__(self, string):
+        return string in self._strings
+
+    def intern(self, string):
+        """
+        :return: The pooled string equal to `string´.
+        """
+        strings = self._strings
+        res = strings.get(string)
+        if res is None:
+            if len(strings) >= self.max_size:
+                self.sweep()
+                strings = self._strings
+            res = strings[string] = string
+        return res
+
+    def acquire(self, string):
+        """
+        Intern a string stored by an element, it stays in the pool until released.
+        :return: The pooled string equal to `string´.
+        """
+        string = self.intern(string)
+        refs = self._refs
+        refs[string] = refs.get(string, 0) + 1
+        return string
+
+    def release(self, string):
+        """
+        Release a string previously acquired, it's dropped from the pool
+        when no element references it anymore.
+        """
+        refs = self._refs
+        count = refs.get(string, 0) - 1
+        if count > 0:
+            refs[string] = count
+        else:
+            refs.pop(string, None)
+            self._strings.pop(string, None)
+
+    def refcount(self, string):
+        return self._refs.get(string, 0)
+
+    def sweep(self):
+        """
+        Drop the strings not referenced by an element.
+        """
+        self._strings = dict((string, string) for string in self._refs)
+
+    def clear(self):
+        self._strings.clear()
+        self._refs.clear()
+
+
+intern_pool = InternPool()
+"""The module-level pool shared by the parser and the elements"""
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+Passive host liveness: a host sending metrics is alive.
+
+The hosts seen since the last tick are kept in a set (O(1) per line). On
+each tick, they are stamped with the tick time and an UP host check result
+is sent for them, at most every up_every seconds per host. A host without
+metrics for down_after seconds gets a DOWN (or UNREACHABLE) result, once,
+and is forgotten until its metrics arrive again: its UP is then sent at once.
+A tick is O(active hosts).
+"""
+
+#############################################################################
+
+UP = 0
+DOWN = 1
+UNREACHABLE = 2
+
+HOST_STATES = {'UP': UP, 'DOWN': DOWN, 'UNREACHABLE': UNREACHABLE}
+
+# without down_after, a silent host is forgotten after _FORGET_AFTER * up_every
+_FORGET_AFTER = 3
+
+
+#############################################################################
+
+
+class HostLiveness(object):
+
+    def __init__(self, up_every, down_after=0, down_state=DOWN):
+        """
+        :param up_every: The min time (in s) between two UP results of a host.
+        :param down_after: The time (in s) without metrics after which a host is DOWN,
+                           0 to never send DOWN results.
+        :param down_state: DOWN or UNREACHABLE.
+        """
+        self.up_every = up_every
+        self.down_after = down_after
+        self.down_state = down_state
+        self.arrived = set()
+        self.last_arrival = {}
+        self.last_up = {}
+
+    def __len__(self):
+        return len(self.last_arrival)
+
+    def seen(self, host):
+        """
+        A metric of the host arrived.
+        """
+        self.arrived.add(host)
+
+    def commands(self, now):
+        """
+        :return: The host check result commands of the tick.
+        """
+        arrived, self.arrived = self.arrived, set()
+        last_arrival = self.last_arrival
+        last_up = self.last_up
+        res = []
+        for host in arrived:
+            last_arrival[host] = now
+            if now >= last_up.get(host, now - self.up_every) + self.up_every:
+                last_up[host] = now
+                res.append('[%d] PROCESS_HOST_CHECK_RESULT;%s;%d;Carbon: metrics received' % (
+                    now, host, UP))
+
+        forget_after = self.down_after or _FORGET_AFTER * self.up_every
+        for host, arrival in last_arrival.items():
+            if now - arrival < forget_after:
+                continue
+            if self.down_after:
+                res.append('[%d] PROCESS_HOST_CHECK_RESULT;%s;%d;Carbon: no metrics for %d s' % (
+                    now, host, self.down_state, now - arrival))
+            del last_arrival[host]
+            last_up.pop(host, None)
+        return res
@@ -22,14 +22,27 @@
 Carbon plaintext protocol implementation.
 """
 
+import errno
+import os
+import re
 import socket
+import stat
 import struct
 
 from datetime import datetime
-from select import select
+from select import select, error as select_error
 from time import time
 from copy import deepcopy
 
+from shinken.log import logger
+
+from .carbon_templates import PathMatcher
+from .carbon_tags import TagMapper, parse_tagged_name
+from .carbon_badlines import (
+    bad_lines, MAX_LINE_LENGTH, TOO_FEW_FIELDS, NON_NUMERIC_VALUE, BAD_TIMESTAMP,
+    WRONG_PATH_DEPTH, OVERSIZE_LINE, INVALID_NAME,
+)
+
 #############################################################################
 
 DEFAULT_PORT = 2003
@@ -46,10 +59,18 @@ DEFAULT_INTERVAL = 10
 
 #############################################################################
 
-# https://github.com/graphite-project/carbon/blob/master/lib/carbon/protocols.py#L122-L124
-# -> We can see carbon truncate line with len > 400 char
-# In python, the size of a string is 38 + 1 per char
-_BUFFER_SIZE = 445  # 445 > 438, ok we are safe.
+# the pooled receive buffers hold a whole datagram (or TCP read), i.e. many lines
+_RECV_BUFFER_SIZE = 65536
+# a Unix datagram isn't limited to 64 KB: this is the default max size on Linux (wmem_default)
+_UNIX_RECV_BUFFER_SIZE = 212992
+_POOL_SIZE = 4
+_NAME_CACHE_SIZE = 100000
+
+# a decimal number, the values and timestamps are validated with it before their conversion
+_is_number = re.compile(r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?$').match
+_NON_FINITE = frozenset(('nan', '+nan', '-nan', 'inf', '+inf', '-inf'))
+# a longer integer may be out of the float range: it's converted to a float, like carbon does
+_MAX_INT_DIGITS = 308
 
 
 #############################################################################
@@ -79,27 +100,191 @@ class CarbonBufferOverflow(CarbonValueError):
     pass
 
 
-def decode_plaintext_packet(buf):
+def decode_plaintext_packet(buf, source=None):
     """
     Decodes a packet in plaintext format.
-    The metric name must respect the collectd naming schema
+    The metric name must respect the collectd naming schema (or a metric template)
+    or be a graphite tagged series : name;tag1=value1;tag2=value2
+    :param buf: The packet, a string.
+    :param source: The peer address the packet was received from.
+    :return: a generator yielding 4-tuples (name, value, timestamp, tags).
+    """
+    if isinstance(buf, unicode):
+        buf = buf.encode('utf-8')
+    return _decode_lines(buf.splitlines(), {}, None, source)
+
+
+def decode_plaintext_buffer(data, length, names=None, limiter=None, source=None):
+    """
+    Decodes the lines of a received buffer.
+    The received bytes are copied once and split in C, the metric names are
+    decoded (and their tags parsed) only when they're not in the `names´ cache.
+    :param data: A bytearray.
+    :param length: The number of bytes received in it.
+    :param names: A dict, the cache of the decoded metric names.
+    :param limiter: An optional RateLimiter, the throttled lines of `source´ are skipped.
+    :param source: The peer address the buffer was received from.
+    :return: a generator yielding 4-tuples (name, value, timestamp, tags).
+    """
+    if names is None:
+        names = {}
+    if length == len(data):
+        # the buffer is full, the last line is truncated
+        end = data.rfind('\n', 0, length) + 1
+        if not end:
+            # a single line longer than the buffer
+            bad_lines.add(OVERSIZE_LINE, source, str(data[:MAX_LINE_LENGTH]))
+        length = end
+    return _decode_lines(memoryview(data)[:length].tobytes().splitlines(), names, limiter, source)
+
+
+def _decode_lines(lines, names, limiter, source):
+    """
+    Decodes the lines, the malformed ones are counted in `bad_lines´ and skipped.
+    Nothing is raised: the values and timestamps are validated before their conversion.
+    """
+    now = time()
+    bad = bad_lines.add
+    for line in lines:
+        if len(line) > MAX_LINE_LENGTH:
+            bad(OVERSIZE_LINE, source, line)
+            continue
+        elem = line.split()
+        if not elem:
+            continue
+        if limiter is not None and not limiter.allow(source, now):
+            continue
+        if len(elem) < 2:
+            bad(TOO_FEW_FIELDS, source, line)
+            continue
+
+        decoded = names.get(elem[0], None)
+        if decoded is None:
+            decoded = decode_metric_name(elem[0])
+            if decoded is None:
+                bad(INVALID_NAME, source, line)
+                continue
+            if len(names) >= _NAME_CACHE_SIZE:
+                names.clear()
+            names[elem[0]] = decoded
+        metric_name, tags = decoded
+
+        # the common forms are validated with isdigit, the others with a regular expression
+        val = elem[1]
+        if val.isdigit() and len(val) <= _MAX_INT_DIGITS:
+            val = int(val)
+        elif val.replace('.', '', 1).isdigit():
+            val = float(val)
+        elif _is_number(val) is not None:
+            # Check if the value if a float or an int
+            if '.' in val or 'e' in val or 'E' in val or len(val) > _MAX_INT_DIGITS:
+                val = float(val)
+            else:
+                val = int(val)
+        elif val.lower() in _NON_FINITE:
+            val = float(val)
+        else:
+            bad(NON_NUMERIC_VALUE, source, line)
+            continue
+        # If we don't have a timestamp, we use current server time
+        if len(elem) == 3:
+            ts = elem[2]
+            if not ts.isdigit() and _is_number(ts) is None:
+                bad(BAD_TIMESTAMP, source, line)
+                continue
+            ts = float(ts)
+            if ts - ts != 0:
+                # out of the float range (infinite)
+                bad(BAD_TIMESTAMP, source, line)
+                continue
+        else:
+            ts = time()
+
+        yield metric_name, val, ts, tags
+
+
+def decode_metric_name(raw):
+    """
+    :param raw: A metric name, a byte string.
+    :return: The 2-tuple (metric name, tags) of a raw metric name, or None if it's invalid.
+    """
+    try:
+        metric_name = raw.decode()
+    except UnicodeDecodeError:
+        return None
+    tags = None
+    if ';' in metric_name:
+        tagged = parse_tagged_name(metric_name)
+        if tagged is None:
+            return None
+        metric_name, tags = tagged
+    return metric_name, tags
+
+
+def parse_number(value):
+    """
+    :param value: A string.
+    :return: Its int or float value, or None if it isn't a number (nothing is raised).
+    """
+    if value.isdigit() and len(value) <= _MAX_INT_DIGITS:
+        return int(value)
+    if _is_number(value) is not None:
+        if '.' in value or 'e' in value or 'E' in value or len(value) > _MAX_INT_DIGITS:
+            return float(value)
+        return int(value)
+    if value.lower() in _NON_FINITE:
+        return float(value)
+    return None
+
+
+def to_float(value):
+    """
+    :param value: An int, long or float.
+    :return: The value as a float, infinite if it's a long out of the float range.
+    """
+    try:
+        return float(value)
+    except OverflowError:
+        return float('inf') if value > 0 else float('-inf')
+
+
+def bind_unix_socket(socktype, path, mode):
+    """
+    :param socktype: socket.SOCK_STREAM or socket.SOCK_DGRAM.
+    :param path: The path of the socket, a stale socket file is replaced.
+    :param mode: The permissions of the socket file.
+    :return: The bound Unix domain socket.
+    """
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            os.remove(path)
+    except OSError as err:
+        if err.errno != errno.ENOENT:
+            raise
+    sock = socket.socket(socket.AF_UNIX, socktype)
+    sock.bind(path)
+    os.chmod(path, mode)
+    return sock
+
+
+class BufferPool(object):
     """
-    elem = buf.decode().split()
-    metric_name = elem[0]
-    val = elem[1]
+    Pool of preallocated receive buffers.
+    """
+
+    def __init__(self, count=_POOL_SIZE, size=_RECV_BUFFER_SIZE):
+        self.size = size
+        self._free = [bytearray(size) for _ in xrange(count)]
 
-    # Check if the value if a float or an int
-    if '.' in val:
-        val = float(val)
-    else:
-        val = int(val)
-    # If we don't have a timestamp, we use current server time
-    if len(elem) == 3:
-        ts = float(elem[2])
-    else:
-        ts = time()
+    def acquire(self):
+        try:
+            return self._free.pop()
+        except IndexError:
+            # all in use: this one will be kept in the pool when released
+            return bytearray(self.size)
 
-    yield metric_name, val, ts
+    def release(self, buf):
+        self._free.append(buf)
 
 
 class Data(object):
@@ -109,6 +294,7 @@ class Data(object):
     plugininstance = None
     type = None
     typeinstance = None
+    tags = None
 
     def __init__(self, **kw):
         for k, v in kw.iteritems():
@@ -152,6 +338,12 @@ class Parser(object):
     Feed its `interpret´ method with some input and get Values instances.
     """
     Values = Values
+    path_matcher = PathMatcher()
+    tag_mapper = TagMapper()
+    rate_limiter = None
+    rate_limit_by = ()
+    statsd_aggregator = None
+    source = None  # the peer address of the packet being interpreted
 
     def receive(self):
         """
@@ -167,36 +359,46 @@ class Parser(object):
     def decode(self, buf=None):
         """
         Decodes a given buffer or the next received packet from `receive()´.
-        :return: a generator yielding 3-tuples (name, value, timestamp).
+        :return: a generator yielding 4-tuples (name, value, timestamp, tags).
         """
         if buf is None:
-            buf = self.receive()
-        return decode_plaintext_packet(buf)
+            buf, self.source = self.receive()
+        return decode_plaintext_packet(buf, self.source)
 
     def interpret_opcodes(self, iterable):
         """
-        :param iterable: An iterable of 3-tuples (metric_name ,value, ts).
-        :return: A generator yielding Values instances based on the iterable.
-        :raise: The generator, when yielding results, can raise a CarbonException
-        (or subclass) instance if there is a decode error.
+        :param iterable: An iterable of 4-tuples (metric_name ,value, ts, tags),
+                         tags is None or a TagSet for the graphite tagged series.
+        :return: A generator yielding Values instances based on the iterable,
+                 the metrics matching no template are counted in `bad_lines´ and skipped.
         """
         vl = self.Values()
+        match = self.path_matcher.match
+        match_tags = self.tag_mapper.match
+        limiter = self.rate_limiter if 'host' in self.rate_limit_by else None
+        bad = bad_lines.add
+        now = time()
 
         # We parse our packet to obtain the collectd naming's schema informations,
         # the value and the timestamp:
-        # format of metric_name :
+        # format of metric_name is given by the metric templates, by default :
         # host.plugin[-plugin_instance].type[-type_instance]
 
-        for metric_name, value, ts in iterable:
-            plugin_instance = None
-            compl_instance = None
-            host, plugin, compl = metric_name.split('.')
-
-            if '-' in plugin:
-                plugin, plugin_instance = plugin.split('-')
-
-            if '-' in compl:
-                compl, compl_instance = compl.split('-')
+        for metric_name, value, ts, tags in iterable:
+            if tags is None:
+                fields = match(metric_name)
+                if fields is None:
+                    bad(WRONG_PATH_DEPTH, self.source, metric_name)
+                    continue
+            else:
+                fields = match_tags(metric_name, tags)
+                if fields is None:
+                    # no host, plugin or type tag
+                    bad(INVALID_NAME, self.source, metric_name)
+                    continue
+            host, plugin, plugin_instance, compl, compl_instance = fields
+            if limiter is not None and not limiter.allow(host, now):
+                continue
 
             vl.time = ts
             vl.host = host
@@ -204,6 +406,7 @@ class Parser(object):
             vl.plugininstance = plugin_instance
             vl.type = compl
             vl.typeinstance = compl_instance
+            vl.tags = tags
             vl[:] = [value]
 
             yield deepcopy(vl)
@@ -219,7 +422,7 @@ class Parser(object):
             If a basestring -> It will also be decode().
 
             After what the result of decode()
-            (a generator which yields 3-tuple (name, value, timestamp))
+            (a generator which yields 4-tuple (name, value, timestamp, tags))
             is given to interpret_opcodes() which will then yield carbon `Values´  instances.
 
             If the `input´ initial value isn't None nor a basestring then it's directly given to
@@ -229,9 +432,8 @@ class Parser(object):
 
         :raise:
             When a read on the socket is needed, it's not impossible to raise some IO exception.
-            Otherwise no raise should occur to return the generator.
-            But the returned generator can raise (subclass-)`CarbonException´ instance
-            if a decode problem occurs.
+            Otherwise no raise should occur: the malformed lines are counted in
+            `bad_lines´ and skipped by the returned generator.
         """
         if isinstance(input, (type(None), basestring)):
             input = self.decode(input)
@@ -246,16 +448,28 @@ class Reader(Parser):
     Reader handles reading data when it arrives.
     """
 
-    def __init__(self, udp, tcp):
+    def __init__(self, udp, tcp, relay=None, statsd=None, unix_stream=None, unix_dgram=None):
         """
         :param udp: A dict with a host and a port for a TCP connection .
         :param tcp: A dict with a host, a port and a multicast bollean for a UDP connection.
+        :param relay: An optional CarbonRelay the received packets are forwarded to.
+        :param statsd: A dict with a host and a port for a StatsD UDP listener, its samples
+                       are aggregated by the statsd_aggregator.
+        :param unix_stream: A dict with a path and a mode for a Unix stream socket.
+        :param unix_dgram: A dict with a path and a mode for a Unix datagram socket.
         :return: A ready to be used carbon Reader instance.
         """
         self._sock_tcp = None
         self._sock_udp = None
+        self._sock_statsd = None
+        self._sock_unix_stream = None
+        self._sock_unix_dgram = None
+        self.relay = relay
+        self.buffers = BufferPool(size=_UNIX_RECV_BUFFER_SIZE if unix_dgram else _RECV_BUFFER_SIZE)
+        self._names = {}
 
-        self.udp, self.tcp = udp, tcp
+        self.udp, self.tcp, self.statsd = udp, tcp, statsd
+        self.unix_stream, self.unix_dgram = unix_stream, unix_dgram
 
         if self.tcp:
             self.ipv6_tcp = ":" in self.tcp['host']
@@ -307,28 +521,123 @@ class Reader(Parser):
                     socket.IPPROTO_IPV6 if self.ipv6_udp else socket.IPPROTO_IP,
                     socket.IP_MULTICAST_LOOP, 0)
 
-    def receive(self):
-        """ Receives a single raw carbon plaintext packet. """
+        if self.statsd:
+            family, socktype, proto, canonname, sockaddr = socket.getaddrinfo(
+                self.statsd['host'], self.statsd['port'], socket.AF_UNSPEC,
+                socket.SOCK_DGRAM, 0, socket.AI_PASSIVE)[0]
+
+            self._sock_statsd = socket.socket(family, socktype, proto)
+            self._sock_statsd.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self._sock_statsd.bind(sockaddr)
+
+        if self.unix_stream:
+            self._sock_unix_stream = bind_unix_socket(
+                socket.SOCK_STREAM, self.unix_stream['path'], self.unix_stream['mode'])
+            self._sock_unix_stream.listen(5)
+
+        if self.unix_dgram:
+            self._sock_unix_dgram = bind_unix_socket(
+                socket.SOCK_DGRAM, self.unix_dgram['path'], self.unix_dgram['mode'])
+
+    def _select(self):
+        """ :return: The sockets ready to be read. """
         sock = []
         if self._sock_tcp:
             sock.append(self._sock_tcp)
         if self._sock_udp:
             sock.append(self._sock_udp)
-
-        inputready, outputready, exceptready = select(sock, [], [])
-
-        for s in inputready:
+        if self._sock_statsd:
+            sock.append(self._sock_statsd)
+        if self._sock_unix_stream:
+            sock.append(self._sock_unix_stream)
+        if self._sock_unix_dgram:
+            sock.append(self._sock_unix_dgram)
+
+        while True:
+            try:
+                inputready, outputready, exceptready = select(sock, [], [])
+                return inputready
+            except select_error as err:
+                # interrupted by a signal
+                if err.args[0] != errno.EINTR:
+                    raise
+
+    def receive_into(self, data):
+        """
+        Receives a raw carbon plaintext packet in a buffer.
+        A StatsD datagram is aggregated, there is nothing to decode (0 bytes).
+        :param data: A bytearray.
+        :return: A 2-tuple (number of bytes received, peer address).
+        """
+        for s in self._select():
             if s == self._sock_tcp:
-                connect, _ = self._sock_tcp.accept()
-                return connect.recv(_BUFFER_SIZE)
+                connect, addr_from = self._sock_tcp.accept()
+                length = connect.recv_into(data)
             elif s == self._sock_udp:
-                buf, addr_from = self._sock_udp.recvfrom(_BUFFER_SIZE)
-                return buf
+                length, addr_from = self._sock_udp.recvfrom_into(data)
+            elif s == self._sock_statsd:
+                length, addr_from = self._sock_statsd.recvfrom_into(data)
+                limiter = self.rate_limiter if 'peer' in self.rate_limit_by else None
+                self.statsd_aggregator.add_packet(data, length, limiter, addr_from[0])
+                return 0, addr_from[0]
+            elif s == self._sock_unix_stream:
+                # the local peers have no address, the source is the socket path
+                connect, _ = self._sock_unix_stream.accept()
+                length = connect.recv_into(data)
+                addr_from = (self.unix_stream['path'],)
+            elif s == self._sock_unix_dgram:
+                length = self._sock_unix_dgram.recv_into(data)
+                addr_from = (self.unix_dgram['path'],)
             else:
-                print "unknown socket:", s
+                logger.warning('[Carbon] Unknown socket: %s' % s)
+                continue
+            if self.relay is not None:
+                # the buffer is reused, the relay gets a copy
+                self.relay.forward(str(data[:length]))
+            return length, addr_from[0]
+        return 0, None
+
+    def decode(self, buf=None):
+        """
+        Decodes a given buffer, or the next received packet, received in a pooled buffer.
+        :return: a generator yielding 4-tuples (name, value, timestamp, tags).
+        """
+        if buf is not None:
+            self.source = None
+            return decode_plaintext_packet(buf)
+        return self._decode_received()
+
+    def _decode_received(self):
+        data = self.buffers.acquire()
+        limiter = self.rate_limiter if 'peer' in self.rate_limit_by else None
+        try:
+            length, peer = self.receive_into(data)
+            self.source = peer
+            for item in decode_plaintext_buffer(data, length, self._names, limiter, peer):
+                yield item
+        finally:
+            self.buffers.release(data)
+
+    def age_caches(self):
+        """
+        Age the path, tags and names caches: the entries not used since the previous call are dropped.
+        """
+        self.path_matcher.age()
+        self.tag_mapper.age()
+        self._names = {}
 
     def close(self):
         if self._sock_tcp:
             self._sock_tcp.close()
         if self._sock_udp:
             self._sock_udp.close()
+        if self._sock_statsd:
+            self._sock_statsd.close()
+        for sock, conf in ((self._sock_unix_stream, self.unix_stream),
+                           (self._sock_unix_dgram, self.unix_dgram)):
+            if sock:
+                sock.close()
+                try:
+                    os.remove(conf['path'])
+                except OSError:
+                    pass
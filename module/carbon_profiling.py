@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+Runtime-toggleable profiling of the receive and aggregation hot path.
+
+The timers are installed by replacing the profiled methods with timed
+wrappers when they are enabled, and by putting the original methods back
+when they are disabled: a disabled profiler costs nothing.
+
+A cProfile run of a given duration can also be started, its stats are
+dumped to a file (to be read with pstats) when it ends.
+"""
+
+import cProfile
+import os
+import time
+from timeit import default_timer
+
+#############################################################################
+
+DEFAULT_DURATION = 30
+"""Default duration (in s) of a cProfile run"""
+
+
+#############################################################################
+
+
+class Timer(object):
+    __slots__ = ('label', 'count', 'total', 'max')
+
+    def __init__(self, label):
+        self.label = label
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, elapsed):
+        self.count += 1
+        self.total += elapsed
+        if elapsed > self.max:
+            self.max = elapsed
+
+    def __str__(self):
+        return '%s: %d calls, %.3f s total, %.1f us avg, %.1f us max' % (
+            self.label, self.count, self.total,
+            1e6 * self.total / self.count if self.count else 0, 1e6 * self.max)
+
+
+def _timed(func, timer):
+    def wrapper(*args, **kwargs):
+        start = default_timer()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            timer.add(default_timer() - start)
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    return wrapper
+
+
+def _timed_generator(func, timer):
+    # the time spent in the generator, not only in its creation
+    def wrapper(*args, **kwargs):
+        gen = func(*args, **kwargs)
+        elapsed = 0.0
+        try:
+            while True:
+                start = default_timer()
+                try:
+                    item = next(gen)
+                except StopIteration:
+                    return
+                finally:
+                    elapsed += default_timer() - start
+                yield item
+        finally:
+            timer.add(elapsed)
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    return wrapper
+
+
+class Profiler(object):
+    """
+    Timers on a set of methods, and cProfile runs.
+    """
+
+    def __init__(self, targets=()):
+        """
+        :param targets: A list of (class, method name, label, is_generator).
+        """
+        self.targets = list(targets)
+        self.timers = {}
+        self.since = None
+        self._originals = []
+        self._cprofile = None
+        self._cprofile_end = None
+        self._cprofile_path = None
+
+    @property
+    def enabled(self):
+        return bool(self._originals)
+
+    def enable(self):
+        """
+        Install the timers, they are reset.
+        """
+        if self.enabled:
+            return
+        self.timers = {}
+        self.since = time.time()
+        for owner, name, label, is_generator in self.targets:
+            original = owner.__dict__[name]
+            timer = self.timers[label] = Timer(label)
+            wrap = _timed_generator if is_generator else _timed
+            setattr(owner, name, wrap(original, timer))
+            self._originals.append((owner, name, original))
+
+    def disable(self):
+        """
+        Put back the original methods, the timers are kept for `report()´.
+        """
+        for owner, name, original in reversed(self._originals):
+            setattr(owner, name, original)
+        self._originals = []
+
+    def toggle(self):
+        """
+        :return: True if the timers are now enabled.
+        """
+        if self.enabled:
+            self.disable()
+        else:
+            self.enable()
+        return self.enabled
+
+    def report(self):
+        """
+        :return: The timers, by total time, as a list of strings.
+        """
+        if self.since is None:
+            return []
+        res = ['timers since %s:' % time.strftime('%Y-%m-%d %H:%M:%S',
+                                                   time.localtime(self.since))]
+        for timer in sorted(self.timers.itervalues(), key=lambda t: t.total, reverse=True):
+            res.append('  %s' % timer)
+        return res
+
+    def start_cprofile(self, directory, duration=DEFAULT_DURATION, now=None):
+        """
+        Start a cProfile run (of the current thread) for `duration´ seconds.
+        :return: The file its stats will be dumped to, None if a run is in progress.
+        """
+        if self._cprofile is not None:
+            return None
+        if now is None:
+            now = time.time()
+        self._cprofile_end = now + duration
+        self._cprofile_path = os.path.join(directory, 'carbon-%d.prof' % now)
+        self._cprofile = cProfile.Profile()
+        self._cprofile.enable()
+        return self._cprofile_path
+
+    def check_cprofile(self, now=None):
+        """
+        End the cProfile run if its duration is over.
+        :return: The file the stats have been dumped to, None if there is nothing done.
+        """
+        if self._cprofile is None:
+            return None
+        if now is None:
+            now = time.time()
+        if now < self._cprofile_end:
+            return None
+        return self.stop_cprofile()
+
+    def stop_cprofile(self):
+        if self._cprofile is None:
+            return None
+        self._cprofile.disable()
+        path = self._cprofile_path
+        self._cprofile.dump_stats(path)
+        self._cprofile = self._cprofile_end = self._cprofile_path = None
+        return path
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+Per source rate limiting of the received lines, with token buckets.
+
+A source is a peer address or a metric host. Each source has its own bucket,
+refilled at the global rate (or at its override rate) up to the burst size:
+a line is accepted if a token is available, otherwise it's throttled.
+"""
+
+#############################################################################
+
+_UNLIMITED = None
+
+
+#############################################################################
+
+
+class TokenBucket(object):
+    __slots__ = ('rate', 'burst', 'tokens', 'last')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = now
+
+    def consume(self, now, count=1):
+        """
+        :return: True if there were `count´ tokens available (they are consumed).
+        """
+        tokens = self.tokens + (now - self.last) * self.rate
+        if tokens > self.burst:
+            tokens = self.burst
+        self.last = now
+        if tokens >= count:
+            self.tokens = tokens - count
+            return True
+        self.tokens = tokens
+        return False
+
+    def full(self, now):
+        return self.tokens + (now - self.last) * self.rate >= self.burst
+
+
+class RateLimiter(object):
+    """
+    Token buckets of the sources.
+    """
+
+    def __init__(self, rate, burst=None, overrides=None):
+        """
+        :param rate: The number of lines per second of a source, 0 for no limit.
+        :param burst: The size of the buckets (for the global rate), by default `rate´.
+        :param overrides: A dict {source: rate}, 0 for no limit. The burst lasts as long as
+                          the global one.
+        """
+        self.rate = rate
+        self.burst = burst or rate
+        self.burst_time = float(self.burst) / rate if rate else 1.0
+        self.overrides = overrides or {}
+        self.buckets = {}
+        self.throttled = {}
+        self.n_throttled = 0
+
+    def _bucket(self, source, now):
+        rate = self.overrides.get(source, self.rate)
+        if not rate:
+            bucket = _UNLIMITED
+        elif rate == self.rate:
+            bucket = TokenBucket(rate, self.burst, now)
+        else:
+            bucket = TokenBucket(rate, max(rate * self.burst_time, 1), now)
+        self.buckets[source] = bucket
+        return bucket
+
+    def allow(self, source, now):
+        """
+        :return: True if a line of the source is accepted.
+        """
+        try:
+            bucket = self.buckets[source]
+        except KeyError:
+            bucket = self._bucket(source, now)
+        if bucket is _UNLIMITED or bucket.consume(now):
+            return True
+        self.n_throttled += 1
+        self.throttled[source] = self.throttled.get(source, 0) + 1
+        return False
+
+    def purge(self, now):
+        """
+        Forget the buckets of the sources idle long enough to have a full bucket.
+        """
+        for source, bucket in self.buckets.items():
+            if bucket is _UNLIMITED or bucket.full(now):
+                del self.buckets[source]
+
+    def report(self):
+        """
+        :return: The throttled sources since the last report (by throttled lines),
+                 as a string. The period counters are reset.
+        """
+        throttled, self.throttled = self.throttled, {}
+        return '%d lines throttled, %d throttled sources%s' % (
+            sum(throttled.itervalues()), len(throttled),
+            ': %s' % ', '.join('%s (%d)' % item for item in sorted(
+                throttled.iteritems(), key=lambda item: item[1], reverse=True))
+            if throttled else '')
+
+
+def parse_rate_overrides(spec):
+    """
+    :param spec: A 'source=rate, source=rate' string.
+    :return: A dict {source: rate}.
+    """
+    res = {}
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        source, sep, rate = item.rpartition('=')
+        if not sep or not source.strip():
+            raise ValueError('Invalid rate limit override %r' % item)
+        res[source.strip()] = float(rate)
+    return res
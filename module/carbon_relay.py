@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+"""
+Relay of the received carbon lines to downstream carbon servers.
+
+The reader only appends the raw received packets to an inbox, a dedicated
+thread splits them in lines, routes each line by its metric path on a
+consistent hash ring (like carbon-relay does) and sends them, in batches, on
+one persistent TCP connection per destination. Each destination has a bounded
+buffer and reconnects with an exponential backoff.
+"""
+
+import bisect
+import socket
+import threading
+import time
+from collections import deque
+from hashlib import md5
+
+from shinken.log import logger
+
+#############################################################################
+
+DEFAULT_MAX_BUFFER = 100000
+"""Default max number of lines buffered per destination"""
+
+DEFAULT_MAX_INBOX = 10000
+"""Default max number of received packets waiting to be relayed"""
+
+DEFAULT_FLUSH_INTERVAL = 0.2
+"""Default time (in s) between two flushes of the destinations buffers"""
+
+MIN_BACKOFF = 1
+MAX_BACKOFF = 60
+
+_RING_REPLICAS = 100
+_ROUTE_CACHE_SIZE = 100000
+
+
+#############################################################################
+
+
+class ConsistentHashRing(object):
+    """
+    Consistent hash ring of the destinations.
+    """
+
+    def __init__(self, nodes, replicas=_RING_REPLICAS):
+        """
+        :param nodes: A list of destination keys (e.g. 'host:port').
+        :param replicas: The number of positions of each node on the ring.
+        """
+        self.nodes = list(nodes)
+        ring = []
+        for node in self.nodes:
+            for idx in xrange(replicas):
+                ring.append((self._position('%s:%d' % (node, idx)), node))
+        ring.sort()
+        self._positions = [pos for pos, _ in ring]
+        self._ring = [node for _, node in ring]
+
+    @staticmethod
+    def _position(key):
+        return int(md5(key).hexdigest()[:8], 16)
+
+    def get_nodes(self, key, count=1):
+        """
+        :param key: The metric path.
+        :param count: The number of distinct nodes to get.
+        :return: A list of nodes, the first one is the primary.
+        """
+        count = min(count, len(self.nodes))
+        res = []
+        idx = bisect.bisect_left(self._positions, self._position(key))
+        ring = self._ring
+        while len(res) < count:
+            node = ring[idx % len(ring)]
+            if node not in res:
+                res.append(node)
+            idx += 1
+        return res
+
+
+class Destination(object):
+    """
+    A downstream carbon server, with its buffer and its persistent connection.
+    """
+
+    def __init__(self, host, port, max_buffer=DEFAULT_MAX_BUFFER, timeout=5):
+        self.host = host
+        self.port = port
+        self.key = '%s:%d' % (host, port)
+        self.max_buffer = max_buffer
+        self.timeout = timeout
+        self.lines = []
+        self.sock = None
+        self.backoff = MIN_BACKOFF
+        self.next_connect = 0
+
+        self.n_sent = 0
+        self.n_dropped = 0
+        self.n_errors = 0
+
+    def __str__(self):
+        return self.key
+
+    def append(self, line):
+        if len(self.lines) >= self.max_buffer:
+            self.n_dropped += 1
+            return
+        self.lines.append(line)
+
+    def _connect(self):
+        self.sock = socket.create_connection((self.host, self.port), self.timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.backoff = MIN_BACKOFF
+
+    def _failed(self, now, err):
+        self.n_errors += 1
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        self.next_connect = now + self.backoff
+        self.backoff = min(self.backoff * 2, MAX_BACKOFF)
+        return err
+
+    def flush(self, now):
+        """
+        Send the buffered lines in one write.
+        :return: None, or the socket error if the send failed (the lines are kept).
+        """
+        if not self.lines:
+            return
+        if self.sock is None:
+            if now < self.next_connect:
+                return
+            try:
+                self._connect()
+            except socket.error as err:
+                return self._failed(now, err)
+        lines = self.lines
+        try:
+            self.sock.sendall('\n'.join(lines) + '\n')
+        except socket.error as err:
+            return self._failed(now, err)
+        self.lines = []
+        self.n_sent += len(lines)
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+class CarbonRelay(object):
+    """
+    Relay the received lines to one or more destinations.
+    """
+
+    def __init__(self, destinations, replication=1, max_buffer=DEFAULT_MAX_BUFFER,
+                 max_inbox=DEFAULT_MAX_INBOX, flush_interval=DEFAULT_FLUSH_INTERVAL):
+        """
+        :param destinations: A list of (host, port).
+        :param replication: The number of destinations receiving each metric.
+        :param max_buffer: The max number of lines buffered per destination.
+        :param max_inbox: The max number of received packets waiting to be relayed.
+        :param flush_interval: The time (in s) between two flushes.
+        """
+        self.destinations = dict((dest.key, dest) for dest in
+                                 (Destination(host, port, max_buffer) for host, port in destinations))
+        self.ring = ConsistentHashRing(sorted(self.destinations))
+        self.replication = replication
+        self.max_inbox = max_inbox
+        self.flush_interval = flush_interval
+        self.n_dropped = 0
+
+        self._inbox = deque()
+        self._routes = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def forward(self, buf):
+        """
+        Queue a received packet to be relayed. Called by the reader, it must stay cheap.
+        """
+        if len(self._inbox) >= self.max_inbox:
+            self.n_dropped += 1
+            return
+        self._inbox.append(buf)
+
+    def _route(self, path):
+        dests = self._routes.get(path)
+        if dests is None:
+            dests = [self.destinations[key]
+                     for key in self.ring.get_nodes(path, self.replication)]
+            if len(self._routes) >= _ROUTE_CACHE_SIZE:
+                self._routes.clear()
+            self._routes[path] = dests
+        return dests
+
+    def process(self):
+        """
+        Route the received packets to the destinations buffers.
+        """
+        inbox = self._inbox
+        route = self._route
+        while inbox:
+            buf = inbox.popleft()
+            for line in buf.splitlines():
+                elems = line.split(None, 1)
+                if not elems:
+                    continue
+                for dest in route(elems[0]):
+                    dest.append(line)
+
+    def flush(self, now=None):
+        """
+        Flush the destinations buffers.
+        :return: A list of (destination, socket error) for the failed destinations.
+        """
+        if now is None:
+            now = time.time()
+        errors = []
+        for dest in self.destinations.itervalues():
+            err = dest.flush(now)
+            if err is not None:
+                errors.append((dest, err))
+        return errors
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.process()
+            for dest, err in self.flush():
+                logger.warning('[Carbon] Relay to %s failed: %s, retry in %d s' % (
+                    dest, err, dest.next_connect - time.time()))
+            self._stop.wait(self.flush_interval)
+        self.process()
+        self.flush()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='carbon-relay')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        for dest in self.destinations.itervalues():
+            dest.close()
+
+    def stats(self):
+        return ', '.join(['%s: %d sent, %d dropped, %d errors, %d buffered' % (
+            dest, dest.n_sent, dest.n_dropped, dest.n_errors, len(dest.lines))
+            for dest in self.destinations.itervalues()] +
+            ['%d packets dropped' % self.n_dropped])
+
+
+def parse_destinations(spec):
+    """
+    :param spec: A 'host:port, host:port' string.
+    :return: A list of (host, port).
+    """
+    res = []
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        host, sep, port = item.rpartition(':')
+        if not sep:
+            raise ValueError('Invalid relay destination %r' % item)
+        res.append((host.strip('[]'), int(port)))
+    return res
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+Per metric reorder window: a fixed size ring buffer of the last points,
+ordered by their time.
+
+A point older than the latest one but within the window is inserted at its
+place, a point with the time of a stored one replaces its value, a point
+older than the whole (full) window is dropped. The slots are allocated once,
+adding a point allocates nothing.
+"""
+
+from array import array
+
+#############################################################################
+
+LATEST = 0
+"""The point is the latest one of the window"""
+
+LATE = 1
+"""The point is older than the latest one, but in the window"""
+
+DROPPED = 2
+"""The point is older than the whole window"""
+
+
+#############################################################################
+
+
+class ReorderWindow(object):
+    __slots__ = ('size', 'times', 'values', 'count', 'end')
+
+    def __init__(self, size):
+        """
+        :param size: The number of points kept.
+        """
+        self.size = size
+        self.times = array('d', [0.0]) * size
+        self.values = [None] * size
+        self.count = 0
+        self.end = 0  # the slot after the latest point
+
+    def __len__(self):
+        return self.count
+
+    def add(self, mtime, value):
+        """
+        :return: LATEST, LATE or DROPPED.
+        """
+        size = self.size
+        times = self.times
+        values = self.values
+        count = self.count
+        end = self.end
+
+        # the number of points newer than this one, from the latest
+        newer = 0
+        idx = end - 1
+        while newer < count and times[idx % size] > mtime:
+            newer += 1
+            idx -= 1
+        if newer < count and times[idx % size] == mtime:
+            # the same time: the last received value wins
+            values[idx % size] = value
+            return LATE if newer else LATEST
+        if newer == count == size:
+            return DROPPED
+
+        # the slot at `end´ is free, or holds the oldest point (dropped): shift the newer points
+        for pos in xrange(end, end - newer, -1):
+            times[pos % size] = times[(pos - 1) % size]
+            values[pos % size] = values[(pos - 1) % size]
+        pos = (end - newer) % size
+        times[pos] = mtime
+        values[pos] = value
+        self.end = (end + 1) % size
+        if count < size:
+            self.count = count + 1
+        return LATE if newer else LATEST
+
+    def latest(self):
+        """
+        :return: The (time, value) of the latest point.
+        """
+        idx = (self.end - 1) % self.size
+        return self.times[idx], self.values[idx]
+
+    def points(self):
+        """
+        :return: The (time, value) of the points, from the oldest.
+        """
+        size = self.size
+        start = self.end - self.count
+        return [(self.times[idx % size], self.values[idx % size])
+                for idx in xrange(start, self.end)]
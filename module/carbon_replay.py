@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+Offline ingest and replay of captured carbon plaintext streams.
+
+A capture (plain text, or gzip) is memory-mapped and each line goes through
+the same parser and elements pipeline as the live module. The time of the
+elements follows the lines timestamps, so the commands are the ones the
+module would have sent. The replay runs as fast as possible, or at a scaled
+real-time rate, and the commands are given to a pluggable sink.
+
+It's used to backfill after an outage and as a deterministic performance
+regression input:
+
+python -m module.carbon_replay [options] capture[.gz]
+"""
+
+import argparse
+import gzip
+import mmap
+import sys
+import time
+
+from shinken.external_command import ExternalCommand
+from shinken.objects.module import Module
+
+from .carbon_parser import DEFAULT_INTERVAL
+from .carbon_shinken_parser import ShinkenCarbonReader
+from .carbon_tags import parse_tags_mapping
+from .module import CarbonArbiter
+
+#############################################################################
+
+_GZIP_MAGIC = '\x1f\x8b'
+_TICK = 1  # time (in s of the capture) between two commands emissions
+_CLEAN_EVERY = 15
+
+
+#############################################################################
+
+
+class ReplayClock(object):
+    """
+    Time source following the timestamps of the replayed lines.
+    """
+
+    def __init__(self, now=None):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def open_capture(path):
+    """
+    :param path: A capture file, gzip compressed or not.
+    :return: An iterator on the capture lines.
+    """
+    with open(path, 'rb') as capture:
+        try:
+            data = mmap.mmap(capture.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty file
+            return iter([])
+    if data[:2] == _GZIP_MAGIC:
+        return iter(gzip.GzipFile(fileobj=data))
+    return iter(data.readline, '')
+
+
+def write_sink(stream):
+    """
+    :return: A sink writing the commands to a file object, one per line.
+    """
+    def sink(cmd):
+        stream.write('%s\n' % cmd)
+    return sink
+
+
+def queue_sink(queue):
+    """
+    :return: A sink putting the commands in a Shinken queue.
+    """
+    def sink(cmd):
+        queue.put(ExternalCommand(cmd))
+    return sink
+
+
+class Replay(object):
+    """
+    Replay carbon lines through a CarbonArbiter elements pipeline.
+    """
+
+    def __init__(self, sink, interval=DEFAULT_INTERVAL, speed=0, **options):
+        """
+        :param sink: A function called with each command.
+        :param interval: The elements interval.
+        :param speed: 0 to replay as fast as possible, otherwise the real-time factor
+                      (e.g. 10 for 10 times faster than the capture).
+        :param options: The other CarbonArbiter options (grouped_collectd_plugins,
+                        templates, tags_mapping, reorder_window, adaptive_interval).
+        """
+        self.sink = sink
+        self.speed = speed
+        self.clock = ReplayClock()
+        self.arbiter = CarbonArbiter(Module({'module_name': 'carbon-replay',
+                                             'module_type': 'carbon'}),
+                                     {}, {}, interval, clock=self.clock, **options)
+        self.reader = ShinkenCarbonReader({}, {}, **self.arbiter.reader_options())
+
+        self.n_lines = 0
+        self.n_skipped = 0
+        self.n_commands = 0
+
+    def _emit(self):
+        for cmd in self.arbiter._get_commands():
+            self.sink(cmd)
+            self.n_commands += 1
+
+    def run(self, lines):
+        """
+        :param lines: An iterable of carbon plaintext lines.
+        """
+        clock = self.clock
+        read_packet = self.arbiter._read_carbon_packet
+        reader = self.reader
+        speed = self.speed
+        first_ts = start = None
+        next_tick = next_clean = 0
+
+        for line in lines:
+            elems = line.split()
+            if len(elems) < 2:
+                self.n_skipped += 1
+                continue
+            if len(elems) > 2:
+                try:
+                    ts = float(elems[2])
+                except ValueError:
+                    self.n_skipped += 1
+                    continue
+            else:
+                # no timestamp: the line is at the time of the previous one
+                ts = clock.now if clock.now is not None else time.time()
+                line = '%s %s %f' % (elems[0], elems[1], ts)
+
+            if first_ts is None:
+                first_ts = clock.now = ts
+                start = time.time()
+                next_tick = ts + _TICK
+                next_clean = ts + _CLEAN_EVERY
+            elif ts > clock.now:
+                clock.now = ts
+            if speed:
+                delay = start + (clock.now - first_ts) / speed - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+
+            # the time moves on: emit with all the lines of the previous tick
+            if clock.now >= next_tick:
+                next_tick = clock.now + _TICK
+                self._emit()
+            if clock.now >= next_clean:
+                next_clean = clock.now + _CLEAN_EVERY
+                self.arbiter._purge_elements(clock.now)
+
+            read_packet(reader, line)
+            self.n_lines += 1
+
+        # the end of the capture: let the last elements be sent
+        if clock.now is not None:
+            clock.now += self.arbiter.interval + _TICK
+            self._emit()
+
+    def stats(self):
+        return '%d lines, %d skipped, %d commands, %d elements' % (
+            self.n_lines, self.n_skipped, self.n_commands, len(self.arbiter.elements))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay a carbon plaintext capture.')
+    parser.add_argument('capture', help='capture file, gzip compressed or not')
+    parser.add_argument('--speed', type=float, default=0,
+                        help='real-time factor, 0 (default) for as fast as possible')
+    parser.add_argument('--interval', type=int, default=DEFAULT_INTERVAL)
+    parser.add_argument('--grouped-collectd-plugins', default='')
+    parser.add_argument('--metric-templates', default='')
+    parser.add_argument('--tags-mapping', default='')
+    parser.add_argument('--reorder-window', type=int, default=0)
+    parser.add_argument('--adaptive-interval', action='store_true')
+    parser.add_argument('--output', default='-', help='commands output file (default: stdout)')
+    args = parser.parse_args(argv)
+
+    output = sys.stdout if args.output == '-' else open(args.output, 'w')
+    replay = Replay(write_sink(output), interval=args.interval, speed=args.speed,
+                    grouped_collectd_plugins=[name.strip() for name in
+                                              args.grouped_collectd_plugins.split(',')
+                                              if name.strip()],
+                    templates=[template.strip() for template in
+                               args.metric_templates.split(',') if template.strip()],
+                    tags_mapping=parse_tags_mapping(args.tags_mapping),
+                    reorder_window=args.reorder_window,
+                    adaptive_interval=args.adaptive_interval)
+    start = time.time()
+    replay.run(open_capture(args.capture))
+    duration = time.time() - start
+    output.flush()
+    sys.stderr.write('%s in %.3f s (%d lines/s)\n' % (
+        replay.stats(), duration, replay.n_lines / duration if duration else 0))
+
+
+if __name__ == '__main__':
+    main()
@@ -5,6 +5,8 @@ from .carbon_parser import (
     Values as _Values, Data as _Data,
     DEFAULT_INTERVAL
 )
+from .carbon_templates import PathMatcher
+from .carbon_tags import TagMapper
 
 
 class Data(_Data):
@@ -35,6 +37,14 @@ class Data(_Data):
             res += '-' + self.typeinstance
         return res
 
+    def get_summary_key(self):
+        """
+        :return: The type of the metric across the plugin instances, its summary row.
+        """
+        if self.typeinstance:
+            return '%s-%s' % (self.type, self.typeinstance)
+        return self.type
+
     def get_name(self):
         return '%s;%s' % (self.host, self.get_srv_desc())
 
@@ -45,10 +55,33 @@ class Values(Data, _Values):
 
 class ShinkenCarbonReader(Reader):
 
+    OPTIONS = ('interval', 'grouped_collectd_plugins', 'templates', 'tags_mapping',
+               'rate_limiter', 'rate_limit_by', 'statsd_aggregator')
+
     def __init__(self, *a, **kw):
-        self.grouped_collectd_plugins = kw.pop('grouped_collectd_plugins', [])
-        self.interval = kw.pop('interval', DEFAULT_INTERVAL)
+        options = dict((name, kw.pop(name)) for name in self.OPTIONS if name in kw)
         super(ShinkenCarbonReader, self).__init__(*a, **kw)
+        self.templates = self.tags_mapping = None
+        self.configure(**options)
+
+    def configure(self, interval=DEFAULT_INTERVAL, grouped_collectd_plugins=None,
+                  templates=None, tags_mapping=None, rate_limiter=None, rate_limit_by=(),
+                  statsd_aggregator=None):
+        """
+        (Re)configure the reader, its sockets are kept.
+        The path and tags caches are only rebuilt when their rules change.
+        """
+        self.grouped_collectd_plugins = grouped_collectd_plugins or []
+        self.interval = interval
+        if templates != self.templates:
+            self.path_matcher = PathMatcher(templates) if templates else Reader.path_matcher
+            self.templates = templates
+        if tags_mapping != self.tags_mapping:
+            self.tag_mapper = TagMapper(tags_mapping) if tags_mapping else Reader.tag_mapper
+            self.tags_mapping = tags_mapping
+        self.rate_limiter = rate_limiter
+        self.rate_limit_by = rate_limit_by
+        self.statsd_aggregator = statsd_aggregator
 
     def Values(self):
         return Values(interval=self.interval,
@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk snapshot of the carbon elements table, for a fast warm restart.
+
+The snapshot is a compact binary file (little endian):
+
+- header: magic, version, snapshot time, number of elements, index offset
+- one record per element: last sent time, host name, service description
+  and, for each perf data, its name, its summary type and plugin instance
+  (empty if the element isn't summarized) and its points (value, time,
+  here time)
+- index: the element names and the offsets of their records
+
+At startup only the index is read; the file is memory-mapped and an element
+record is decoded when data arrives for this element.
+"""
+
+import mmap
+import os
+import struct
+import time
+
+from .carbon_parser import to_float
+
+#############################################################################
+
+MAGIC = 'CRBS'
+VERSION = 2
+
+_HEADER = struct.Struct('<4sBxxxdIQ')
+_ELEMENT = struct.Struct('<dH')
+_POINT = struct.Struct('<Bddd')
+_LEN = struct.Struct('<H')
+_COUNT = struct.Struct('<I')
+
+_INT, _FLOAT = 0, 1
+
+
+#############################################################################
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def _text(string):
+    """
+    :return: The string as unicode, a byte string is decoded as UTF-8 (invalid bytes replaced).
+    """
+    if isinstance(string, unicode):
+        return string
+    return string.decode('utf-8', 'replace')
+
+
+def _pack_string(string):
+    data = _text(string).encode('utf-8')
+    return _LEN.pack(len(data)) + data
+
+
+def _point_value(val):
+    """
+    :return: The (type, float value) of a perf data value.
+    """
+    if isinstance(val, list):
+        # the first point of a perf data holds the read values
+        val = val[0] if val else 0
+    if isinstance(val, (int, long)):
+        try:
+            return _INT, float(val)
+        except OverflowError:
+            # restored as a float
+            return _FLOAT, to_float(val)
+    return _FLOAT, float(val)
+
+
+def dump_elements(elements):
+    """
+    Take a consistent copy of the elements, to be done with the elements lock held.
+    The perf data points lists are replaced (not modified) by the elements,
+    so a shallow copy is enough and it's cheap.
+    :param elements: The carbon elements table {name: Element}.
+    :return: The dump to be given to `write_snapshot()´.
+    """
+    return [(name, elem.last_sent, elem.host_name, elem.sdesc, elem.perf_datas.copy(),
+             elem.summary and dict((mname, elem.summary.cell_fields(mname))
+                                   for mname in elem.summary.cells))
+            for name, elem in elements.iteritems()]
+
+
+def _serialize(dump):
+    """
+    :return: A 3-tuple (records, names, offsets) of the dumped elements,
+             the elements which can't be serialized are skipped.
+    """
+    records = []
+    names = []
+    offsets = []
+    offset = _HEADER.size
+    point_pack = _POINT.pack
+    len_pack = _LEN.pack
+    for name, last_sent, host_name, sdesc, perf_datas, summary in dump:
+        try:
+            chunks = [_ELEMENT.pack(last_sent, len(perf_datas)),
+                      _pack_string(host_name),
+                      _pack_string(sdesc)]
+            for mname, met_pts in perf_datas.iteritems():
+                key, instance = (summary or {}).get(mname, None) or ('', '')
+                mname = _text(mname).encode('utf-8')
+                chunks.extend((len_pack(len(mname)), mname,
+                               _pack_string(key), _pack_string(instance),
+                               len_pack(len(met_pts))))
+                for met_pt in met_pts:
+                    val = met_pt.val
+                    if val.__class__ is float:
+                        chunks.append(point_pack(_FLOAT, val, met_pt.time, met_pt.here_time))
+                    else:
+                        val_type, val = _point_value(val)
+                        chunks.append(point_pack(val_type, val, met_pt.time, met_pt.here_time))
+        except (struct.error, OverflowError, TypeError, ValueError):
+            continue
+        record = ''.join(chunks)
+        names.append(_text(name))
+        offsets.append(offset)
+        offset += len(record)
+        records.append(record)
+    return records, names, offsets
+
+
+def write_snapshot(path, dump, now=None):
+    """
+    Write a snapshot of the elements table, atomically.
+    :param path: The snapshot file path.
+    :param dump: The elements dumped by `dump_elements()´.
+    :param now: The snapshot time.
+    :return: The number of elements written, the ones which can't be serialized are skipped.
+    """
+    if now is None:
+        now = time.time()
+    records, names, offsets = _serialize(dump)
+    index_offset = _HEADER.size + sum(len(record) for record in records)
+    names_blob = u'\n'.join(names).encode('utf-8')
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as snapshot:
+        snapshot.write(_HEADER.pack(MAGIC, VERSION, now, len(names), index_offset))
+        snapshot.writelines(records)
+        snapshot.write(_COUNT.pack(len(names_blob)))
+        snapshot.write(names_blob)
+        snapshot.write(struct.pack('<%dQ' % len(offsets), *offsets))
+    os.rename(tmp_path, path)
+    return len(names)
+
+
+class SnapshotReader(object):
+    """
+    Lazy reader of a snapshot file.
+    Only the index is read at opening, an element record is decoded by `pop()´.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: The snapshot file path.
+        :raise SnapshotError: If the file is not a valid snapshot.
+        """
+        self.path = path
+        self._index = {}
+        self._map = None
+        self._file = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, mmap.error) as err:
+            self._file.close()
+            raise SnapshotError('Invalid snapshot %s: %s' % (path, err))
+
+        data = self._map
+        try:
+            magic, version, self.time, count, index_offset = _HEADER.unpack_from(data, 0)
+        except struct.error as err:
+            self.close()
+            raise SnapshotError('Invalid snapshot %s: %s' % (path, err))
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise SnapshotError('Invalid snapshot %s: bad magic or version' % path)
+
+        try:
+            blob_len, = _COUNT.unpack_from(data, index_offset)
+            start = index_offset + _COUNT.size
+            names = data[start:start + blob_len].decode('utf-8').split(u'\n') if count else []
+            offsets = struct.unpack_from('<%dQ' % count, data, start + blob_len)
+        except (struct.error, UnicodeDecodeError) as err:
+            self.close()
+            raise SnapshotError('Invalid snapshot %s index: %s' % (path, err))
+        if len(names) != count:
+            self.close()
+            raise SnapshotError('Invalid snapshot %s index: %d names for %d elements' % (
+                path, len(names), count))
+        self._index = dict(zip(names, offsets))
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, name):
+        return name in self._index
+
+    def pop(self, name):
+        """
+        Decode the record of an element and remove it from the snapshot.
+        :param name: The element name.
+        :return: None if the element is not in the snapshot, otherwise a 4-tuple
+                 (host_name, sdesc, last_sent, perf_datas) where perf_datas is a list
+                 of (metric_name, [(value, time, here_time), ...], summary) and summary
+                 the (type, plugin instance) of the metric, or None.
+        :raise SnapshotError: If the record is truncated or corrupt.
+        """
+        offset = self._index.pop(name, None)
+        if offset is None:
+            return None
+        try:
+            return self._read_record(offset)
+        except (struct.error, UnicodeDecodeError) as err:
+            raise SnapshotError('Invalid snapshot %s record of %s: %s' % (self.path, name, err))
+
+    def _read_record(self, offset):
+        data = self._map
+
+        last_sent, n_metrics = _ELEMENT.unpack_from(data, offset)
+        offset += _ELEMENT.size
+        host_name, offset = self._read_string(offset)
+        sdesc, offset = self._read_string(offset)
+        perf_datas = []
+        for _ in xrange(n_metrics):
+            mname, offset = self._read_string(offset)
+            key, offset = self._read_string(offset)
+            instance, offset = self._read_string(offset)
+            n_points, = _LEN.unpack_from(data, offset)
+            offset += _LEN.size
+            points = []
+            for _ in xrange(n_points):
+                val_type, val, mtime, here_time = _POINT.unpack_from(data, offset)
+                offset += _POINT.size
+                points.append((int(val) if val_type == _INT else val, mtime, here_time))
+            perf_datas.append((mname, points, (key, instance) if key else None))
+        return host_name, sdesc, last_sent, perf_datas
+
+    def _read_string(self, offset):
+        length, = _LEN.unpack_from(self._map, offset)
+        offset += _LEN.size
+        if offset + length > len(self._map):
+            raise struct.error('string beyond the end of the file')
+        return self._map[offset:offset + length].decode('utf-8'), offset + length
+
+    def close(self):
+        self._index = {}
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
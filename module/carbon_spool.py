@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+Disk spool for the external commands.
+
+When the queue to the daemon is saturated (or unavailable), the commands are
+appended to segment files in the spool directory instead of blocking the
+module. They are replayed, in order, once the queue drains; commands older
+than the max age are dropped, and the oldest segments are dropped when the
+spool exceeds its max size (checked on every append: a batch which doesn't
+fit starts a new segment, a batch larger than the max size keeps its newest
+commands).
+
+Each line of a segment is: <spool time> <command>
+"""
+
+import os
+import time
+
+#############################################################################
+
+DEFAULT_MAX_SIZE = 100 * 1024 * 1024
+"""Default max size (in bytes) of the spool"""
+
+DEFAULT_MAX_AGE = 600
+"""Default max age (in s) of a spooled command"""
+
+DEFAULT_SEGMENT_SIZE = 4 * 1024 * 1024
+"""Default size (in bytes) of a segment file"""
+
+_PREFIX = 'spool.'
+
+
+#############################################################################
+
+
+class CommandSpool(object):
+    """
+    Append-only, segment based, spool of commands.
+    """
+
+    def __init__(self, directory, max_size=DEFAULT_MAX_SIZE, max_age=DEFAULT_MAX_AGE,
+                 segment_size=DEFAULT_SEGMENT_SIZE):
+        """
+        :param directory: The spool directory, created if needed.
+        :param max_size: The max size (in bytes) of all the segments.
+        :param max_age: The max age (in s) of a command to be replayed.
+        :param segment_size: The size (in bytes) after which a new segment is started.
+        """
+        self.directory = directory
+        self.max_size = max_size
+        self.max_age = max_age
+        self.segment_size = segment_size
+
+        self.n_spooled = 0
+        self.n_replayed = 0
+        self.n_expired = 0
+        self.n_dropped_segments = 0
+        self.n_dropped = 0
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        # segments left by a previous run are replayed too
+        self._segments = sorted(int(name[len(_PREFIX):]) for name in os.listdir(directory)
+                                if name.startswith(_PREFIX) and name[len(_PREFIX):].isdigit())
+        self._sizes = dict((seq, os.path.getsize(self._path(seq))) for seq in self._segments)
+        self._writer = None
+        self._writer_seq = None
+        self._reader = None
+        self._reader_seq = None
+
+    def _path(self, seq):
+        return os.path.join(self.directory, '%s%012d' % (_PREFIX, seq))
+
+    @property
+    def pending(self):
+        """
+        :return: True if some commands are waiting in the spool.
+        """
+        return bool(self._segments)
+
+    @property
+    def size(self):
+        """
+        :return: The size (in bytes) of the spool.
+        """
+        return sum(self._sizes.itervalues())
+
+    def extend(self, commands, now=None):
+        """
+        Append commands to the spool.
+        :param commands: A list of commands.
+        """
+        if not commands:
+            return
+        if now is None:
+            now = time.time()
+        lines = ['%d %s\n' % (now, cmd) for cmd in commands]
+        data_size = sum(len(line) for line in lines)
+        while lines and data_size > self.max_size:
+            # larger than the whole spool: the oldest commands are dropped
+            data_size -= len(lines.pop(0))
+            self.n_dropped += 1
+        if not lines:
+            return
+        if self._writer is None or self._sizes[self._writer_seq] >= self.segment_size or \
+                self.size + data_size > self.max_size:
+            # a new segment, the previous ones can then be dropped to make room
+            self._new_segment()
+        self._writer.write(''.join(lines))
+        self._writer.flush()
+        self._sizes[self._writer_seq] += data_size
+        self.n_spooled += len(lines)
+
+        while self.size > self.max_size and len(self._segments) > 1:
+            self._drop_segment(self._segments[0])
+            self.n_dropped_segments += 1
+
+    def _new_segment(self):
+        if self._writer is not None:
+            self._writer.close()
+        seq = self._segments[-1] + 1 if self._segments else 0
+        self._writer = open(self._path(seq), 'ab')
+        self._writer_seq = seq
+        self._segments.append(seq)
+        self._sizes[seq] = 0
+
+    def _drop_segment(self, seq):
+        if seq == self._reader_seq:
+            self._reader.close()
+            self._reader = self._reader_seq = None
+        if seq == self._writer_seq:
+            self._writer.close()
+            self._writer = self._writer_seq = None
+        self._segments.remove(seq)
+        del self._sizes[seq]
+        os.remove(self._path(seq))
+
+    def replay(self, put, now=None):
+        """
+        Replay the spooled commands, in order, until `put´ refuses one.
+        :param put: A function sending a command, returning False if it can't.
+        :return: The number of commands replayed.
+        """
+        if now is None:
+            now = time.time()
+        min_time = now - self.max_age
+        n_replayed = 0
+        while self._segments:
+            seq = self._segments[0]
+            if self._reader_seq != seq:
+                if seq == self._writer_seq:
+                    self._writer.flush()
+                self._reader = open(self._path(seq), 'rb')
+                self._reader_seq = seq
+            reader = self._reader
+            while True:
+                pos = reader.tell()
+                line = reader.readline()
+                if not line.endswith('\n'):
+                    # end of the segment (or a partial line being written)
+                    reader.seek(pos)
+                    break
+                spool_time, _, cmd = line[:-1].partition(' ')
+                if int(spool_time) < min_time:
+                    self.n_expired += 1
+                    continue
+                if not put(cmd):
+                    reader.seek(pos)
+                    self.n_replayed += n_replayed
+                    return n_replayed
+                n_replayed += 1
+            if seq == self._writer_seq:
+                # everything has been replayed, the current segment is restarted
+                self._writer.close()
+                self._writer = self._writer_seq = None
+            self._drop_segment(seq)
+        self.n_replayed += n_replayed
+        return n_replayed
+
+    def stats(self):
+        return ('%d spooled, %d replayed, %d expired, %d dropped segments, %d dropped, '
+                '%d bytes pending' % (self.n_spooled, self.n_replayed, self.n_expired,
+                                      self.n_dropped_segments, self.n_dropped, self.size))
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = self._writer_seq = None
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = self._reader_seq = None
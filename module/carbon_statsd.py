@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+StatsD protocol: the samples received on the StatsD listener are aggregated
+in memory, and the aggregates are flushed every flush interval as carbon
+points (4-tuples), interpreted like the decoded plaintext lines.
+
+A line is name:value|type[|@sample_rate], with several value|type
+separated by ':' and several lines per datagram. The types are:
+- c (counter): the sum of the values (divided by the sample rate),
+  flushed as name (count in the interval) and name_rate (per second);
+- g (gauge): the last value, +value or -value changes the previous one,
+  flushed as name;
+- s (set): the distinct values, flushed as name (their number);
+- ms or h (timer): flushed as name_count, name_mean, name_min, name_max
+  and name_pNN for each percentile (nearest rank).
+A metric is flushed only if it was updated during the interval. The
+DogStatsD tags (|#tag:value) are ignored.
+
+The lines are validated like the plaintext ones, without raising: the names
+are decoded (and cached), the invalid lines are counted in `bad_lines´ and
+skipped, and the peer rate limiter applies.
+"""
+
+import dummy_threading
+from math import ceil
+from time import time
+
+from .carbon_parser import decode_metric_name, parse_number
+from .carbon_badlines import (
+    bad_lines, MAX_LINE_LENGTH, TOO_FEW_FIELDS, NON_NUMERIC_VALUE, OVERSIZE_LINE,
+    INVALID_NAME, UNSUPPORTED_TYPE,
+)
+
+#############################################################################
+
+DEFAULT_PORT = 8125
+"""Default port of the StatsD listener"""
+
+DEFAULT_PERCENTILES = '90'
+"""Default percentiles of the timers"""
+
+_COUNTER = 'c'
+_GAUGE = 'g'
+_SET = 's'
+_TIMERS = ('ms', 'h')
+_NAME_CACHE_SIZE = 100000
+
+
+#############################################################################
+
+
+def parse_percentiles(spec):
+    """
+    :param spec: A '90, 99.9' string.
+    :return: A list of (suffix, fraction), e.g. [('p90', 0.9), ('p99_9', 0.999)].
+    """
+    res = []
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        pct = float(item)
+        if not 0 < pct <= 100:
+            raise ValueError('Invalid percentile %r' % item)
+        res.append(('p' + item.replace('.', '_'), pct / 100))
+    return res
+
+
+class StatsdAggregator(object):
+    """
+    Aggregates of the StatsD samples of the current flush interval.
+    """
+
+    def __init__(self, percentiles=None, lock=None):
+        """
+        :param percentiles: The percentiles of the timers, see parse_percentiles.
+        :param lock: Protects the aggregates when they are flushed by another thread.
+        """
+        self.percentiles = percentiles if percentiles is not None else \
+            parse_percentiles(DEFAULT_PERCENTILES)
+        self.lock = lock or dummy_threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.sets = {}
+        self.timers = {}
+        # the gauges of the previous interval, the base of the relative changes
+        self._old_gauges = {}
+        self._names = {}
+        self.n_samples = 0
+        self.n_bad_lines = 0
+
+    def add_line(self, line):
+        """
+        Aggregate the samples of a line.
+        :return: None, or the bad_lines category of an invalid line (its previous
+                 samples are aggregated).
+        """
+        if len(line) > MAX_LINE_LENGTH:
+            return OVERSIZE_LINE
+        raw_name, sep, samples = line.partition(':')
+        if not (raw_name and sep):
+            return TOO_FEW_FIELDS
+        names = self._names
+        name = names.get(raw_name, None)
+        if name is None:
+            decoded = decode_metric_name(raw_name)
+            # the graphite tags aren't supported
+            if decoded is None or decoded[1] is not None:
+                return INVALID_NAME
+            if len(names) >= _NAME_CACHE_SIZE:
+                names.clear()
+            name = names[raw_name] = decoded[0]
+        for sample in samples.split(':'):
+            fields = sample.split('|')
+            if len(fields) < 2:
+                return TOO_FEW_FIELDS
+            value, mtype = fields[0], fields[1]
+            rate = 1.0
+            for field in fields[2:]:
+                if field[:1] == '@':
+                    rate = parse_number(field[1:])
+                    if rate is None or not 0 < rate <= 1:
+                        return NON_NUMERIC_VALUE
+            if mtype == _SET:
+                self.sets.setdefault(name, set()).add(value)
+                self.n_samples += 1
+                continue
+            number = parse_number(value)
+            if number is None:
+                return NON_NUMERIC_VALUE
+            if mtype == _COUNTER:
+                if rate != 1.0:
+                    number /= rate
+                self.counters[name] = self.counters.get(name, 0) + number
+            elif mtype == _GAUGE:
+                if value[0] in '+-':
+                    base = self.gauges.get(name, None)
+                    if base is None:
+                        base = self._old_gauges.get(name, 0)
+                    number += base
+                self.gauges[name] = number
+            elif mtype in _TIMERS:
+                timer = self.timers.get(name, None)
+                if timer is None:
+                    timer = self.timers[name] = [[], 0]
+                timer[0].append(number)
+                timer[1] += 1 if rate == 1.0 else 1 / rate
+            else:
+                return UNSUPPORTED_TYPE
+            self.n_samples += 1
+        return None
+
+    def add_packet(self, data, length, limiter=None, source=None):
+        """
+        Aggregate the lines of a received datagram, the invalid ones are counted and skipped.
+        :param data: A bytearray.
+        :param length: The number of bytes received in it.
+        :param limiter: An optional RateLimiter, the throttled lines of `source´ are skipped.
+        :param source: The peer address the datagram was received from.
+        """
+        add_line = self.add_line
+        bad = bad_lines.add
+        now = time()
+        with self.lock:
+            for line in memoryview(data)[:length].tobytes().splitlines():
+                if not line:
+                    continue
+                if limiter is not None and not limiter.allow(source, now):
+                    continue
+                category = add_line(line)
+                if category is not None:
+                    self.n_bad_lines += 1
+                    bad(category, source, line)
+
+    def flush(self, now, interval):
+        """
+        Reset the aggregates of the interval.
+        :param now: The time of the flushed points.
+        :param interval: The time (in s) since the previous flush.
+        :return: The list of the flushed 4-tuples (name, value, timestamp, tags).
+        """
+        with self.lock:
+            counters, self.counters = self.counters, {}
+            gauges, self.gauges = self.gauges, {}
+            sets, self.sets = self.sets, {}
+            timers, self.timers = self.timers, {}
+            self._old_gauges = gauges
+
+        res = []
+        for name, count in counters.iteritems():
+            res.append((name, count, now, None))
+            res.append((name + '_rate', float(count) / interval, now, None))
+        for name, value in gauges.iteritems():
+            res.append((name, value, now, None))
+        for name, values in sets.iteritems():
+            res.append((name, len(values), now, None))
+        for name, (values, count) in timers.iteritems():
+            values.sort()
+            n_values = len(values)
+            res.append((name + '_count', count, now, None))
+            res.append((name + '_mean', float(sum(values)) / n_values, now, None))
+            res.append((name + '_min', values[0], now, None))
+            res.append((name + '_max', values[-1], now, None))
+            for suffix, fraction in self.percentiles:
+                rank = int(ceil(fraction * n_values)) - 1
+                res.append(('%s_%s' % (name, suffix), values[max(rank, 0)], now, None))
+        return res
+
+    def stats(self):
+        """
+        :return: The samples and bad lines counters since the last call, as a string.
+        """
+        n_samples, self.n_samples = self.n_samples, 0
+        n_bad_lines, self.n_bad_lines = self.n_bad_lines, 0
+        return '%d samples, %d bad lines' % (n_samples, n_bad_lines)
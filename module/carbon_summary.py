@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+Summary of the grouped plugins with many instances (e.g. the cpu plugin of a
+128 cores host): the last values of an element are kept in a matrix, a row
+per type (type[-type_instance]) and a column per plugin instance, and the
+aggregates of each row across the instances (sum, mean, max and p95) are
+computed at emission time.
+
+The aggregates are vectorised with NumPy when it's installed, otherwise
+they are computed row by row on the array. A missing value is a NaN.
+
+When the last cell of a row (or column) is removed, the row (or column) is
+freed and reused by the next new type (or plugin instance): the matrix is
+bounded by the types and instances alive at the same time, even when the
+instance names churn.
+"""
+
+from array import array
+from math import ceil
+
+from .carbon_parser import to_float
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+#############################################################################
+
+AGGREGATES = ('sum', 'mean', 'max', 'p95')
+"""The aggregates of a row, suffixes of the summary metric names"""
+
+_PERCENTILE = 0.95
+_NAN = float('nan')
+
+
+#############################################################################
+
+
+class InstanceMatrix(object):
+    """
+    The last values of the metrics of an element, by type and plugin instance.
+    """
+
+    def __init__(self):
+        self.rows = {}  # type -> row
+        self.cols = {}  # plugin instance -> col
+        self.cells = {}  # metric name -> (row, col)
+        self.keys = []  # row -> type, None if the row is free
+        self.instances = []  # col -> plugin instance, None if the column is free
+        self.row_cells = []  # row -> number of cells
+        self.col_cells = []  # col -> number of cells
+        self._free_rows = []
+        self._free_cols = []
+        self.width = 0
+        self.values = array('d')
+
+    def __len__(self):
+        return len(self.cells)
+
+    def __contains__(self, mname):
+        return mname in self.cells
+
+    def _add_cell(self, mname, key, instance):
+        row = self.rows.get(key, None)
+        if row is None:
+            if self._free_rows:
+                row = self._free_rows.pop()
+                self.keys[row] = key
+            else:
+                row = len(self.keys)
+                self.keys.append(key)
+                self.row_cells.append(0)
+                self.values.extend([_NAN] * self.width)
+            self.rows[key] = row
+        col = self.cols.get(instance, None)
+        if col is None:
+            if self._free_cols:
+                col = self._free_cols.pop()
+                self.instances[col] = instance
+            else:
+                # a new column: the rows are copied once, with a NaN at their end
+                col = self.width
+                values = array('d')
+                for idx in range(len(self.keys)):
+                    values.extend(self.values[idx * self.width:(idx + 1) * self.width])
+                    values.append(_NAN)
+                self.values = values
+                self.width += 1
+                self.instances.append(instance)
+                self.col_cells.append(0)
+            self.cols[instance] = col
+        self.row_cells[row] += 1
+        self.col_cells[col] += 1
+        cell = self.cells[mname] = (row, col)
+        return cell
+
+    def set(self, mname, key, instance, value):
+        """
+        :param mname: The metric name.
+        :param key: Its type[-type_instance].
+        :param instance: Its plugin instance.
+        :param value: Its last value.
+        """
+        cell = self.cells.get(mname, None)
+        if cell is None:
+            cell = self._add_cell(mname, key, instance)
+        try:
+            self.values[cell[0] * self.width + cell[1]] = value
+        except OverflowError:
+            # a long out of the float range
+            self.values[cell[0] * self.width + cell[1]] = to_float(value)
+
+    def cell_fields(self, mname):
+        """
+        :return: The (type, plugin instance) of a metric, or None if it's not in the matrix.
+        """
+        cell = self.cells.get(mname, None)
+        if cell is None:
+            return None
+        return self.keys[cell[0]], self.instances[cell[1]]
+
+    def remove(self, mname):
+        cell = self.cells.pop(mname, None)
+        if cell is None:
+            return
+        row, col = cell
+        # the free cells are NaNs, ready to be reused
+        self.values[row * self.width + col] = _NAN
+        self.row_cells[row] -= 1
+        if not self.row_cells[row]:
+            del self.rows[self.keys[row]]
+            self.keys[row] = None
+            self._free_rows.append(row)
+        self.col_cells[col] -= 1
+        if not self.col_cells[col]:
+            del self.cols[self.instances[col]]
+            self.instances[col] = None
+            self._free_cols.append(col)
+
+    def aggregates(self):
+        """
+        :return: A list of (type, [sum, mean, max, p95]) for the types with values.
+        """
+        if not self.width:
+            return []
+        if numpy is not None:
+            return self._aggregates_numpy()
+        res = []
+        width = self.width
+        for row, key in enumerate(self.keys):
+            values = sorted(value for value in self.values[row * width:(row + 1) * width]
+                            if value == value)
+            if not values:
+                continue
+            total = sum(values)
+            res.append((key, [total, total / len(values), values[-1],
+                              values[int(ceil(_PERCENTILE * len(values))) - 1]]))
+        return res
+
+    def _aggregates_numpy(self):
+        matrix = numpy.frombuffer(self.values, dtype=numpy.float64).reshape(
+            len(self.keys), self.width)
+        missing = numpy.isnan(matrix)
+        counts = self.width - missing.sum(axis=1)
+        totals = numpy.where(missing, 0.0, matrix).sum(axis=1)
+        # the NaNs are sorted last: the values of a row are its first counts cells
+        ordered = numpy.sort(matrix, axis=1)
+        rows = numpy.arange(len(self.keys))
+        maxs = ordered[rows, numpy.maximum(counts - 1, 0)]
+        p95s = ordered[rows, numpy.maximum(numpy.ceil(_PERCENTILE * counts).astype(int) - 1, 0)]
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            means = totals / counts
+        return [(key, [float(totals[row]), float(means[row]), float(maxs[row]),
+                       float(p95s[row])])
+                for row, key in enumerate(self.keys) if counts[row]]
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""
+Graphite tagged series support.
+
+A tagged series is sent as ``name;tag1=value1;tag2=value2 value timestamp``
+(see http://graphite.readthedocs.io/en/latest/tags.html).
+
+The same few tag sets are sent over and over, so the tag keys and values
+are interned (in the shared names intern pool) and each tag set is
+canonicalised (sorted, deduplicated) in a shared immutable TagSet instance.
+"""
+
+from .carbon_intern import intern_pool
+
+#############################################################################
+
+DEFAULT_TAGS_MAPPING = {
+    'host': 'host',
+    'plugin': 'plugin',
+    'plugininstance': 'plugin_instance',
+    'type': 'name',
+    'typeinstance': 'type_instance',
+}
+"""Default mapping from the carbon Data fields to the tags, 'name' is the series name"""
+
+DEFAULT_CACHE_SIZE = 100000
+"""Max number of raw tag strings (and mapped series) kept in cache"""
+
+_FIELD_ALIASES = {
+    'host': 'host',
+    'plugin': 'plugin',
+    'plugin_instance': 'plugininstance',
+    'plugininstance': 'plugininstance',
+    'type': 'type',
+    'type_instance': 'typeinstance',
+    'typeinstance': 'typeinstance',
+}
+
+# order of the fields in a mapping result, same as the carbon Data attributes
+_FIELDS = ('host', 'plugin', 'plugininstance', 'type', 'typeinstance')
+
+
+#############################################################################
+
+
+class TagSet(tuple):
+    """
+    An immutable, canonical set of tags: a sorted tuple of (key, value) pairs.
+    Always get them with `make_tagset()´ so equal tag sets are the same object.
+    """
+
+    __slots__ = ()
+
+    def get(self, key, default=None):
+        for tag_key, tag_value in self:
+            if tag_key == key:
+                return tag_value
+        return default
+
+    def __str__(self):
+        return ';'.join('%s=%s' % tag for tag in self)
+
+    # A TagSet is shared: never copy it (Values instances are deep copied).
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+class TagPool(object):
+    """
+    Intern pool for the tag sets, the tag strings are in the names intern pool.
+    """
+
+    def __init__(self, cache_size=DEFAULT_CACHE_SIZE, strings=intern_pool):
+        self.cache_size = cache_size
+        self.intern = strings.intern
+        self._tagsets = {}
+        self._raw = {}
+        self._old_raw = {}
+
+    def __len__(self):
+        return len(self._tagsets)
+
+    def make_tagset(self, pairs):
+        """
+        :param pairs: An iterable of (key, value), the last value of a key wins.
+        :return: The shared TagSet instance.
+        """
+        intern = self.intern
+        key = tuple(sorted((intern(k), intern(v)) for k, v in dict(pairs).iteritems()))
+        tagset = self._tagsets.get(key)
+        if tagset is None:
+            if len(self._tagsets) >= self.cache_size:
+                self.clear()
+            tagset = self._tagsets[key] = TagSet(key)
+        return tagset
+
+    def parse(self, raw):
+        """
+        :param raw: The tags part of a tagged series, e.g. 'tag1=v1;tag2=v2'.
+        :return: The shared TagSet instance, or None if the tags are malformed.
+        """
+        tagset = self._raw.get(raw)
+        if tagset is None:
+            tagset = self._old_raw.pop(raw, None)
+            if tagset is None:
+                pairs = []
+                for tag in raw.split(';'):
+                    key, sep, value = tag.partition('=')
+                    if not (key and sep and value):
+                        return None
+                    pairs.append((key, value))
+                tagset = self.make_tagset(pairs)
+            if len(self._raw) >= self.cache_size:
+                self._raw.clear()
+            self._raw[raw] = tagset
+        return tagset
+
+    def clear(self):
+        self._tagsets.clear()
+        self._raw.clear()
+        self._old_raw.clear()
+
+    def age(self):
+        """
+        Age the caches: the tags not parsed since the previous call are dropped.
+        """
+        self._old_raw = self._raw
+        self._raw = {}
+        self._tagsets = dict((tagset, tagset) for tagset in self._old_raw.itervalues())
+
+
+tag_pool = TagPool()
+"""The module-level pool used by the decoder"""
+
+
+def parse_tagged_name(metric_name, pool=tag_pool):
+    """
+    :param metric_name: A tagged series name, e.g. 'name;tag1=v1;tag2=v2'.
+    :return: A 2-tuple (name, TagSet) or None if the tags are malformed.
+    """
+    name, _, raw = metric_name.partition(';')
+    if not name:
+        return None
+    tagset = pool.parse(raw)
+    if tagset is None:
+        return None
+    return pool.intern(name), tagset
+
+
+class TagMapper(object):
+    """
+    Map a tagged series on the carbon Data fields (host, plugin, ...).
+    """
+
+    def __init__(self, mapping=None, cache_size=DEFAULT_CACHE_SIZE):
+        """
+        :param mapping: A dict {field: tag}, 'name' stands for the series name.
+                        Missing fields get their default tag.
+        :param cache_size: The max number of mapped series kept in cache.
+        """
+        tags = dict(DEFAULT_TAGS_MAPPING)
+        for field, tag in (mapping or {}).iteritems():
+            if field not in _FIELD_ALIASES:
+                raise ValueError('Unknown field %r in tags mapping' % field)
+            tags[_FIELD_ALIASES[field]] = tag
+        self.mapping = tags
+        self._tags = tuple(tags[field] for field in _FIELDS)
+        self.cache_size = cache_size
+        self._cache = {}
+        self._old = {}
+
+    def match(self, name, tagset):
+        """
+        :param name: The series name.
+        :param tagset: The series TagSet.
+        :return: A 5-tuple (host, plugin, plugininstance, type, typeinstance)
+                 or None if the host, plugin or type tag is missing.
+        """
+        key = (name, tagset)
+        res = self._cache.get(key)
+        if res is None:
+            res = self._old.pop(key, None)
+            if res is None:
+                tags = dict(tagset)
+                tags['name'] = name
+                res = tuple(tags.get(tag) for tag in self._tags)
+                if res[0] is None or res[1] is None or res[3] is None:
+                    return None
+            if len(self._cache) >= self.cache_size:
+                self._cache.clear()
+            self._cache[key] = res
+        return res
+
+    def age(self):
+        """
+        Age the cache: the series not mapped since the previous call are dropped.
+        """
+        self._old = self._cache
+        self._cache = {}
+
+
+def parse_tags_mapping(spec):
+    """
+    :param spec: A 'field=tag, field=tag' string.
+    :return: The {field: tag} dict.
+    """
+    mapping = {}
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        field, sep, tag = item.partition('=')
+        if not sep:
+            raise ValueError('Invalid tags mapping %r' % item)
+        mapping[field.strip()] = tag.strip()
+    return mapping
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+"""
+Graphite-style metric path templates.
+
+A template maps the dot-separated components of a metric path on the
+collectd naming schema fields used by this module (host, plugin,
+plugin_instance, type, type_instance).
+
+A template is written as ``[filter ]template``, e.g.::
+
+    host.plugin.type                      (the collectd default)
+    host.host.host.plugin.type*           (FQDN host names)
+    servers.* .host.plugin.type*          (Diamond, only for servers.*)
+
+- The same field repeated several times is joined with a '.'.
+- A trailing '*' on the last field makes it absorb all the remaining
+  components of the path.
+- An empty field (or 'skip') drops the matching component.
+- When a template doesn't give a plugin_instance (or type_instance), the
+  plugin (or type) is split on its first '-' like collectd does.
+
+The filter is a glob matched on the first components of the path.
+"""
+
+import re
+from operator import itemgetter
+
+from .carbon_intern import intern_pool
+
+#############################################################################
+
+DEFAULT_TEMPLATE = 'host.plugin.type'
+"""Default template, the collectd naming schema"""
+
+DEFAULT_CACHE_SIZE = 100000
+"""Max number of metric paths kept in the match cache"""
+
+# order of the fields in a match result, same as the carbon Data attributes
+_FIELDS = ('host', 'plugin', 'plugininstance', 'type', 'typeinstance')
+
+_FIELD_ALIASES = {
+    'host': 'host',
+    'plugin': 'plugin',
+    'plugin_instance': 'plugininstance',
+    'plugininstance': 'plugininstance',
+    'type': 'type',
+    'type_instance': 'typeinstance',
+    'typeinstance': 'typeinstance',
+    'skip': None,
+    '': None,
+}
+
+
+#############################################################################
+
+
+class MetricTemplate(object):
+    """
+    A compiled metric path template.
+    """
+
+    def __init__(self, template, filter=None):
+        """
+        :param template: The template, e.g. 'host.host.plugin.type*'.
+        :param filter: An optional glob (e.g. 'servers.*') the path must start with.
+        :raise ValueError: If the template is not valid.
+        """
+        self.template = template
+        self.filter = filter
+        self.filter_prefix = None
+        self._filter_re = None
+        if filter:
+            first = filter.split('.', 1)[0]
+            if '*' not in first and '?' not in first:
+                self.filter_prefix = first
+            self._filter_re = re.compile(_glob_to_regex(filter))
+
+        indexes = dict((field, []) for field in _FIELDS)
+        self.greedy = None
+        parts = template.split('.')
+        for idx, part in enumerate(parts):
+            if part.endswith('*'):
+                if idx != len(parts) - 1:
+                    raise ValueError("'*' is only allowed on the last field of %r" % template)
+                part = part[:-1]
+                self.greedy = idx
+            if part not in _FIELD_ALIASES:
+                raise ValueError('Unknown field %r in metric template %r' % (part, template))
+            field = _FIELD_ALIASES[part]
+            if field is not None:
+                indexes[field].append(idx)
+        for field in ('host', 'plugin', 'type'):
+            if not indexes[field]:
+                raise ValueError('Metric template %r has no %s field' % (template, field))
+
+        self.depth = len(parts)
+        self.split_plugin = not indexes['plugininstance']
+        self.split_type = not indexes['typeinstance']
+        self._getters = tuple(indexes[field] for field in _FIELDS)
+
+        # Fast path: every field is at most one component, the whole match is
+        # then a single itemgetter call on the split path (with a trailing None
+        # for the missing fields).
+        self._fast = None
+        if self.greedy is None and all(len(idx) <= 1 for idx in self._getters):
+            self._fast = itemgetter(*[idx[0] if idx else -1 for idx in self._getters])
+
+    def __repr__(self):
+        if self.filter:
+            return '<MetricTemplate %s %s>' % (self.filter, self.template)
+        return '<MetricTemplate %s>' % self.template
+
+    def match_filter(self, path):
+        """
+        :return: True if the metric path is accepted by the template filter.
+        """
+        return self._filter_re is None or self._filter_re.match(path) is not None
+
+    def match(self, parts):
+        """
+        :param parts: The metric path split on '.'.
+        :return: A 5-tuple (host, plugin, plugininstance, type, typeinstance)
+                 or None if the path doesn't have the template depth.
+        """
+        nparts = len(parts)
+        if self.greedy is None:
+            if nparts != self.depth:
+                return None
+        elif nparts < self.depth:
+            return None
+
+        if self._fast is not None:
+            parts.append(None)
+            host, plugin, plugin_instance, type_, type_instance = self._fast(parts)
+        else:
+            greedy = self.greedy
+            res = []
+            for idx in self._getters:
+                if not idx:
+                    res.append(None)
+                elif idx[-1] == greedy:
+                    res.append('.'.join([parts[i] for i in idx[:-1]] + parts[greedy:]))
+                elif len(idx) == 1:
+                    res.append(parts[idx[0]])
+                else:
+                    res.append('.'.join([parts[i] for i in idx]))
+            host, plugin, plugin_instance, type_, type_instance = res
+
+        if self.split_plugin and plugin and '-' in plugin:
+            plugin, plugin_instance = plugin.split('-', 1)
+        if self.split_type and type_ and '-' in type_:
+            type_, type_instance = type_.split('-', 1)
+        return host, plugin, plugin_instance, type_, type_instance
+
+
+class PathMatcher(object):
+    """
+    Choose the template to apply to a metric path and cache the results.
+    Templates with a filter are tried in their declaration order,
+    the first template without filter is the default one.
+    """
+
+    def __init__(self, templates=None, cache_size=DEFAULT_CACHE_SIZE):
+        """
+        :param templates: A list of '[filter ]template' strings.
+        :param cache_size: The max number of metric paths kept in cache.
+        """
+        self._by_prefix = {}
+        self._wildcard = []
+        self.default = None
+        self.cache_size = cache_size
+        self._cache = {}
+        self._old = {}
+
+        for spec in templates or []:
+            template = parse_template(spec)
+            if template.filter is None:
+                if self.default is None:
+                    self.default = template
+            elif template.filter_prefix is not None:
+                self._by_prefix.setdefault(template.filter_prefix, []).append(template)
+            else:
+                self._wildcard.append(template)
+        if self.default is None:
+            self.default = MetricTemplate(DEFAULT_TEMPLATE)
+
+    def _match(self, path):
+        parts = path.split('.')
+        for template in self._by_prefix.get(parts[0], ()):
+            if template.match_filter(path):
+                res = template.match(parts[:])
+                if res is not None:
+                    return res
+        for template in self._wildcard:
+            if template.match_filter(path):
+                res = template.match(parts[:])
+                if res is not None:
+                    return res
+        return self.default.match(parts)
+
+    def match(self, path):
+        """
+        :param path: A metric path.
+        :return: A 5-tuple (host, plugin, plugininstance, type, typeinstance)
+                 or None if no template matches the path.
+        """
+        cache = self._cache
+        res = cache.get(path)
+        if res is None:
+            res = self._old.pop(path, None)
+            if res is None:
+                res = self._match(path)
+                if res is None:
+                    return None
+                intern = intern_pool.intern
+                res = tuple(field if field is None else intern(field) for field in res)
+            if len(cache) >= self.cache_size:
+                cache.clear()
+            cache[path] = res
+        return res
+
+    def age(self):
+        """
+        Age the cache: the paths not matched since the previous call are dropped.
+        """
+        self._old = self._cache
+        self._cache = {}
+
+
+def parse_template(spec):
+    """
+    :param spec: A '[filter ]template' string.
+    :return: The MetricTemplate instance.
+    """
+    elems = spec.split()
+    if len(elems) == 1:
+        return MetricTemplate(elems[0])
+    if len(elems) == 2:
+        return MetricTemplate(elems[1], filter=elems[0])
+    raise ValueError('Invalid metric template %r' % spec)
+
+
+def _glob_to_regex(pattern):
+    """
+    Convert a graphite glob ('*' and '?' don't cross '.') to a regex
+    matching the beginning of a metric path.
+    """
+    res = re.escape(pattern).replace(r'\*', '[^.]*').replace(r'\?', '[^.]')
+    return res + r'(?:\.|$)'
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+Warning and critical thresholds of the metrics, evaluated when the perfdata
+of an element is sent: the element then sends a service check result.
+
+A rule is 'pattern warn crit [min [max]]': the pattern is a glob on
+'service/metric' (e.g. 'df-*/percent_bytes-used'), warn and crit are Nagios
+ranges ('-' for none) and min, max the bounds of the perfdata. The first
+matching rule of a metric applies.
+
+A Nagios range is [@]start:end, the value alerts when it's outside of it
+(inside with '@'); start is 0 if omitted, '~' is -infinity, an omitted end
+is +infinity: '10' alerts when < 0 or > 10, '10:' when < 10, '~:10' when > 10.
+"""
+
+from fnmatch import fnmatchcase
+
+#############################################################################
+
+OK = 0
+WARNING = 1
+CRITICAL = 2
+
+STATES = ('OK', 'WARNING', 'CRITICAL')
+
+_CACHE_SIZE = 100000
+
+
+#############################################################################
+
+
+class NagiosRange(object):
+    __slots__ = ('spec', 'start', 'end', 'inside')
+
+    def __init__(self, spec):
+        """
+        :param spec: A Nagios range.
+        :raise ValueError: If the range is invalid.
+        """
+        self.spec = spec
+        self.inside = spec.startswith('@')
+        bounds = spec[1:] if self.inside else spec
+        start, sep, end = bounds.rpartition(':')
+        if not sep:
+            start = '0'
+        self.start = float('-inf') if start == '~' else float(start or 0)
+        self.end = float(end) if end else float('inf')
+        if self.start > self.end:
+            raise ValueError('Invalid range %r: start > end' % spec)
+
+    def alert(self, value):
+        """
+        :return: True if the value raises an alert.
+        """
+        outside = value < self.start or value > self.end
+        return not outside if self.inside else outside
+
+    def __str__(self):
+        return self.spec
+
+
+class ThresholdRule(object):
+    __slots__ = ('pattern', 'warn', 'crit', 'min', 'max')
+
+    def __init__(self, pattern, warn=None, crit=None, min=None, max=None):
+        self.pattern = pattern
+        self.warn = warn
+        self.crit = crit
+        self.min = min
+        self.max = max
+
+    def state(self, value):
+        """
+        :return: OK, WARNING or CRITICAL.
+        """
+        if self.crit is not None and self.crit.alert(value):
+            return CRITICAL
+        if self.warn is not None and self.warn.alert(value):
+            return WARNING
+        return OK
+
+    def perfdata_fields(self):
+        """
+        :return: The ';warn;crit;min;max' fields of the perfdata.
+        """
+        return (';%s;%s;%s;%s' % tuple('' if field is None else field for field in (
+            self.warn, self.crit, self.min, self.max))).rstrip(';')
+
+
+class ThresholdRules(object):
+    """
+    The threshold rules, and their cache by (service, metric).
+    """
+
+    def __init__(self, rules=None, cache_size=_CACHE_SIZE):
+        self.rules = rules or []
+        self.cache_size = cache_size
+        self._cache = {}
+
+    def __len__(self):
+        return len(self.rules)
+
+    def match(self, sdesc, mname):
+        """
+        :return: The first rule matching the metric of the service, or None.
+        """
+        key = (sdesc, mname)
+        try:
+            return self._cache[key]
+        except KeyError:
+            pass
+        path = '%s/%s' % (sdesc, mname)
+        for rule in self.rules:
+            if fnmatchcase(path, rule.pattern):
+                break
+        else:
+            rule = None
+        if len(self._cache) >= self.cache_size:
+            self._cache.clear()
+        self._cache[key] = rule
+        return rule
+
+
+def parse_thresholds(spec):
+    """
+    :param spec: A 'pattern warn crit [min [max]], ...' string.
+    :return: A list of ThresholdRule.
+    """
+    res = []
+    for item in spec.split(','):
+        elems = item.split()
+        if not elems:
+            continue
+        if not 3 <= len(elems) <= 5:
+            raise ValueError('Invalid threshold rule %r' % item.strip())
+        pattern, warn, crit = elems[:3]
+        # the min and max are kept as written in the perfdata
+        bounds = elems[3:] + [None] * (5 - len(elems))
+        for bound in elems[3:]:
+            float(bound)
+        res.append(ThresholdRule(pattern,
+                                 None if warn == '-' else NagiosRange(warn),
+                                 None if crit == '-' else NagiosRange(crit),
+                                 *bounds))
+    return res
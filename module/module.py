@@ -31,12 +31,15 @@
 Carbon client Plugin for Receiver or arbiter
 """
 
+import os
+import signal
 import threading
 import dummy_threading
 import time
 import traceback
 from itertools import izip
 from collections import namedtuple
+from Queue import Full
 
 #############################################################################
 
@@ -53,9 +56,56 @@ from .carbon_parser import (
 from .carbon_shinken_parser import (
     Data, Values, ShinkenCarbonReader
 )
+from .carbon_tags import parse_tags_mapping, tag_pool
+from .carbon_intern import intern_pool
+from .carbon_snapshot import (
+    SnapshotError, SnapshotReader, dump_elements, write_snapshot
+)
+from .carbon_spool import CommandSpool
+from .carbon_spool import DEFAULT_MAX_SIZE as DEFAULT_SPOOL_MAX_SIZE
+from .carbon_spool import DEFAULT_MAX_AGE as DEFAULT_SPOOL_MAX_AGE
+from .carbon_relay import CarbonRelay, parse_destinations
+from .carbon_relay import DEFAULT_MAX_BUFFER as DEFAULT_RELAY_MAX_BUFFER
+from .carbon_parser import Parser
+from .carbon_profiling import Profiler
+from .carbon_profiling import DEFAULT_DURATION as DEFAULT_PROFILE_DURATION
+from .carbon_cardinality import CardinalityTracker
+from .carbon_cardinality import DEFAULT_TOP as DEFAULT_CARDINALITY_TOP
+from .carbon_reorder import ReorderWindow, DROPPED, LATE
+from .carbon_ratelimit import RateLimiter, parse_rate_overrides
+from .carbon_config import read_module_config
+from .carbon_statsd import StatsdAggregator, parse_percentiles
+from .carbon_statsd import DEFAULT_PORT as DEFAULT_STATSD_PORT
+from .carbon_statsd import DEFAULT_PERCENTILES as DEFAULT_STATSD_PERCENTILES
+from .carbon_thresholds import ThresholdRules, parse_thresholds, OK, STATES
+from .carbon_liveness import HostLiveness, HOST_STATES, DOWN
+from .carbon_summary import InstanceMatrix, AGGREGATES
+from .carbon_history import History, HistoryServer
+from .carbon_history import DEFAULT_MAX_SERIES as DEFAULT_HISTORY_MAX_SERIES
+from .carbon_history import DEFAULT_HOST as DEFAULT_HISTORY_HOST
+from .carbon_events import lifecycle_log
+from .carbon_events import DEFAULT_SAMPLES as DEFAULT_LIFECYCLE_SAMPLES
+from .carbon_badlines import bad_lines
+from .carbon_badlines import DEFAULT_SAMPLES as DEFAULT_BAD_LINES_SAMPLES
 
 #############################################################################
 
+DEFAULT_SNAPSHOT_EVERY = 60
+"""Default time in second between two snapshots of the elements"""
+
+# adaptive send interval: the arrivals closer than _BATCH_GAP seconds are in the same batch,
+# the learned period is an exponential moving average of the time between two batches,
+# a partial batch is sent after _PARTIAL_TIMEOUT periods
+_BATCH_GAP = 1.0
+_PERIOD_SMOOTHING = 0.2
+_PARTIAL_TIMEOUT = 1.5
+
+CACHE_AGE_EVERY = 300
+"""Time in second between two agings of the caches"""
+
+DEFAULT_MAX_SILENCE = 300
+"""Default time in second an unchanged perfdata isn't sent, in change only mode"""
+
 properties = {
     'daemons': ['arbiter', 'receiver'],
     'type': 'carbon',
@@ -70,6 +120,36 @@ def get_instance(plugin):
     This function is called by the module manager
     to get an instance of this module
     """
+    config = parse_config(plugin)
+    udp, tcp, statsd = config['udp'], config['tcp'], config['statsd']
+
+    if udp:
+        logger.info("[Carbon] Using host=%s port=%d multicast=%d on UDP" % (
+            udp['host'], udp['port'], udp['multicast']))
+
+    if tcp:
+        logger.info("[Carbon] Using host=%s port=%d on TCP" % (tcp['host'], tcp['port']))
+
+    if statsd:
+        logger.info("[Carbon] Using host=%s port=%d for StatsD" % (
+            statsd['host'], statsd['port']))
+
+    for socktype in ('stream', 'dgram'):
+        unix = config['unix_' + socktype]
+        if unix:
+            logger.info("[Carbon] Using path=%s mode=%o on Unix %s socket" % (
+                unix['path'], unix['mode'], socktype))
+
+    instance = CarbonArbiter(plugin, **config)
+    return instance
+
+
+def parse_config(plugin):
+    """
+    Parse the module configuration.
+    :param plugin: The module configuration object.
+    :return: A dict of the CarbonArbiter keyword arguments.
+    """
     if hasattr(plugin, "use_tcp"):
         use_tcp = plugin.use_tcp.lower() in ("yes", "true", "1")
     else:
@@ -106,30 +186,308 @@ def get_instance(plugin):
     else:
         multicast = False
 
+    if hasattr(plugin, "use_statsd"):
+        use_statsd = plugin.use_statsd.lower() in ("yes", "true", "1")
+    else:
+        use_statsd = False
+
+    if hasattr(plugin, 'host_statsd'):
+        host_statsd = plugin.host_statsd
+    else:
+        host_statsd = "0.0.0.0"
+
+    if hasattr(plugin, 'port_statsd'):
+        port_statsd = int(plugin.port_statsd)
+    else:
+        port_statsd = DEFAULT_STATSD_PORT
+
+    if hasattr(plugin, 'unix_stream_path'):
+        unix_stream_path = plugin.unix_stream_path
+    else:
+        unix_stream_path = None
+
+    if hasattr(plugin, 'unix_dgram_path'):
+        unix_dgram_path = plugin.unix_dgram_path
+    else:
+        unix_dgram_path = None
+
+    if hasattr(plugin, 'unix_socket_mode'):
+        unix_socket_mode = int(plugin.unix_socket_mode, 8)
+    else:
+        unix_socket_mode = 0o660
+
     if hasattr(plugin, 'interval'):
         interval = int(plugin.interval)
     else:
         interval = DEFAULT_INTERVAL
 
+    if hasattr(plugin, 'statsd_flush_interval'):
+        statsd_flush_interval = int(plugin.statsd_flush_interval)
+    else:
+        statsd_flush_interval = interval
+
+    if hasattr(plugin, 'statsd_percentiles'):
+        statsd_percentiles = parse_percentiles(plugin.statsd_percentiles)
+    else:
+        statsd_percentiles = parse_percentiles(DEFAULT_STATSD_PERCENTILES)
+
     if hasattr(plugin, 'grouped_collectd_plugins'):
         grouped_collectd_plugins = [name.strip()
                                     for name in plugin.grouped_collectd_plugins.split(',')]
     else:
         grouped_collectd_plugins = []
 
+    if hasattr(plugin, 'summarized_plugins'):
+        summarized_plugins = [name.strip()
+                              for name in plugin.summarized_plugins.split(',') if name.strip()]
+    else:
+        summarized_plugins = []
+
+    if hasattr(plugin, "summary_instances"):
+        summary_instances = plugin.summary_instances.lower() in ("yes", "true", "1")
+    else:
+        summary_instances = False
+
+    if hasattr(plugin, 'metric_templates'):
+        templates = [template.strip()
+                     for template in plugin.metric_templates.split(',') if template.strip()]
+    else:
+        templates = []
+
+    if hasattr(plugin, 'tags_mapping'):
+        tags_mapping = parse_tags_mapping(plugin.tags_mapping)
+    else:
+        tags_mapping = {}
+
+    if hasattr(plugin, 'snapshot_file'):
+        snapshot_file = plugin.snapshot_file
+    else:
+        snapshot_file = None
+
+    if hasattr(plugin, 'snapshot_every'):
+        snapshot_every = int(plugin.snapshot_every)
+    else:
+        snapshot_every = DEFAULT_SNAPSHOT_EVERY
+
+    if hasattr(plugin, 'spool_dir'):
+        spool_dir = plugin.spool_dir
+    else:
+        spool_dir = None
+
+    if hasattr(plugin, 'spool_max_size'):
+        spool_max_size = int(plugin.spool_max_size) * 1024 * 1024
+    else:
+        spool_max_size = DEFAULT_SPOOL_MAX_SIZE
+
+    if hasattr(plugin, 'spool_max_age'):
+        spool_max_age = int(plugin.spool_max_age)
+    else:
+        spool_max_age = DEFAULT_SPOOL_MAX_AGE
+
+    if hasattr(plugin, 'relay_destinations'):
+        relay_destinations = parse_destinations(plugin.relay_destinations)
+    else:
+        relay_destinations = []
+
+    if hasattr(plugin, 'relay_replication'):
+        relay_replication = int(plugin.relay_replication)
+    else:
+        relay_replication = 1
+
+    if hasattr(plugin, 'relay_max_buffer'):
+        relay_max_buffer = int(plugin.relay_max_buffer)
+    else:
+        relay_max_buffer = DEFAULT_RELAY_MAX_BUFFER
+
+    if hasattr(plugin, 'profile_dir'):
+        profile_dir = plugin.profile_dir
+    else:
+        profile_dir = '/tmp'
+
+    if hasattr(plugin, 'profile_duration'):
+        profile_duration = int(plugin.profile_duration)
+    else:
+        profile_duration = DEFAULT_PROFILE_DURATION
+
+    if hasattr(plugin, "cardinality_tracking"):
+        cardinality_tracking = plugin.cardinality_tracking.lower() in ("yes", "true", "1")
+    else:
+        cardinality_tracking = False
+
+    if hasattr(plugin, 'cardinality_top'):
+        cardinality_top = int(plugin.cardinality_top)
+    else:
+        cardinality_top = DEFAULT_CARDINALITY_TOP
+
+    if hasattr(plugin, 'max_series_per_host'):
+        max_series_per_host = int(plugin.max_series_per_host)
+    else:
+        max_series_per_host = 0
+
+    if hasattr(plugin, 'max_series_per_service'):
+        max_series_per_service = int(plugin.max_series_per_service)
+    else:
+        max_series_per_service = 0
+
+    if hasattr(plugin, 'reorder_window'):
+        reorder_window = int(plugin.reorder_window)
+    else:
+        reorder_window = 0
+
+    if hasattr(plugin, "adaptive_interval"):
+        adaptive_interval = plugin.adaptive_interval.lower() in ("yes", "true", "1")
+    else:
+        adaptive_interval = False
+
+    if hasattr(plugin, "change_only"):
+        change_only = plugin.change_only.lower() in ("yes", "true", "1")
+    else:
+        change_only = False
+
+    if hasattr(plugin, 'max_silence'):
+        max_silence = int(plugin.max_silence)
+    else:
+        max_silence = DEFAULT_MAX_SILENCE
+
+    if hasattr(plugin, 'thresholds'):
+        thresholds = parse_thresholds(plugin.thresholds)
+    else:
+        thresholds = []
+
+    if hasattr(plugin, 'host_up_every'):
+        host_up_every = int(plugin.host_up_every)
+    else:
+        host_up_every = 0
+
+    if hasattr(plugin, 'host_down_after'):
+        host_down_after = int(plugin.host_down_after)
+    else:
+        host_down_after = 0
+
+    if hasattr(plugin, 'host_down_state'):
+        if plugin.host_down_state.upper() not in ('DOWN', 'UNREACHABLE'):
+            raise ValueError('Invalid host_down_state %r: DOWN or UNREACHABLE expected'
+                             % plugin.host_down_state)
+        host_down_state = HOST_STATES[plugin.host_down_state.upper()]
+    else:
+        host_down_state = DOWN
+
+    if hasattr(plugin, 'history_points'):
+        history_points = int(plugin.history_points)
+    else:
+        history_points = 0
+
+    if hasattr(plugin, 'history_max_series'):
+        history_max_series = int(plugin.history_max_series)
+    else:
+        history_max_series = DEFAULT_HISTORY_MAX_SERIES
+
+    if hasattr(plugin, 'history_host'):
+        history_host = plugin.history_host
+    else:
+        history_host = DEFAULT_HISTORY_HOST
+
+    if hasattr(plugin, 'history_port'):
+        history_port = int(plugin.history_port)
+    else:
+        history_port = 0
+
+    if hasattr(plugin, 'lifecycle_log_samples'):
+        lifecycle_log_samples = int(plugin.lifecycle_log_samples)
+    else:
+        lifecycle_log_samples = DEFAULT_LIFECYCLE_SAMPLES
+
+    if hasattr(plugin, 'lifecycle_log_detail'):
+        lifecycle_log_detail = plugin.lifecycle_log_detail.lower() in ("yes", "true", "1")
+    else:
+        lifecycle_log_detail = False
+
+    if hasattr(plugin, 'bad_lines_samples'):
+        bad_lines_samples = int(plugin.bad_lines_samples)
+    else:
+        bad_lines_samples = DEFAULT_BAD_LINES_SAMPLES
+
+    if hasattr(plugin, 'rate_limit'):
+        rate_limit = float(plugin.rate_limit)
+    else:
+        rate_limit = 0
+
+    if hasattr(plugin, 'rate_limit_burst'):
+        rate_limit_burst = float(plugin.rate_limit_burst)
+    else:
+        rate_limit_burst = None
+
+    if hasattr(plugin, 'rate_limit_by'):
+        rate_limit_by = [name.strip() for name in plugin.rate_limit_by.split(',') if name.strip()]
+        for name in rate_limit_by:
+            if name not in ('peer', 'host'):
+                raise ValueError('Invalid rate_limit_by %r: peer and/or host expected' % name)
+    else:
+        rate_limit_by = ['host']
+
+    if hasattr(plugin, 'rate_limit_overrides'):
+        rate_limit_overrides = parse_rate_overrides(plugin.rate_limit_overrides)
+    else:
+        rate_limit_overrides = {}
+
+    if hasattr(plugin, 'config_file'):
+        config_file = plugin.config_file
+    else:
+        config_file = None
+
     udp = {}
     tcp = {}
+    statsd = {}
+    unix_stream = {}
+    unix_dgram = {}
 
     if use_udp:
         udp = {'host': host_udp, 'port': port_udp, 'multicast': multicast}
-        logger.info("[Carbon] Using host=%s port=%d multicast=%d on UDP" % (host_udp, port_udp, multicast))
 
     if use_tcp:
         tcp = {'host': host_tcp, 'port': port_tcp}
-        logger.info("[Carbon] Using host=%s port=%d on TCP" % (host_tcp, port_tcp))
 
-    instance = CarbonArbiter(plugin, udp, tcp, interval, grouped_collectd_plugins)
-    return instance
+    if use_statsd:
+        statsd = {'host': host_statsd, 'port': port_statsd}
+
+    if unix_stream_path:
+        unix_stream = {'path': unix_stream_path, 'mode': unix_socket_mode}
+
+    if unix_dgram_path:
+        unix_dgram = {'path': unix_dgram_path, 'mode': unix_socket_mode}
+
+    return dict(udp=udp, tcp=tcp, statsd=statsd, unix_stream=unix_stream,
+                unix_dgram=unix_dgram, interval=interval,
+                grouped_collectd_plugins=grouped_collectd_plugins,
+                summarized_plugins=summarized_plugins, summary_instances=summary_instances,
+                templates=templates, tags_mapping=tags_mapping,
+                snapshot_file=snapshot_file, snapshot_every=snapshot_every,
+                spool_dir=spool_dir, spool_max_size=spool_max_size,
+                spool_max_age=spool_max_age,
+                relay_destinations=relay_destinations,
+                relay_replication=relay_replication,
+                relay_max_buffer=relay_max_buffer,
+                profile_dir=profile_dir, profile_duration=profile_duration,
+                cardinality_tracking=cardinality_tracking,
+                cardinality_top=cardinality_top,
+                max_series_per_host=max_series_per_host,
+                max_series_per_service=max_series_per_service,
+                reorder_window=reorder_window,
+                adaptive_interval=adaptive_interval,
+                change_only=change_only, max_silence=max_silence, thresholds=thresholds,
+                host_up_every=host_up_every, host_down_after=host_down_after,
+                host_down_state=host_down_state,
+                history_points=history_points, history_max_series=history_max_series,
+                history_host=history_host, history_port=history_port,
+                lifecycle_log_samples=lifecycle_log_samples,
+                lifecycle_log_detail=lifecycle_log_detail,
+                bad_lines_samples=bad_lines_samples,
+                rate_limit=rate_limit, rate_limit_burst=rate_limit_burst,
+                rate_limit_by=rate_limit_by,
+                rate_limit_overrides=rate_limit_overrides,
+                config_file=config_file,
+                statsd_flush_interval=statsd_flush_interval,
+                statsd_percentiles=statsd_percentiles)
 
 
 #############################################################################
@@ -141,13 +499,37 @@ MP = MetricPoint = namedtuple('MetricPoint',
 class Element(object):
     """ Element store service name and all perfdatas before send it in a external command """
 
-    def __init__(self, host_name, sdesc, interval, last_sent=None):
-        self.host_name = host_name
-        self.sdesc = sdesc
+    def __init__(self, host_name, sdesc, interval, last_sent=None, clock=time.time,
+                 reorder_window=0, adaptive=False, max_silence=0, thresholds=None,
+                 summarize=False, summary_instances=False, history=None):
+        self.host_name = intern_pool.acquire(host_name)
+        self.sdesc = intern_pool.acquire(sdesc)
         self.perf_datas = {}
         self.interval = interval
+        self.clock = clock
+        # number of points kept per metric to accept the late ones, 0 to only keep the last one
+        self.reorder_window = reorder_window
+        self.windows = {}
+        # learn the reporting period of the source, and send a batch as soon as it's complete
+        self.adaptive = adaptive
+        self.period = None
+        self.batch_start = None
+        self.last_arrival = None
+        # only send the perfdata when it changed, or after max_silence seconds (0 to always send)
+        self.max_silence = max_silence
+        self.fingerprint = None
+        self.last_emitted = None
+        self.n_suppressed = 0
+        # the ThresholdRules of the metrics: a service check result is sent if one matches
+        self.thresholds = thresholds
+        # the perfdata of a grouped plugin is summarized across its instances (with or without
+        # the values of the instances)
+        self.summary = InstanceMatrix() if summarize else None
+        self.summary_instances = summary_instances
+        # the History the received points are added to
+        self.history = history
         if not last_sent:
-            last_sent = time.time()
+            last_sent = clock()
         # for the first time we'll wait 2*interval to be sure to get a complete data set :
         self.last_sent = last_sent + 2 * interval
 
@@ -169,14 +551,42 @@ class Element(object):
         """
         return self._last_update(min)
 
+    @property
+    def send_interval(self):
+        """
+        :return: The learned reporting period if there is one, the configured interval otherwise.
+        """
+        if self.adaptive and self.period is not None:
+            return self.period
+        return self.interval
+
     @property
     def send_ready(self):
         """
         :return: True if this element is ready to have its perfdata sent. False otherwise.
         """
+        if self.adaptive and self.perf_datas and self._last_update() > self.last_sent:
+            # all the metrics have arrived since the last send, or the batch is late
+            return (self._last_update(min) > self.last_sent or
+                    self.clock() > self.last_sent + _PARTIAL_TIMEOUT * self.send_interval)
         return (self.perf_datas and
                 self._last_update() > self.last_sent and
-                time.time() > self.last_sent + self.interval)
+                self.clock() > self.last_sent + self.interval)
+
+    def _learn_period(self, now):
+        """
+        Update the learned reporting period with an arrival.
+        """
+        if self.last_arrival is None or now - self.last_arrival > _BATCH_GAP:
+            # a new batch
+            if self.batch_start is not None:
+                sample = now - self.batch_start
+                if self.period is None:
+                    self.period = sample
+                else:
+                    self.period += _PERIOD_SMOOTHING * (sample - self.period)
+            self.batch_start = now
+        self.last_arrival = now
 
     def __str__(self):
         return '%s.%s' % (self.host_name, self.sdesc)
@@ -191,12 +601,23 @@ class Element(object):
         if not mvalues:
             return
 
+        if self.history is not None:
+            self.history.add((self.host_name, self.sdesc, mname), mtime,
+                             mvalues[0] if isinstance(mvalues, list) else mvalues)
+
+        if self.adaptive:
+            self._learn_period(self.clock())
+
+        if self.reorder_window:
+            return self._add_windowed_perf_data(mname, mvalues, mtime)
+
         res = []
-        now = time.time()
+        now = self.clock()
 
         oldvalues = self.perf_datas.get(mname, None)
         if oldvalues is None:
-            logger.info('%s : New perfdata: %s : %s' % (self, mname, mvalues))
+            mname = intern_pool.acquire(mname)
+            lifecycle_log.event('new perfdata', self, mname)
             res.append(MP(mvalues, mvalues, mtime, now))
         else:
             for met_point, val in izip(oldvalues, mvalues):
@@ -209,6 +630,86 @@ class Element(object):
         if res:
             self.perf_datas[mname] = res
 
+    def _add_windowed_perf_data(self, mname, mvalues, mtime):
+        """
+        Add a point to the reorder window of the metric, its latest point is the perf data.
+        """
+        val = mvalues[0] if isinstance(mvalues, list) else mvalues
+        window = self.windows.get(mname, None)
+        if window is None:
+            window = ReorderWindow(self.reorder_window)
+            oldvalues = self.perf_datas.get(mname, None)
+            if oldvalues is None:
+                mname = intern_pool.acquire(mname)
+                lifecycle_log.event('new perfdata', self, mname)
+            else:
+                # e.g. restored from a snapshot
+                window.add(oldvalues[0].time, oldvalues[0].val)
+            self.windows[mname] = window
+
+        status = window.add(mtime, val)
+        if status == DROPPED or status == LATE:
+            # the latest point doesn't change
+            return
+        self.perf_datas[mname] = [MP(val, val, mtime, self.clock())]
+
+    def summarize(self, mname, key, instance):
+        """
+        Update the summary with the last value of a perf data.
+        :param key: The type of the metric across the plugin instances.
+        :param instance: Its plugin instance.
+        """
+        met_values = self.perf_datas.get(mname, None)
+        if met_values is None:
+            return
+        val = met_values[0].val
+        self.summary.set(mname, key, instance, val[0] if isinstance(val, list) else val)
+
+    def _summarized_perf_datas(self):
+        """
+        :return: The perf datas to send: the aggregates of the types across the plugin instances,
+                 the values of the instances are replaced (unless summary_instances).
+        """
+        summary = self.summary
+        if self.summary_instances:
+            res = dict(self.perf_datas)
+        else:
+            res = dict((mname, met_values) for mname, met_values in self.perf_datas.iteritems()
+                       if mname not in summary)
+        mtime = here_time = self._last_update()
+        for key, values in summary.aggregates():
+            for aggregate, val in izip(AGGREGATES, values):
+                res['%s_%s' % (key, aggregate)] = [MP(val, val, mtime, here_time)]
+        return res
+
+    def remove_perf_data(self, mname):
+        """
+        Remove a perf data of this element and release its name.
+        :param mname:   The metric name.
+        """
+        del self.perf_datas[mname]
+        self.windows.pop(mname, None)
+        if self.summary is not None:
+            self.summary.remove(mname)
+        if self.history is not None:
+            self.history.discard((self.host_name, self.sdesc, mname))
+        intern_pool.release(mname)
+
+    def release(self):
+        """
+        Release the names of this element (and of its remaining perf datas)
+        from the intern pool, once it's removed from the elements.
+        """
+        for mname in self.perf_datas:
+            intern_pool.release(mname)
+            if self.history is not None:
+                self.history.discard((self.host_name, self.sdesc, mname))
+        self.perf_datas.clear()
+        self.windows.clear()
+        self.summary = None
+        intern_pool.release(self.host_name)
+        intern_pool.release(self.sdesc)
+
     def get_command(self):
         """
         Look if this element has data to be sent to Shinken.
@@ -221,20 +722,48 @@ class Element(object):
 
         res = ''
         max_time = None
-        for met_name, values_list in sorted(self.perf_datas.items(), key=lambda i: i[0]):
+        thresholds = self.thresholds
+        state = None
+        alerts = []
+        perf_datas = self.perf_datas
+        if self.summary is not None:
+            perf_datas = self._summarized_perf_datas()
+        for met_name, values_list in sorted(perf_datas.items(), key=lambda i: i[0]):
+            rule = thresholds.match(self.sdesc, met_name) if thresholds else None
             for met_idx, met_pt in enumerate(values_list):
+                # the first point of a metric holds the received values
+                val = met_pt.val[0] if isinstance(met_pt.val, list) else met_pt.val
                 value_to_str = lambda v: \
-                    '%f' % v if isinstance(met_pt.val, float) else \
-                    '%d' % v if isinstance(met_pt.val, int) else \
+                    '%f' % v if isinstance(val, float) else \
+                    '%d' % v if isinstance(val, int) else \
                     '%s' % v
-                met_value = value_to_str(met_pt.val)
-                res += ('{met_name}%s={met_value} ' % (
+                met_value = value_to_str(val)
+                res += ('{met_name}%s={met_value}' % (
                     '_{met_idx}' if len(values_list) > 1 else ''
                 )).format(**locals())
+                if rule is not None:
+                    met_state = rule.state(val)
+                    if met_state != OK:
+                        alerts.append(res[res.rfind(' ') + 1:])
+                    if state is None or met_state > state:
+                        state = met_state
+                    res += rule.perfdata_fields()
+                res += ' '
                 if max_time is None or met_pt.here_time > max_time:
                     max_time = met_pt.here_time
 
-        self.last_sent = time.time()
+        now = self.last_sent = self.clock()
+        if self.max_silence:
+            fingerprint = hash((state, res))
+            if fingerprint == self.fingerprint and now < self.last_emitted + self.max_silence:
+                self.n_suppressed += 1
+                return
+            self.fingerprint = fingerprint
+            self.last_emitted = now
+        if state is not None:
+            return '[%d] PROCESS_SERVICE_CHECK_RESULT;%s;%s;%d;Carbon %s%s|%s' % (
+                int(max_time), self.host_name, self.sdesc, state, STATES[state],
+                ': ' + ', '.join(alerts) if alerts else '', res)
         return '[%d] PROCESS_SERVICE_OUTPUT;%s;%s;Carbon|%s' % (
             int(max_time), self.host_name, self.sdesc, res)
 
@@ -243,15 +772,88 @@ class CarbonArbiter(BaseModule):
     """ Main class for this carbon module """
 
     def __init__(self, modconf, udp, tcp,  interval, grouped_collectd_plugins=None,
-                 use_dedicated_thread=False):
+                 use_dedicated_thread=False, templates=None, tags_mapping=None,
+                 snapshot_file=None, snapshot_every=DEFAULT_SNAPSHOT_EVERY,
+                 spool_dir=None, spool_max_size=DEFAULT_SPOOL_MAX_SIZE,
+                 spool_max_age=DEFAULT_SPOOL_MAX_AGE, relay_destinations=None,
+                 relay_replication=1, relay_max_buffer=DEFAULT_RELAY_MAX_BUFFER,
+                 profile_dir='/tmp', profile_duration=DEFAULT_PROFILE_DURATION,
+                 cardinality_tracking=False, cardinality_top=DEFAULT_CARDINALITY_TOP,
+                 max_series_per_host=0, max_series_per_service=0, reorder_window=0,
+                 adaptive_interval=False, change_only=False, max_silence=DEFAULT_MAX_SILENCE,
+                 thresholds=None, host_up_every=0, host_down_after=0, host_down_state=DOWN,
+                 rate_limit=0, rate_limit_burst=None, rate_limit_by=('host',),
+                 rate_limit_overrides=None, config_file=None, statsd=None,
+                 statsd_flush_interval=None, statsd_percentiles=None, unix_stream=None,
+                 unix_dgram=None, summarized_plugins=None, summary_instances=False,
+                 history_points=0, history_max_series=DEFAULT_HISTORY_MAX_SERIES,
+                 history_host=DEFAULT_HISTORY_HOST, history_port=0,
+                 lifecycle_log_samples=DEFAULT_LIFECYCLE_SAMPLES, lifecycle_log_detail=False,
+                 bad_lines_samples=DEFAULT_BAD_LINES_SAMPLES, clock=time.time):
         BaseModule.__init__(self, modconf)
         self.udp = udp
         self.tcp = tcp
+        self.statsd = statsd or {}
+        self.unix_stream = unix_stream or {}
+        self.unix_dgram = unix_dgram or {}
         self.interval = interval
         if grouped_collectd_plugins is None:
             grouped_collectd_plugins = []
         self.elements = {}
         self.grouped_collectd_plugins = grouped_collectd_plugins
+        self.summarized_plugins = summarized_plugins or []
+        self.summary_instances = summary_instances
+        self.templates = templates or []
+        self.tags_mapping = tags_mapping or {}
+        self.snapshot_file = snapshot_file
+        self.snapshot_every = snapshot_every
+        self.snapshot = None
+        self.spool_dir = spool_dir
+        self.spool_max_size = spool_max_size
+        self.spool_max_age = spool_max_age
+        self.spool = None
+        self._queue_errors = 0
+        self.relay_destinations = relay_destinations or []
+        self.relay_replication = relay_replication
+        self.relay_max_buffer = relay_max_buffer
+        self.relay = None
+        # time source of the elements, the replay of a capture uses the lines time
+        self.clock = clock
+        self.profile_dir = profile_dir
+        self.profile_duration = profile_duration
+        self.profiler = Profiler([
+            (CarbonArbiter, '_read_carbon_packet', 'read packet', False),
+            (Parser, 'interpret_opcodes', 'interpret opcodes', True),
+            (Element, 'add_perf_data', 'add perf data', False),
+            (Element, 'get_command', 'get command', False),
+            (CarbonArbiter, '_queue_commands', 'queue put', False),
+        ])
+        self.cardinality = None
+        self._set_cardinality(cardinality_tracking, cardinality_top,
+                              max_series_per_host, max_series_per_service)
+        self.reorder_window = reorder_window
+        self.adaptive_interval = adaptive_interval
+        self.change_only = change_only
+        self.max_silence = max_silence
+        self._set_thresholds(thresholds)
+        self.liveness = None
+        self._set_liveness(host_up_every, host_down_after, host_down_state)
+        self.history = None
+        self._set_history(history_points, history_max_series)
+        self.history_host = history_host
+        self.history_port = history_port
+        self.history_server = None
+        self.lifecycle_log_samples = lifecycle_log_samples
+        self.lifecycle_log_detail = lifecycle_log_detail
+        self._set_lifecycle_log(lifecycle_log_samples, lifecycle_log_detail)
+        self.bad_lines_samples = bad_lines_samples
+        bad_lines.samples = bad_lines_samples
+        self._set_rate_limiter(rate_limit, rate_limit_burst, rate_limit_by, rate_limit_overrides)
+        self.config_file = config_file
+        self.reader = None
+        self._reload_requested = False
+        # send cadence (last_sent) by (host, plugin) of the elements removed by a grouping change
+        self._carried = {}
 
         self.use_dedicated_thread = use_dedicated_thread
         th_mgr = (threading if use_dedicated_thread
@@ -259,16 +861,40 @@ class CarbonArbiter(BaseModule):
         self.lock = th_mgr.Lock()  # protect the access to self.elements
         self.send_ready = False
 
-    def _read_carbon_packet(self, reader):
+        # the StatsD samples are aggregated by the reader, and flushed by the main loop
+        self.statsd_flush_interval = statsd_flush_interval or interval
+        if self.statsd:
+            self.statsd_aggregator = StatsdAggregator(statsd_percentiles, lock=self.lock)
+        else:
+            self.statsd_aggregator = None
+
+    def _summarized(self, plugin):
+        """
+        :return: True if the elements of the plugin are summarized.
+        """
+        return plugin in self.summarized_plugins and plugin in self.grouped_collectd_plugins
+
+    @property
+    def element_max_silence(self):
+        """
+        :return: The max_silence of the elements, 0 if the unchanged perfdatas are sent.
+        """
+        return self.max_silence if self.change_only else 0
+
+    def _read_carbon_packet(self, reader, buf=None):
         """
         Read and interpret a packet from a carbon client.
         :param reader: A carbon Reader instance.
+        :param buf: The packet to interpret, by default it's received by the reader.
         """
 
         elements = self.elements
         lock = self.lock
+        intern = intern_pool.intern
+        cardinality = self.cardinality
+        liveness = self.liveness
 
-        item_iterator = reader.interpret()
+        item_iterator = reader.interpret(buf)
         while True:
             try:
                 item = next(item_iterator)
@@ -281,20 +907,441 @@ class CarbonArbiter(BaseModule):
             assert isinstance(item, Data)
             assert isinstance(item, Values)
 
-            name = item.get_name()
+            name = intern(item.get_name())
+            mname = intern(item.get_metric_name())
             elem = elements.get(name, None)
+            if elem is None and self.snapshot is not None:
+                with lock:
+                    elem = self._restore_element(name, item.plugin)
+            new_series = cardinality is not None and (elem is None or
+                                                      mname not in elem.perf_datas)
+            if new_series and not cardinality.allow(item.host,
+                                                    len(elem.perf_datas) if elem else 0):
+                # the updates of the existing series are still accepted
+                cardinality.reject(item.host)
+                if elem is not None and name not in elements:
+                    # a restored element which isn't kept
+                    for _ in elem.perf_datas:
+                        cardinality.remove_series(elem.host_name, elem.sdesc)
+                    elem.release()
+                continue
             if elem is None:
                 elem = Element(item.host,
                                item.get_srv_desc(),
-                               self.interval)
-                logger.info('Created %s ; interval=%s' % (elem, elem.interval))
+                               self.interval,
+                               clock=self.clock,
+                               reorder_window=self.reorder_window,
+                               adaptive=self.adaptive_interval,
+                               max_silence=self.element_max_silence,
+                               thresholds=self.threshold_rules,
+                               summarize=self._summarized(item.plugin),
+                               summary_instances=self.summary_instances,
+                               history=self.history)
+                if self._carried:
+                    last_sent = self._carried.get((item.host, item.plugin), None)
+                    if last_sent is not None:
+                        elem.last_sent = last_sent
+                lifecycle_log.event('created', elem)
             # now we can add this perf data:
             with lock:
-                elem.add_perf_data(item.get_metric_name(), item, item.time)
+                if liveness is not None:
+                    liveness.seen(elem.host_name)
+                elem.add_perf_data(mname, item, item.time)
+                if elem.summary is not None:
+                    elem.summarize(mname, item.get_summary_key(), item.plugininstance or '')
+                if new_series and mname in elem.perf_datas:
+                    cardinality.add_series(elem.host_name, elem.sdesc, mname)
                 if name not in elements:
-                    elements[name] = elem
+                    elements[intern_pool.acquire(name)] = elem
                     # end for
 
+    def _load_snapshot(self):
+        """
+        Open the elements snapshot, its elements are restored when their data arrives.
+        """
+        if not os.path.exists(self.snapshot_file):
+            return
+        try:
+            self.snapshot = SnapshotReader(self.snapshot_file)
+        except (SnapshotError, IOError) as err:
+            logger.warning('[Carbon] Ignoring snapshot: %s' % err)
+            return
+        logger.info('[Carbon] Loaded snapshot of %d elements from %s' % (
+            len(self.snapshot), self.snapshot_file))
+
+    def _restore_element(self, name, plugin):
+        """
+        :param name: The element name.
+        :param plugin: The plugin of the element, as in the data which arrived for it.
+        :return: The element restored from the snapshot, or None if it's not in it.
+        """
+        if self.snapshot is None:
+            return None
+        try:
+            record = self.snapshot.pop(name)
+        except SnapshotError as err:
+            logger.warning('[Carbon] Ignoring snapshot: %s' % err)
+            self._close_snapshot()
+            return None
+        if record is None:
+            return None
+        host_name, sdesc, last_sent, perf_datas = record
+        elem = Element(host_name, sdesc, self.interval, clock=self.clock,
+                       reorder_window=self.reorder_window, adaptive=self.adaptive_interval,
+                       max_silence=self.element_max_silence,
+                       thresholds=self.threshold_rules,
+                       summarize=self._summarized(plugin),
+                       summary_instances=self.summary_instances,
+                       history=self.history)
+        elem.last_sent = last_sent
+        for mname, points, summary in perf_datas:
+            mname = intern_pool.acquire(mname)
+            elem.perf_datas[mname] = [
+                MP(val, val, mtime, here_time) for val, mtime, here_time in points]
+            if elem.summary is not None and summary is not None:
+                elem.summarize(mname, *summary)
+            if self.cardinality is not None:
+                self.cardinality.add_series(host_name, sdesc, mname)
+        return elem
+
+    def _close_snapshot(self):
+        self.snapshot.close()
+        self.snapshot = None
+
+    def _write_snapshot(self):
+        """
+        Write the elements snapshot.
+        """
+        start = time.time()
+        with self.lock:
+            dump = dump_elements(self.elements)
+        try:
+            count = write_snapshot(self.snapshot_file, dump)
+        except (IOError, OSError) as err:
+            logger.error('[Carbon] Unable to write snapshot %s: %s' % (self.snapshot_file, err))
+            return
+        logger.info('[Carbon] Snapshot of %d elements written in %.3f s' % (
+            count, time.time() - start))
+        if count < len(dump):
+            logger.warning('[Carbon] %d elements skipped in the snapshot: invalid values' % (
+                len(dump) - count))
+
+    def _queue_commands(self, commands):
+        """
+        Put the commands in the queue (or in the spool).
+        """
+        # we could send those in one shot !
+        # if it existed an ExternalCommand*s* items class.. TODO.
+        if self.spool is None:
+            for cmd in commands:
+                self.from_q.put(ExternalCommand(cmd))
+        else:
+            self._send_commands(commands)
+
+    def _toggle_timers(self, *_):
+        """
+        Signal handler (SIGUSR1): enable or disable the profiling timers.
+        """
+        if self.profiler.toggle():
+            logger.info('[Carbon] Profiling timers enabled')
+        else:
+            logger.info('[Carbon] Profiling timers disabled')
+            self._log_timers()
+
+    def _log_timers(self):
+        for line in self.profiler.report():
+            logger.info('[Carbon] Profiling %s' % line)
+
+    def _start_cprofile(self, *_):
+        """
+        Signal handler (SIGUSR2): profile the module with cProfile for profile_duration seconds.
+        """
+        path = self.profiler.start_cprofile(self.profile_dir, self.profile_duration)
+        if path:
+            logger.info('[Carbon] cProfile started for %d s, stats will be in %s' % (
+                self.profile_duration, path))
+
+    def _set_signals(self):
+        try:
+            signal.signal(signal.SIGUSR1, self._toggle_timers)
+            signal.signal(signal.SIGUSR2, self._start_cprofile)
+            if self.config_file:
+                signal.signal(signal.SIGHUP, self._request_reload)
+        except ValueError as err:
+            # not in the main thread
+            logger.warning('[Carbon] Signals not available: %s' % err)
+
+    def _put_command(self, cmd):
+        """
+        Put a command in the queue, without blocking.
+        :return: False if the queue is saturated or unavailable.
+        """
+        try:
+            self.from_q.put(ExternalCommand(cmd), False)
+        except Full:
+            return False
+        except (IOError, OSError, EOFError) as err:
+            # logged once, then counted until the queue is back
+            if not self._queue_errors:
+                logger.warning('[Carbon] Queue unavailable: %s' % err)
+            self._queue_errors += 1
+            return False
+        if self._queue_errors:
+            logger.info('[Carbon] Queue available again after %d failed puts' %
+                        self._queue_errors)
+            self._queue_errors = 0
+        return True
+
+    def _send_commands(self, commands):
+        """
+        Send the commands to the queue, the ones that can't be are spooled.
+        The spooled commands are sent first, to keep the order.
+        """
+        spool = self.spool
+        if spool.pending:
+            spool.replay(self._put_command)
+        for idx, cmd in enumerate(commands):
+            if spool.pending or not self._put_command(cmd):
+                spool.extend(commands[idx:])
+                break
+
+    def _get_commands(self):
+        """
+        :return: The list of commands of the elements ready to be sent.
+        """
+        tosend = []
+        with self.lock:
+            for elem in self.elements.itervalues():
+                cmd = elem.get_command()
+                if cmd:
+                    tosend.append(cmd)
+        return tosend
+
+    def _count_suppressed(self):
+        """
+        :return: The number of unchanged commands suppressed since the last call.
+        """
+        count = 0
+        with self.lock:
+            for elem in self.elements.itervalues():
+                count += elem.n_suppressed
+                elem.n_suppressed = 0
+        return count
+
+    def _purge_elements(self, now):
+        """
+        Purge the perf datas (and then the elements) not updated for more than 3 intervals.
+        """
+        elements = self.elements
+        todel = []
+        with self.lock:
+            for name, elem in elements.iteritems():
+                for perf_name, met_values in elem.perf_datas.items():
+                    if met_values[0].here_time < now - 3 * max(elem.interval,
+                                                               elem.send_interval):
+                        # this perf data has not been updated for more than 3 intervals,
+                        # purge it.
+                        elem.remove_perf_data(perf_name)
+                        if self.cardinality is not None:
+                            self.cardinality.remove_series(elem.host_name, elem.sdesc)
+                        lifecycle_log.event('purged perfdata', elem, perf_name)
+                if not elem.perf_datas:
+                    todel.append(name)
+            for key, last_sent in self._carried.items():
+                if last_sent < now - 3 * self.interval:
+                    del self._carried[key]
+            if self.snapshot is not None and \
+                    now > self.snapshot.time + 3 * self.interval:
+                # what is still in the snapshot would be purged now
+                self._close_snapshot()
+            for name in todel:
+                elem = elements.pop(name)
+                lifecycle_log.event('purged', elem)
+                elem.release()
+                intern_pool.release(name)
+
+    def _set_cardinality(self, tracking, top, max_series_per_host, max_series_per_service):
+        # the limits need the series to be tracked
+        if not (tracking or max_series_per_host or max_series_per_service):
+            self.cardinality = None
+        elif self.cardinality is None:
+            self.cardinality = CardinalityTracker(max_series_per_host, max_series_per_service, top)
+            for elem in self.elements.itervalues():
+                for mname in elem.perf_datas:
+                    self.cardinality.add_series(elem.host_name, elem.sdesc, mname)
+        else:
+            self.cardinality.max_series_per_host = max_series_per_host
+            self.cardinality.max_series_per_service = max_series_per_service
+            self.cardinality.top_hosts.size = self.cardinality.top_plugins.size = top
+
+    def _set_rate_limiter(self, rate_limit, rate_limit_burst, rate_limit_by, rate_limit_overrides):
+        if rate_limit or rate_limit_overrides:
+            self.rate_limiter = RateLimiter(rate_limit, rate_limit_burst, rate_limit_overrides)
+        else:
+            self.rate_limiter = None
+        self.rate_limit_by = tuple(rate_limit_by)
+
+    def _set_thresholds(self, thresholds):
+        self.thresholds = thresholds or []
+        self.threshold_rules = ThresholdRules(self.thresholds) if self.thresholds else None
+
+    def _set_liveness(self, up_every, down_after, down_state):
+        if not up_every:
+            self.liveness = None
+        elif self.liveness is None:
+            self.liveness = HostLiveness(up_every, down_after, down_state)
+        else:
+            self.liveness.up_every = up_every
+            self.liveness.down_after = down_after
+            self.liveness.down_state = down_state
+
+    def _set_history(self, points, max_series):
+        if not points:
+            self.history = None
+        elif self.history is None:
+            self.history = History(points, max_series)
+        else:
+            # the existing series keep their size
+            self.history.points = points
+            self.history.max_series = max_series
+        for elem in self.elements.itervalues():
+            elem.history = self.history
+
+    @staticmethod
+    def _set_lifecycle_log(samples, detail):
+        lifecycle_log.samples = samples
+        lifecycle_log.detail = detail
+
+    def _rekey_elements(self, plugins):
+        """
+        The elements of the plugins whose grouping changed get new names: they are removed,
+        and their send cadence is carried over to the elements created under the new names.
+        """
+        sdescs = [(Data(plugin=plugin).get_srv_desc(), plugin) for plugin in plugins]
+        elements = self.elements
+        for name, elem in elements.items():
+            for sdesc, plugin in sdescs:
+                if elem.sdesc == sdesc or elem.sdesc.startswith(sdesc + '-'):
+                    break
+            else:
+                continue
+            key = (elem.host_name, plugin)
+            self._carried[key] = max(self._carried.get(key, 0), elem.last_sent)
+            if self.cardinality is not None:
+                for _ in elem.perf_datas:
+                    self.cardinality.remove_series(elem.host_name, elem.sdesc)
+            lifecycle_log.event('rekeyed', elem)
+            elements.pop(name).release()
+            intern_pool.release(name)
+
+    def reload(self, config):
+        """
+        Apply a new configuration (see parse_config) to the running module: the derived
+        structures (caches, rules, intervals) are swapped in place, the elements are kept
+        (rekeyed if their grouping changed) and the sockets stay open.
+        :return: The names of the changed options which need a restart.
+        """
+        restart = sorted(name for name in ('udp', 'tcp', 'statsd', 'unix_stream', 'unix_dgram',
+                                           'snapshot_file', 'spool_dir',
+                                           'relay_destinations', 'relay_replication',
+                                           'relay_max_buffer', 'history_host', 'history_port')
+                         if config[name] != getattr(self, name))
+        regrouped = set(self.grouped_collectd_plugins) ^ set(config['grouped_collectd_plugins'])
+        regrouped |= set(self.summarized_plugins) ^ set(config['summarized_plugins'])
+        with self.lock:
+            self.interval = config['interval']
+            self.grouped_collectd_plugins = config['grouped_collectd_plugins']
+            self.summarized_plugins = config['summarized_plugins']
+            self.summary_instances = config['summary_instances']
+            self.templates = config['templates']
+            self.tags_mapping = config['tags_mapping']
+            self.snapshot_every = config['snapshot_every']
+            self.profile_dir = config['profile_dir']
+            self.profile_duration = config['profile_duration']
+            self.statsd_flush_interval = config['statsd_flush_interval']
+            if self.statsd_aggregator is not None:
+                self.statsd_aggregator.percentiles = config['statsd_percentiles']
+            if self.spool is not None:
+                self.spool.max_size = config['spool_max_size']
+                self.spool.max_age = config['spool_max_age']
+            self._set_cardinality(config['cardinality_tracking'], config['cardinality_top'],
+                                  config['max_series_per_host'], config['max_series_per_service'])
+            self._set_rate_limiter(config['rate_limit'], config['rate_limit_burst'],
+                                   config['rate_limit_by'], config['rate_limit_overrides'])
+            if regrouped:
+                self._rekey_elements(regrouped)
+            self.reorder_window = config['reorder_window']
+            self.adaptive_interval = config['adaptive_interval']
+            self.change_only = config['change_only']
+            self.max_silence = config['max_silence']
+            self._set_thresholds(config['thresholds'])
+            self._set_liveness(config['host_up_every'], config['host_down_after'],
+                               config['host_down_state'])
+            self._set_history(config['history_points'], config['history_max_series'])
+            self.lifecycle_log_samples = config['lifecycle_log_samples']
+            self.lifecycle_log_detail = config['lifecycle_log_detail']
+            self._set_lifecycle_log(self.lifecycle_log_samples, self.lifecycle_log_detail)
+            self.bad_lines_samples = bad_lines.samples = config['bad_lines_samples']
+            for elem in self.elements.itervalues():
+                elem.thresholds = self.threshold_rules
+                elem.summary_instances = self.summary_instances
+                elem.interval = self.interval
+                elem.adaptive = self.adaptive_interval
+                elem.max_silence = self.element_max_silence
+                if elem.reorder_window != self.reorder_window:
+                    elem.reorder_window = self.reorder_window
+                    elem.windows.clear()
+            if self.reader is not None:
+                self.reader.configure(**self.reader_options())
+        return restart
+
+    def _request_reload(self, *_):
+        """
+        Signal handler (SIGHUP): reload the configuration from config_file.
+        """
+        self._reload_requested = True
+
+    def _reload_config(self):
+        try:
+            config = parse_config(read_module_config(self.config_file, self.name))
+        except (IOError, ValueError) as err:
+            logger.error('[Carbon] Reload failed, the configuration is unchanged: %s' % err)
+            return
+        restart = self.reload(config)
+        logger.info('[Carbon] Configuration reloaded from %s' % self.config_file)
+        if restart:
+            logger.warning('[Carbon] Restart the module to change: %s' % ', '.join(restart))
+
+    def _age_caches(self):
+        """
+        Drop the cached paths, tags and names not used since the previous aging,
+        and the interned names no element references.
+        """
+        if self.reader is not None:
+            self.reader.age_caches()
+        tag_pool.age()
+        intern_pool.sweep()
+
+    def reader_options(self):
+        """
+        :return: The keyword arguments of the ShinkenCarbonReader of this module.
+        """
+        return dict(interval=self.interval,
+                    grouped_collectd_plugins=self.grouped_collectd_plugins,
+                    templates=self.templates,
+                    tags_mapping=self.tags_mapping,
+                    rate_limiter=self.rate_limiter,
+                    rate_limit_by=self.rate_limit_by,
+                    statsd_aggregator=self.statsd_aggregator)
+
+    def _flush_statsd(self, interval):
+        """
+        Flush the StatsD aggregates of the interval to the elements.
+        """
+        points = self.statsd_aggregator.flush(self.clock(), interval)
+        if points:
+            self._read_carbon_packet(self.reader, points)
+
     def _read_carbon(self, reader):
         while not self.interrupted:
             self._read_carbon_packet(reader)
@@ -303,20 +1350,48 @@ class CarbonArbiter(BaseModule):
     def main(self):
 
         use_dedicated_thread = self.use_dedicated_thread
-        elements = self.elements
-        lock = self.lock
         now = time.time()
         clean_every = 15
         report_every = 60
         next_clean = now + clean_every
         next_report = now + report_every
+        next_snapshot = now + self.snapshot_every
+        next_age = now + CACHE_AGE_EVERY
+        last_flush = now
         n_cmd_sent = 0
 
-        if not(self.udp or self.tcp):
-            raise Exception('You must define a TCP or a UDP connection')
+        if not(self.udp or self.tcp or self.statsd or self.unix_stream or self.unix_dgram):
+            raise Exception('You must define a TCP, a UDP, a StatsD or a Unix socket connection')
+
+        if self.snapshot_file:
+            self._load_snapshot()
+
+        if self.spool_dir:
+            self.spool = CommandSpool(self.spool_dir, max_size=self.spool_max_size,
+                                      max_age=self.spool_max_age)
+            if self.spool.pending:
+                logger.info('[Carbon] %d bytes of commands to replay from the spool'
+                            % self.spool.size)
+
+        if self.relay_destinations:
+            self.relay = CarbonRelay(self.relay_destinations, replication=self.relay_replication,
+                                     max_buffer=self.relay_max_buffer)
+            self.relay.start()
+            logger.info('[Carbon] Relaying to %s' % ', '.join(self.relay.destinations))
 
-        reader = ShinkenCarbonReader(self.udp, self.tcp, interval=self.interval,
-                                     grouped_collectd_plugins=self.grouped_collectd_plugins)
+        if self.history is not None and self.history_port:
+            self.history_server = HistoryServer(self.history, self.history_host, self.history_port)
+            self.history_server.start()
+            logger.info('[Carbon] History queries on http://%s:%d/history' % (
+                self.history_host, self.history_port))
+
+        self._set_signals()
+
+        reader = self.reader = ShinkenCarbonReader(self.udp, self.tcp, relay=self.relay,
+                                                   statsd=self.statsd,
+                                                   unix_stream=self.unix_stream,
+                                                   unix_dgram=self.unix_dgram,
+                                                   **self.reader_options())
         try:
             if use_dedicated_thread:
                 carbon_reader_thread = threading.Thread(target=self._read_carbon, args=(reader,))
@@ -329,45 +1404,74 @@ class CarbonArbiter(BaseModule):
                 else:
                     self._read_carbon_packet(reader)
 
-                tosend = []
-                with lock:
-                    for elem in elements.itervalues():
-                        cmd = elem.get_command()
-                        if cmd:
-                            tosend.append(cmd)
-                # we could send those in one shot !
-                # if it existed an ExternalCommand*s* items class.. TODO.
-                for cmd in tosend:
-                    self.from_q.put(ExternalCommand(cmd))
+                if self._reload_requested:
+                    self._reload_requested = False
+                    self._reload_config()
+
+                if self.statsd_aggregator is not None:
+                    now = time.time()
+                    if now >= last_flush + self.statsd_flush_interval:
+                        self._flush_statsd(now - last_flush)
+                        last_flush = now
+
+                tosend = self._get_commands()
+                self._queue_commands(tosend)
                 n_cmd_sent += len(tosend)
 
                 now = time.time()
+                path = self.profiler.check_cprofile(now)
+                if path:
+                    logger.info('[Carbon] cProfile stats dumped in %s' % path)
                 if now > next_clean:
                     next_clean = now + clean_every
                     if use_dedicated_thread:
                         if not carbon_reader_thread.isAlive() and not self.interrupted:
                             raise Exception('Carbon reader thread unexpectedly died.. exiting.')
 
-                    todel = []
-                    with lock:
-                        for name, elem in elements.iteritems():
-                            for perf_name, met_values in elem.perf_datas.items():
-                                if met_values[0].here_time < now - 3 * elem.interval:
-                                    # this perf data has not been updated for more than 3 intervals,
-                                    # purge it.
-                                    del elem.perf_datas[perf_name]
-                                    logger.info('%s %s: 3*interval without data, purged.' % (
-                                        elem, perf_name))
-                            if not elem.perf_datas:
-                                todel.append(name)
-                        for name in todel:
-                            logger.info('%s : not anymore updated > purged.' % name)
-                            del elements[name]
+                    self._purge_elements(self.clock())
+                    if self.rate_limiter is not None:
+                        self.rate_limiter.purge(now)
+                    if self.liveness is not None:
+                        with self.lock:
+                            tosend = self.liveness.commands(self.clock())
+                        self._queue_commands(tosend)
+                        n_cmd_sent += len(tosend)
+
+                if now > next_age:
+                    next_age = now + CACHE_AGE_EVERY
+                    self._age_caches()
+
+                if self.snapshot_file and now > next_snapshot:
+                    next_snapshot = now + self.snapshot_every
+                    self._write_snapshot()
 
                 if now > next_report:
                     next_report = now + report_every
                     logger.info(
                         '%s commands reported during last %s seconds.' % (n_cmd_sent, report_every))
+                    if self.change_only:
+                        logger.info('[Carbon] %d unchanged commands suppressed' %
+                                    self._count_suppressed())
+                    if self.spool is not None:
+                        logger.info('[Carbon] Spool: %s' % self.spool.stats())
+                    if self._queue_errors:
+                        logger.warning('[Carbon] Queue still unavailable: %d failed puts' %
+                                       self._queue_errors)
+                    if self.relay is not None:
+                        logger.info('[Carbon] Relay: %s' % self.relay.stats())
+                    if self.profiler.enabled:
+                        self._log_timers()
+                    if self.statsd_aggregator is not None:
+                        logger.info('[Carbon] StatsD: %s' % self.statsd_aggregator.stats())
+                    if self.rate_limiter is not None:
+                        logger.info('[Carbon] Rate limits: %s' % self.rate_limiter.report())
+                    if self.cardinality is not None:
+                        for line in self.cardinality.report():
+                            logger.info('[Carbon] Cardinality: %s' % line)
+                    for line in lifecycle_log.report():
+                        logger.info('[Carbon] Elements: %s' % line)
+                    for line in bad_lines.report():
+                        logger.warning('[Carbon] Bad lines: %s' % line)
                     n_cmd_sent = 0
 
         except Exception as err:
@@ -377,3 +1481,20 @@ class CarbonArbiter(BaseModule):
             reader.close()
             if use_dedicated_thread:
                 carbon_reader_thread.join()
+            if self.snapshot is not None:
+                self._close_snapshot()
+            if self.snapshot_file:
+                # an error here would hide the one being raised
+                try:
+                    self._write_snapshot()
+                except Exception as err:
+                    logger.error('[Carbon] Unable to write snapshot %s: %s ; %s' % (
+                        self.snapshot_file, err, traceback.format_exc()))
+            if self.spool is not None:
+                self.spool.close()
+            if self.relay is not None:
+                self.relay.stop()
+            if self.history_server is not None:
+                self.history_server.stop()
+            self.profiler.disable()
+            self.profiler.stop_cprofile()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Memory used by a synthetic elements table of 1M metrics,
+with and without the names intern pool.
+
+You can run it from the main folder of this repository:
+
+python test/bench_intern.py [n_hosts]
+"""
+
+import logging
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import module.module
+from module.module import Element, logger
+
+N_SERVICES = 5
+N_METRICS = 10
+
+
+class NoInternPool(object):
+    """ Pass-through pool: every name is a fresh string """
+
+    def intern(self, string):
+        return string
+
+    acquire = intern
+
+    def release(self, string):
+        pass
+
+
+def rss_kb():
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * 4
+
+
+def build_table(n_hosts):
+    intern = module.module.intern_pool.intern
+    acquire = module.module.intern_pool.acquire
+    elements = {}
+    now = time.time()
+    for host_idx in xrange(n_hosts):
+        for srv_idx in xrange(N_SERVICES):
+            for met_idx in xrange(N_METRICS):
+                # the names are rebuilt for each line, like the parser does
+                path = 'host%d.service%d.metric%d' % (host_idx, srv_idx, met_idx)
+                host, sdesc, mname = path.split('.')
+                name = intern('%s;%s' % (host, sdesc))
+                elem = elements.get(name)
+                if elem is None:
+                    elem = elements[acquire(name)] = Element(host, sdesc, 10)
+                elem.add_perf_data(intern(mname), met_idx + 1, now)
+    return elements
+
+
+def run(mode, n_hosts):
+    logger.setLevel(logging.WARNING)
+    if mode == 'nointern':
+        module.module.intern_pool = NoInternPool()
+    before = rss_kb()
+    elements = build_table(n_hosts)
+    n_metrics = sum(len(elem.perf_datas) for elem in elements.itervalues())
+    print '%-9s %d elements, %d metrics: %d MB' % (
+        mode, len(elements), n_metrics, (rss_kb() - before) / 1024)
+
+
+def main():
+    if len(sys.argv) > 2:
+        run(sys.argv[1], int(sys.argv[2]))
+        return
+    n_hosts = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000 / (N_SERVICES * N_METRICS)
+    for mode in ('nointern', 'intern'):
+        # one process per mode, to get a clean RSS
+        subprocess.check_call([sys.executable, __file__, mode, str(n_hosts)])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Memory soak of the elements table: a CarbonArbiter is driven through hours of
+simulated time (the clock is mocked) by churning hosts and metrics. After each
+phase the sources disappear and the purge runs: the elements, the acquired
+names and the caches must be back to their baseline, and the memory must not
+grow from one phase to the next by more than a threshold.
+
+The memory is sampled with tracemalloc, by allocation site. Without tracemalloc
+(Python 2), the RSS and the gc tracked objects by type are sampled instead.
+
+You can run it from the main folder of this repository:
+
+python test/bench_soak.py [--hosts 100] [--hours 1] [--threshold 1024]
+
+It exits with 1 if the memory grows by more than threshold KB.
+"""
+
+import argparse
+import gc
+import logging
+import os
+import sys
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from shinken.objects.module import Module
+
+from module.carbon_intern import intern_pool
+from module.carbon_replay import ReplayClock
+from module.carbon_shinken_parser import ShinkenCarbonReader
+from module.module import CACHE_AGE_EVERY, CarbonArbiter, logger
+
+N_SERVICES = 3
+N_METRICS = 4
+CLEAN_EVERY = 15
+TOP = 10
+
+
+def rss_kb():
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * 4
+
+
+class Sampler(object):
+    """ Memory samples, by allocation site or by object type """
+
+    def __init__(self):
+        if tracemalloc is not None:
+            tracemalloc.start(1)
+
+    def take(self):
+        gc.collect()
+        if tracemalloc is not None:
+            snapshot = tracemalloc.take_snapshot().filter_traces(
+                [tracemalloc.Filter(False, tracemalloc.__file__)])
+            return snapshot, sum(stat.size for stat in snapshot.statistics('filename'))
+        types = Counter(type(obj).__name__ for obj in gc.get_objects())
+        return types, rss_kb() * 1024
+
+    def top_growth(self, before, after):
+        if tracemalloc is not None:
+            return ['%s' % stat for stat in after.compare_to(before, 'lineno')[:TOP]
+                    if stat.size_diff > 0]
+        growth = after
+        growth.subtract(before)
+        return ['%s: %+d objects' % item for item in growth.most_common(TOP) if item[1] > 0]
+
+
+class Soak(object):
+
+    def __init__(self, n_hosts, churn, interval, **options):
+        self.n_hosts = n_hosts
+        self.churn = churn
+        self.interval = interval
+        self.clock = ReplayClock(1492439949.0)
+        self.arbiter = CarbonArbiter(Module({'module_name': 'carbon-soak',
+                                             'module_type': 'carbon'}),
+                                     {}, {}, interval, clock=self.clock, **options)
+        self.reader = self.arbiter.reader = ShinkenCarbonReader(
+            {}, {}, **self.arbiter.reader_options())
+        self.first_host = 0
+        self.round = 0
+        self.n_lines = 0
+        self.n_commands = 0
+        self.next_clean = self.clock.now + CLEAN_EVERY
+        self.next_age = self.clock.now + CACHE_AGE_EVERY
+
+    def _tick(self, seconds):
+        clock = self.clock
+        arbiter = self.arbiter
+        clock.now += seconds
+        self.n_commands += len(arbiter._get_commands())
+        if clock.now >= self.next_clean:
+            self.next_clean = clock.now + CLEAN_EVERY
+            arbiter._purge_elements(clock.now)
+        if clock.now >= self.next_age:
+            self.next_age = clock.now + CACHE_AGE_EVERY
+            arbiter._age_caches()
+
+    def run(self, hours):
+        """
+        Send the metrics of the active hosts every interval, `churn´ hosts are
+        replaced every round and each host has a metric with a new name every round.
+        """
+        read_packet = self.arbiter._read_carbon_packet
+        reader = self.reader
+        for _ in xrange(int(hours * 3600 / self.interval)):
+            now = self.clock.now
+            for host_idx in xrange(self.first_host, self.first_host + self.n_hosts):
+                for srv_idx in xrange(N_SERVICES):
+                    for met_idx in xrange(N_METRICS):
+                        read_packet(reader, 'soak%d.service-%d.metric-%d %d %d' % (
+                            host_idx, srv_idx, met_idx, self.round, now))
+                # e.g. a per process metric
+                read_packet(reader, 'soak%d.processes.pid-%d %d %d' % (
+                    host_idx, self.round, self.round, now))
+                self.n_lines += N_SERVICES * N_METRICS + 1
+            self.first_host += self.churn
+            self.round += 1
+            self._tick(self.interval)
+
+    def drain(self):
+        """
+        All the sources disappear: let the purge and two cache agings run.
+        """
+        for _ in xrange(int(max(4 * self.interval, 2 * CACHE_AGE_EVERY) / CLEAN_EVERY) + 2):
+            self._tick(CLEAN_EVERY)
+
+    def state(self):
+        arbiter = self.arbiter
+        return {
+            'elements': len(arbiter.elements),
+            'perf datas': sum(len(elem.perf_datas) for elem in arbiter.elements.itervalues()),
+            'acquired names': len(intern_pool._refs),
+            'interned names': len(intern_pool),
+            'path cache': len(self.reader.path_matcher._cache) +
+                          len(self.reader.path_matcher._old),
+            'names cache': len(self.reader._names),
+            'carried cadences': len(arbiter._carried),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Memory soak of the elements table.')
+    parser.add_argument('--hosts', type=int, default=100, help='active hosts')
+    parser.add_argument('--churn', type=int, default=5, help='hosts replaced per interval')
+    parser.add_argument('--hours', type=float, default=1, help='simulated hours per phase')
+    parser.add_argument('--phases', type=int, default=3)
+    parser.add_argument('--interval', type=int, default=10)
+    parser.add_argument('--reorder-window', type=int, default=0)
+    parser.add_argument('--adaptive-interval', action='store_true')
+    parser.add_argument('--threshold', type=int, default=1024,
+                        help='max memory growth (in KB) between the last two phases')
+    args = parser.parse_args()
+
+    logger.setLevel(logging.WARNING)
+    soak = Soak(args.hosts, args.churn, args.interval, reorder_window=args.reorder_window,
+                adaptive_interval=args.adaptive_interval)
+    sampler = Sampler()
+    baseline = soak.state()
+    if tracemalloc is None:
+        print 'tracemalloc not available: sampling the RSS and the gc objects by type'
+
+    samples = []
+    for phase in xrange(args.phases):
+        soak.run(args.hours)
+        active = soak.state()
+        soak.drain()
+        drained = soak.state()
+        samples.append(sampler.take())
+        print 'phase %d: %d lines, %d commands, %d KB' % (
+            phase + 1, soak.n_lines, soak.n_commands, samples[-1][1] / 1024)
+        print '  active:  %s' % ', '.join('%s %d' % item for item in sorted(active.items()))
+        print '  drained: %s' % ', '.join('%s %d' % item for item in sorted(drained.items()))
+
+    failures = []
+    for key in sorted(baseline):
+        if drained[key] != baseline[key]:
+            failures.append('%s: %d after the purge, %d at start' % (
+                key, drained[key], baseline[key]))
+    if len(samples) > 1:
+        (before, before_size), (after, after_size) = samples[-2:]
+        growth = (after_size - before_size) / 1024
+        print 'growth between the last two phases: %d KB' % growth
+        for line in sampler.top_growth(before, after):
+            print '  %s' % line
+        if growth > args.threshold:
+            failures.append('memory growth %d KB > %d KB' % (growth, args.threshold))
+
+    for failure in failures:
+        print 'FAILED: %s' % failure
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,13 +5,43 @@ from module import get_instance
 
 from module.carbon_parser import decode_plaintext_packet
 from module.carbon_parser import Parser
+from module.carbon_parser import decode_plaintext_buffer, Reader
+from module.carbon_templates import PathMatcher
+from module.carbon_tags import TagMapper
+from module.carbon_intern import InternPool, intern_pool
+from module.carbon_snapshot import SnapshotError, SnapshotReader, dump_elements, write_snapshot
+from module.carbon_spool import CommandSpool
+from module.carbon_relay import CarbonRelay, ConsistentHashRing
+from module.carbon_replay import Replay, ReplayClock, open_capture
+from module.carbon_profiling import Profiler
+from module.carbon_cardinality import CountMinSketch, HyperLogLog
+from module.carbon_shinken_parser import ShinkenCarbonReader
+from module.carbon_reorder import ReorderWindow, LATEST, LATE, DROPPED
+from module.carbon_ratelimit import RateLimiter, parse_rate_overrides
+from module.carbon_config import read_module_config
+from module.carbon_statsd import StatsdAggregator, parse_percentiles
+from module.carbon_thresholds import NagiosRange, ThresholdRules, parse_thresholds
+from module.carbon_liveness import HostLiveness, UNREACHABLE
+from module.carbon_summary import InstanceMatrix
+from module.carbon_history import History, HistoryServer, RingBuffer
+from module.carbon_events import LifecycleLog, lifecycle_log
+from module.carbon_badlines import BadLines, bad_lines
+from module.module import parse_config
 
 from module.module import Element
 
 from shinken.objects.module import Module
 
 import unittest2 as unittest
+import gzip
+import Queue
+import os
+import shutil
+import socket
+import tempfile
 import time
+import json
+import urllib2
 
 basic_dict_modconf = dict(
     module_name='carbon',
@@ -123,6 +153,1030 @@ class TestDecodePlaintextPacket(unittest.TestCase):
         self.assertEqual(value[0], 10.4)
 
 
+class TestMetricTemplates(unittest.TestCase):
+    def test_default_template(self):
+        matcher = PathMatcher()
+        self.assertEqual(matcher.match("mycomputer.testcarbon-1.toto-2"),
+                         ("mycomputer", "testcarbon", "1", "toto", "2"))
+        self.assertIs(matcher.match("mycomputer.testcarbon.toto.titi"), None)
+
+    def test_templates(self):
+        matcher = PathMatcher(["servers.* .host.plugin.type*",
+                               "host.host.host.plugin.type*"])
+        self.assertEqual(matcher.match("servers.web1.cpu.total.user"),
+                         ("web1", "cpu", None, "total.user", None))
+        self.assertEqual(matcher.match("web1.example.com.cpu-0.percent-idle"),
+                         ("web1.example.com", "cpu", "0", "percent", "idle"))
+        self.assertIs(matcher.match("mycomputer.testcarbon.toto"), None)
+
+    def test_required_fields(self):
+        for template in ("plugin.type", "host.type", "host.plugin", "host.plugin_instance.type"):
+            self.assertRaises(ValueError, PathMatcher, [template])
+        self.assertRaises(ValueError, PathMatcher, ["servers.* .host.skip.type*"])
+
+    def test_interpret_opcodes_templates(self):
+        parser = Parser()
+        parser.path_matcher = PathMatcher(["host.host.plugin.type"])
+        packet_data = decode_plaintext_packet("mycomputer.lan.testcarbon.toto 10")
+        value = parser.interpret_opcodes(packet_data).next()
+        self.assertEqual(value.host, "mycomputer.lan")
+        self.assertEqual(value.plugin, "testcarbon")
+        self.assertEqual(value.type, "toto")
+
+        bad_lines.report()
+        packet_data = decode_plaintext_packet("mycomputer.testcarbon.toto 10")
+        self.assertEqual(list(parser.interpret_opcodes(packet_data)), [])
+        self.assertEqual(bad_lines.by_category, {'wrong path depth': 1})
+
+
+class TestTaggedSeries(unittest.TestCase):
+    def test_decode_tagged(self):
+        data = decode_plaintext_packet("cpu;plugin=cpu;host=web1;host=web2 10 1492439949")
+        name, value, ts, tags = data.next()
+        self.assertEqual(name, "cpu")
+        self.assertEqual(tags, (("host", "web2"), ("plugin", "cpu")))
+
+        data = decode_plaintext_packet("cpu;host=web2;plugin=cpu 11 1492439959")
+        self.assertIs(data.next()[3], tags)
+
+        bad_lines.report()
+        self.assertEqual(list(decode_plaintext_packet("cpu;host 10")), [])
+        self.assertEqual(bad_lines.by_category, {'invalid name': 1})
+
+    def test_interpret_opcodes_tagged(self):
+        parser = Parser()
+        parser.tag_mapper = TagMapper({'type_instance': 'state'})
+        packet_data = decode_plaintext_packet("percent;host=web1;plugin=cpu;state=idle 98.5")
+        value = parser.interpret_opcodes(packet_data).next()
+        self.assertEqual(value.host, "web1")
+        self.assertEqual(value.plugin, "cpu")
+        self.assertIs(value.plugininstance, None)
+        self.assertEqual(value.type, "percent")
+        self.assertEqual(value.typeinstance, "idle")
+
+        packet_data = decode_plaintext_packet("percent;plugin=cpu 98.5")
+        self.assertEqual(list(parser.interpret_opcodes(packet_data)), [])
+
+        # the mapped type tag is missing
+        parser.tag_mapper = TagMapper({'type': 'metric'})
+        bad_lines.report()
+        packet_data = decode_plaintext_packet("percent;host=web1;plugin=cpu 98.5")
+        self.assertEqual(list(parser.interpret_opcodes(packet_data)), [])
+        self.assertEqual(bad_lines.by_category, {'invalid name': 1})
+
+
+class TestInternPool(unittest.TestCase):
+    def test_acquire_release(self):
+        pool = InternPool(max_size=2)
+        name = pool.acquire(''.join(['my', 'computer']))
+        self.assertIs(pool.intern('mycomputer'), name)
+        pool.intern('foo')
+        pool.intern('bar')
+        # the pool is full: unreferenced strings are dropped, not the acquired ones
+        self.assertNotIn('foo', pool)
+        self.assertIs(pool.intern('mycomputer'), name)
+        pool.release(name)
+        self.assertNotIn('mycomputer', pool)
+
+    def test_element_names(self):
+        element = Element('internhost', 'interntest', 5)
+        element.add_perf_data(''.join(['intern', 'metric']), 10, time.time())
+        self.assertEqual(intern_pool.refcount('internmetric'), 1)
+        element.remove_perf_data('internmetric')
+        self.assertEqual(intern_pool.refcount('internmetric'), 0)
+        element.release()
+        self.assertNotIn('interntest', intern_pool)
+
+
+class TestSnapshot(unittest.TestCase):
+    def test_snapshot(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+
+        ts = time.time()
+        element = Element('mycomputer', 'testcarbon', 5, ts)
+        element.add_perf_data('toto', 10.43, ts)
+        element.add_perf_data('titi', 12, ts)
+        write_snapshot(path, dump_elements({'mycomputer;testcarbon': element}))
+
+        arbiter = CarbonArbiter(Module(basic_dict_modconf), {}, {}, 5, snapshot_file=path)
+        arbiter._load_snapshot()
+        self.assertEqual(len(arbiter.snapshot), 1)
+        self.assertIs(arbiter._restore_element('unknown;service', 'service'), None)
+        restored = arbiter._restore_element('mycomputer;testcarbon', 'testcarbon')
+        self.assertEqual(len(arbiter.snapshot), 0)
+        self.assertEqual(restored.last_sent, element.last_sent)
+        self.assertEqual(restored.perf_datas['toto'][0].val, 10.43)
+        self.assertEqual(restored.perf_datas['titi'][0].val, 12)
+        self.assertIsInstance(restored.perf_datas['titi'][0].val, int)
+        arbiter._close_snapshot()
+
+    def test_non_ascii_names(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        ts = time.time()
+        element = Element('h\xe9', 'app', 5, ts)
+        element.add_perf_data('c\xc3\xa9', 1, ts)
+        self.assertEqual(write_snapshot(path, dump_elements({'h\xe9;app': element})), 1)
+        reader = SnapshotReader(path)
+        self.addCleanup(reader.close)
+        mname, points, _ = reader.pop(u'h\ufffd;app')[3][0]
+        self.assertEqual((mname, points[0][:2]), (u'c\xe9', (1, ts)))
+
+    def test_invalid_values(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        ts = time.time()
+        huge = Element('myhugehost', 'app', 5, ts)
+        huge.add_perf_data('huge', 10 ** 400, ts)
+        invalid = Element('myinvalidhost', 'app', 5, ts)
+        invalid.add_perf_data('invalid', 'x', ts)
+        count = write_snapshot(path, dump_elements({'myhugehost;app': huge,
+                                                    'myinvalidhost;app': invalid}))
+        self.assertEqual(count, 1)
+        reader = SnapshotReader(path)
+        self.addCleanup(reader.close)
+        self.assertEqual(reader.pop('myhugehost;app')[3][0][1][0][0], float('inf'))
+        self.assertNotIn('myinvalidhost;app', reader)
+
+    def test_corrupt_snapshot(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        ts = time.time()
+        elements = {}
+        for idx in range(2):
+            element = elements['mycomputer%d;testcarbon' % idx] = Element(
+                'mycomputer%d' % idx, 'testcarbon', 5, ts)
+            element.add_perf_data('toto', 10, ts)
+        write_snapshot(path, dump_elements(elements))
+        with open(path, 'rb') as snapshot:
+            data = snapshot.read()
+
+        # a truncated index
+        with open(path, 'wb') as snapshot:
+            snapshot.write(data[:-4])
+        self.assertRaises(SnapshotError, SnapshotReader, path)
+
+        # a corrupt record: the element falls back to a cold start
+        with open(path, 'wb') as snapshot:
+            snapshot.write(data[:40] + '\xff' * 8 + data[48:])
+        arbiter = CarbonArbiter(Module(basic_dict_modconf), {}, {}, 5, snapshot_file=path)
+        arbiter._load_snapshot()
+        self.assertEqual(len(arbiter.snapshot), 2)
+        restored = [arbiter._restore_element('mycomputer%d;testcarbon' % idx, 'testcarbon')
+                    for idx in range(2)]
+        self.assertIn(None, restored)
+        self.assertIs(arbiter.snapshot, None)
+
+    def test_rejected_restored_element(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        ts = time.time()
+        element = Element('myrejectedhost', 'load', 5, ts)
+        element.add_perf_data('restoredmetric', 10, ts)
+        write_snapshot(path, dump_elements({'myrejectedhost;load': element}))
+        element.release()
+
+        arbiter = CarbonArbiter(Module(basic_dict_modconf), {}, {}, 5, snapshot_file=path,
+                                max_series_per_host=1)
+        arbiter._load_snapshot()
+        reader = ShinkenCarbonReader({}, {}, **arbiter.reader_options())
+        arbiter._read_carbon_packet(reader, 'myrejectedhost.load.newmetric 1 %d' % ts)
+        self.assertEqual(arbiter.elements, {})
+        self.assertEqual(intern_pool.refcount('restoredmetric'), 0)
+        self.assertEqual(intern_pool.refcount('myrejectedhost'), 0)
+        arbiter._close_snapshot()
+
+
+class TestCommandSpool(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_replay_in_order(self):
+        spool = CommandSpool(self.directory, segment_size=20)
+        spool.extend(['cmd%d' % i for i in range(5)])
+        spool.extend(['cmd%d' % i for i in range(5, 8)])
+        self.assertTrue(spool.pending)
+
+        sent = []
+        put = lambda cmd: len(sent) < 3 and sent.append(cmd) is None
+        self.assertEqual(spool.replay(put), 3)
+        self.assertTrue(spool.pending)
+        put = lambda cmd: sent.append(cmd) is None
+        self.assertEqual(spool.replay(put), 5)
+        self.assertEqual(sent, ['cmd%d' % i for i in range(8)])
+        self.assertFalse(spool.pending)
+        self.assertEqual(os.listdir(self.directory), [])
+        spool.close()
+
+    def test_max_age_and_size(self):
+        spool = CommandSpool(self.directory, max_size=45, max_age=60, segment_size=10)
+        now = time.time()
+        spool.extend(['dropped'], now)
+        spool.extend(['old'], now - 120)
+        spool.extend(['a'], now)
+        spool.extend(['b'], now)
+        self.assertEqual(spool.n_dropped_segments, 1)
+        spool.close()
+
+        # the segments are replayed after a restart
+        spool = CommandSpool(self.directory, max_age=60)
+        sent = []
+        spool.replay(lambda cmd: sent.append(cmd) is None)
+        self.assertEqual(sent, ['a', 'b'])
+        self.assertEqual(spool.n_expired, 1)
+        spool.close()
+
+    def test_arbiter_send_commands(self):
+        arbiter = CarbonArbiter(Module(basic_dict_modconf), {}, {}, 5)
+        arbiter.from_q = Queue.Queue(maxsize=2)
+        arbiter.spool = CommandSpool(self.directory)
+        arbiter._send_commands(['cmd1', 'cmd2', 'cmd3'])
+        self.assertTrue(arbiter.spool.pending)
+        self.assertEqual(arbiter.from_q.get().cmd_line, 'cmd1')
+        self.assertEqual(arbiter.from_q.get().cmd_line, 'cmd2')
+        arbiter._send_commands(['cmd4'])
+        self.assertFalse(arbiter.spool.pending)
+        self.assertEqual(arbiter.from_q.get().cmd_line, 'cmd3')
+        self.assertEqual(arbiter.from_q.get().cmd_line, 'cmd4')
+        arbiter.spool.close()
+
+    def test_max_size_single_segment(self):
+        spool = CommandSpool(self.directory, max_size=60)
+        now = time.time()
+        spool.extend(['cmd%d' % i for i in range(3)], now)
+        spool.extend(['cmd%d' % i for i in range(3, 5)], now)
+        self.assertLessEqual(spool.size, 60)
+        spool.extend(['cmd%d' % i for i in range(5, 15)], now)
+        self.assertLessEqual(spool.size, 60)
+        sent = []
+        spool.replay(lambda cmd: sent.append(cmd) is None, now)
+        self.assertEqual(sent, ['cmd12', 'cmd13', 'cmd14'])
+        self.assertEqual(spool.n_dropped, 7)
+        spool.close()
+
+    def test_queue_unavailable(self):
+        class ClosedQueue(object):
+            def put(self, item, block=True):
+                raise IOError('closed')
+
+        arbiter = CarbonArbiter(Module(basic_dict_modconf), {}, {}, 5)
+        arbiter.from_q = ClosedQueue()
+        arbiter.spool = CommandSpool(self.directory)
+        for idx in range(3):
+            arbiter._send_commands(['cmd%d' % idx])
+        self.assertEqual(arbiter._queue_errors, 3)
+        arbiter.from_q = Queue.Queue()
+        arbiter._send_commands(['cmd3'])
+        self.assertEqual(arbiter._queue_errors, 0)
+        self.assertEqual(arbiter.from_q.qsize(), 4)
+        arbiter.spool.close()
+
+
+class TestCarbonRelay(unittest.TestCase):
+    def test_hash_ring(self):
+        ring = ConsistentHashRing(['a:2003', 'b:2003', 'c:2003'])
+        nodes = ring.get_nodes('mycomputer.cpu-0.percent-idle', 2)
+        self.assertEqual(len(set(nodes)), 2)
+        self.assertEqual(ring.get_nodes('mycomputer.cpu-0.percent-idle'), nodes[:1])
+        self.assertEqual(len(ring.get_nodes('mycomputer.cpu-0.percent-idle', 5)), 3)
+
+    def test_relay(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        self.addCleanup(server.close)
+        port = server.getsockname()[1]
+
+        relay = CarbonRelay([('127.0.0.1', port)])
+        relay.forward("mycomputer.testcarbon.toto 10\nmycomputer.testcarbon.titi 11\n")
+        relay.forward("  \nmycomputer.testcarbon.toto 12 1492439949\n")
+        relay.process()
+        self.assertEqual(relay.flush(), [])
+        connect, _ = server.accept()
+        connect.settimeout(5)
+        data = ''
+        while data.count('\n') < 3:
+            data += connect.recv(4096)
+        connect.close()
+        self.assertEqual(data, "mycomputer.testcarbon.toto 10\nmycomputer.testcarbon.titi 11\n"
+                               "mycomputer.testcarbon.toto 12 1492439949\n")
+        relay.stop()
+
+        # the destination is gone: the lines are kept and the reconnection delayed
+        server.close()
+        relay.forward("mycomputer.testcarbon.toto 13\n")
+        relay.process()
+        now = time.time()
+        errors = relay.flush(now)
+        self.assertEqual(len(errors), 1)
+        dest = errors[0][0]
+        self.assertEqual(len(dest.lines), 1)
+        self.assertGreater(dest.next_connect, now)
+        self.assertEqual(relay.flush(now), [])
+
+
+class TestReplay(unittest.TestCase):
+    def test_replay_capture(self):
+        fd, path = tempfile.mkstemp(suffix='.gz')
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        ts = 1492439949
+        capture = gzip.open(path, 'wb')
+        for idx in range(6):
+            capture.write('mycomputer.testcarbon.toto %d %d\n' % (idx + 1, ts + idx * 10))
+            capture.write('mycomputer.testcarbon.titi %d %d\n' % (idx + 1, ts + idx * 10))
+        capture.write('malformed\n')
+        capture.close()
+
+        commands = []
+        replay = Replay(commands.append, interval=10)
+        replay.run(open_capture(path))
+        self.assertEqual(replay.n_lines, 12)
+        self.assertEqual(replay.n_skipped, 1)
+        # the first command after 2*interval, the last one at the end of the capture
+        self.assertEqual(commands, [
+            '[%d] PROCESS_SERVICE_OUTPUT;mycomputer;testcarbon;Carbon|titi=4 toto=4 ' % (ts + 30),
+            '[%d] PROCESS_SERVICE_OUTPUT;mycomputer;testcarbon;Carbon|titi=6 toto=6 ' % (ts + 50),
+        ])
+
+
+class TestProfiler(unittest.TestCase):
+    def test_timers(self):
+        add_perf_data = Element.__dict__['add_perf_data']
+        interpret_opcodes = Parser.__dict__['interpret_opcodes']
+        profiler = Profiler([(Element, 'add_perf_data', 'add perf data', False),
+                             (Parser, 'interpret_opcodes', 'interpret opcodes', True)])
+        self.assertTrue(profiler.toggle())
+        self.addCleanup(profiler.disable)
+
+        element = Element('mycomputer', 'testcarbon', 5)
+        element.add_perf_data('toto', 10.43, time.time())
+        values = list(Parser().interpret("mycomputer.testcarbon.toto 10"))
+        self.assertEqual(len(values), 1)
+        self.assertEqual(profiler.timers['add perf data'].count, 1)
+        self.assertEqual(profiler.timers['interpret opcodes'].count, 1)
+
+        self.assertFalse(profiler.toggle())
+        self.assertIs(Element.__dict__['add_perf_data'], add_perf_data)
+        self.assertIs(Parser.__dict__['interpret_opcodes'], interpret_opcodes)
+        self.assertEqual(len(profiler.report()), 3)
+
+    def test_cprofile(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        profiler = Profiler()
+        now = time.time()
+        path = profiler.start_cprofile(directory, 10, now)
+        self.assertIs(profiler.start_cprofile(directory, 10, now), None)
+        self.assertIs(profiler.check_cprofile(now + 5), None)
+        self.assertEqual(profiler.check_cprofile(now + 10), path)
+        self.assertTrue(os.path.exists(path))
+
+
+class TestCardinality(unittest.TestCase):
+    def test_sketches(self):
+        sketch = CountMinSketch(1024, 4)
+        for idx in range(100):
+            sketch.add('host%d' % (idx % 10))
+        self.assertGreaterEqual(sketch.estimate('host1'), 10)
+        self.assertEqual(sketch.add('host1', -10), 0)
+        self.assertEqual(sketch.add('host1', -1), 0)
+
+        hll = HyperLogLog()
+        for idx in range(10000):
+            hll.add('mycomputer.testcarbon.metric%d' % idx)
+            hll.add('mycomputer.testcarbon.metric%d' % idx)
+        self.assertAlmostEqual(hll.count(), 10000, delta=500)
+
+    def test_series_limits(self):
+        arbiter = CarbonArbiter(Module(basic_dict_modconf), {}, {}, 10,
+                                max_series_per_host=3, max_series_per_service=2)
+        reader = ShinkenCarbonReader({}, {}, **arbiter.reader_options())
+        now = time.time()
+        for metric in ('cpu.user', 'cpu.system', 'cpu.idle', 'memory.used',
+                       'memory.free', 'load.shortterm'):
+            arbiter._read_carbon_packet(reader, 'mycardhost.%s 1 %d' % (metric, now))
+        self.assertEqual(sorted(arbiter.elements['mycardhost;cpu'].perf_datas),
+                         ['system', 'user'])
+        self.assertEqual(sorted(arbiter.elements['mycardhost;memory'].perf_datas), ['used'])
+        self.assertNotIn('mycardhost;load', arbiter.elements)
+        self.assertEqual(arbiter.cardinality.n_rejected, 3)
+
+        # the existing series are still updated
+        arbiter._read_carbon_packet(reader, 'mycardhost.cpu.user 2 %d' % (now + 5))
+        self.assertEqual(arbiter.elements['mycardhost;cpu'].perf_datas['user'][0].val, 2)
+
+        # once purged, the series leave room for new ones
+        arbiter._purge_elements(now + 100)
+        arbiter._read_carbon_packet(reader, 'mycardhost.load.shortterm 1 %d' % (now + 100))
+        self.assertIn('mycardhost;load', arbiter.elements)
+        report = arbiter.cardinality.report()
+        self.assertIn('mycardhost (', report[1])
+        self.assertEqual(arbiter.cardinality.n_rejected, 0)
+
+
+class TestReorderWindow(unittest.TestCase):
+    def test_window(self):
+        window = ReorderWindow(3)
+        self.assertEqual(window.add(10, 1), LATEST)
+        self.assertEqual(window.add(12, 3), LATEST)
+        self.assertEqual(window.add(11, 2), LATE)
+        self.assertEqual(window.points(), [(10, 1), (11, 2), (12, 3)])
+        # full: the oldest point is dropped
+        self.assertEqual(window.add(11.5, 4), LATE)
+        self.assertEqual(window.points(), [(11, 2), (11.5, 4), (12, 3)])
+        self.assertEqual(window.add(10.5, 5), DROPPED)
+        self.assertEqual(window.add(12, 6), LATEST)
+        self.assertEqual(window.add(12.5, 7), LATEST)
+        self.assertEqual(window.points(), [(11.5, 4), (12, 6), (12.5, 7)])
+        self.assertEqual(window.latest(), (12.5, 7))
+
+    def test_element(self):
+        ts = 1492442591
+        element = Element('mycomputer', 'testcarbon', 5, ts, reorder_window=4)
+        element.add_perf_data('toto', [1], ts)
+        # sub-second and late points are not lost
+        element.add_perf_data('toto', [2], ts + 0.5)
+        self.assertEqual(element.perf_datas['toto'][0].val, 2)
+        element.add_perf_data('toto', [3], ts + 2)
+        element.add_perf_data('toto', [4], ts + 1)
+        self.assertEqual(element.perf_datas['toto'][0].val, 3)
+        self.assertEqual(element.windows['toto'].points(),
+                         [(ts, 1), (ts + 0.5, 2), (ts + 1, 4), (ts + 2, 3)])
+        element.remove_perf_data('toto')
+        self.assertEqual(element.windows, {})
+
+
+class TestDecodeBuffer(unittest.TestCase):
+    def test_decode_buffer(self):
+        data = bytearray(64)
+        packet = b"mycomputer.testcarbon.toto 10 1492439949\n\n  titi;host=h;plugin=p  1.5\r\n"
+        data[:len(packet)] = packet
+        names = {}
+        values = list(decode_plaintext_buffer(data, len(packet), names))
+        self.assertEqual(values[0], ('mycomputer.testcarbon.toto', 10, 1492439949.0, None))
+        self.assertEqual(values[1][:2], ('titi', 1.5))
+        self.assertEqual(values[1][3].get('host'), 'h')
+        self.assertEqual(len(names), 2)
+        # the cached names are reused
+        self.assertIs(list(decode_plaintext_buffer(data, len(packet), names))[0][0], values[0][0])
+
+        # a bad line is skipped, not the lines following it
+        bad_lines.report()
+        data[:len(packet)] = b"mycomputer.testcarbon.toto abc\nmycomputer.testcarbon.titi 1\n".ljust(
+            len(packet))
+        self.assertEqual([value[0] for value in decode_plaintext_buffer(data, len(packet))],
+                         ['mycomputer.testcarbon.titi'])
+        self.assertEqual(len(bad_lines), 1)
+
+        # a full buffer without a newline
+        data = bytearray('mycomputer.testcarbon.toto ' + '1' * 100)
+        self.assertEqual(list(decode_plaintext_buffer(data, len(data), source='10.0.0.3')), [])
+        self.assertEqual(bad_lines.by_category, {'non-numeric value': 1, 'oversize line': 1})
+
+    def test_receive_into(self):
+        port = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        port.bind(('127.0.0.1', 0))
+        udp = {'host': '127.0.0.1', 'port': port.getsockname()[1], 'multicast': False}
+        port.close()
+        reader = Reader(udp, {})
+        self.addCleanup(reader.close)
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        client.sendto("mycomputer.testcarbon.toto 10\nmycomputer.testcarbon.titi 11\n",
+                      ('127.0.0.1', udp['port']))
+        client.close()
+        values = list(reader.interpret())
+        self.assertEqual([(vl.type, vl[0]) for vl in values], [('toto', 10), ('titi', 11)])
+        self.assertEqual(len(reader.buffers._free), 4)
+
+
+class TestRateLimiter(unittest.TestCase):
+    def test_token_buckets(self):
+        limiter = RateLimiter(10, 20, parse_rate_overrides('trusted=0, slow=1'))
+        now = 1000.0
+        self.assertEqual(sum(limiter.allow('host1', now) for _ in range(30)), 20)
+        self.assertEqual(sum(limiter.allow('host1', now + 1) for _ in range(30)), 10)
+        self.assertEqual(sum(limiter.allow('trusted', now) for _ in range(30)), 30)
+        self.assertEqual(sum(limiter.allow('slow', now) for _ in range(30)), 2)
+        self.assertEqual(limiter.n_throttled, 10 + 20 + 28)
+        self.assertEqual(limiter.report(),
+                         '58 lines throttled, 2 throttled sources: host1 (30), slow (28)')
+        self.assertEqual(limiter.report(), '0 lines throttled, 0 throttled sources')
+        limiter.purge(now + 10)
+        self.assertEqual(limiter.buckets, {})
+
+    def test_throttled_hosts(self):
+        arbiter = CarbonArbiter(Module(basic_dict_modconf), {}, {}, 10,
+                                rate_limit=1, rate_limit_overrides={'myfasthost': 0})
+        reader = ShinkenCarbonReader({}, {}, **arbiter.reader_options())
+        packet = '\n'.join('%s.testcarbon.toto%d 1' % (host, idx)
+                           for host in ('myslowhost', 'myfasthost') for idx in range(5))
+        data = bytearray(packet + '\n')
+        values = list(reader.interpret_opcodes(decode_plaintext_buffer(data, len(data))))
+        self.assertEqual([vl.host for vl in values], ['myslowhost'] + ['myfasthost'] * 5)
+        self.assertIn('myslowhost (4)', arbiter.rate_limiter.report())
+
+
+class TestConfigReload(unittest.TestCase):
+    def test_read_module_config(self):
+        fd, path = tempfile.mkstemp(suffix='.cfg')
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        with open(path, 'w') as config:
+            config.write('define module {\n  module_name other\n  interval 5\n}\n'
+                         'define module{\n  module_name carbon\n  module_type carbon\n'
+                         '  # interval 30\n  interval\t20\n'
+                         '  metric_templates servers.* .host.plugin.type*, host.plugin.type*\n}\n')
+        config = parse_config(read_module_config(path, 'carbon'))
+        self.assertEqual(config['interval'], 20)
+        self.assertEqual(config['templates'], ['servers.* .host.plugin.type*', 'host.plugin.type*'])
+        self.assertRaises(ValueError, read_module_config, path, 'nothere')
+
+    def test_reload(self):
+        arbiter = get_instance(Module(basic_dict_modconf))
+        reader = arbiter.reader = ShinkenCarbonReader({}, {}, **arbiter.reader_options())
+        now = time.time()
+        for line in ('myreloadhost.cpu-0.cpu-user 1', 'myreloadhost.cpu-1.cpu-user 2',
+                     'myreloadhost.load.shortterm 1'):
+            arbiter._read_carbon_packet(reader, '%s %d' % (line, now))
+        self.assertEqual(sorted(arbiter.elements), ['myreloadhost;cpu-0', 'myreloadhost;cpu-1',
+                                                    'myreloadhost;load'])
+        last_sent = max(arbiter.elements['myreloadhost;cpu-0'].last_sent,
+                        arbiter.elements['myreloadhost;cpu-1'].last_sent)
+
+        restart = arbiter.reload(parse_config(Module(dict(basic_dict_modconf, interval='30',
+                                                          grouped_collectd_plugins='cpu',
+                                                          use_udp='1'))))
+        self.assertEqual(restart, ['udp'])
+        self.assertEqual(arbiter.elements['myreloadhost;load'].interval, 30)
+        self.assertEqual(reader.interval, 30)
+        self.assertEqual(reader.grouped_collectd_plugins, ['cpu'])
+        # the cpu elements are rekeyed, with their send cadence
+        self.assertEqual(sorted(arbiter.elements), ['myreloadhost;load'])
+        arbiter._read_carbon_packet(reader, 'myreloadhost.cpu-0.cpu-user 3 %d' % now)
+        elem = arbiter.elements['myreloadhost;cpu']
+        self.assertEqual(elem.perf_datas.keys(), ['cpu-0-user'])
+        self.assertEqual(elem.last_sent, last_sent)
+
+
+class TestAdaptiveInterval(unittest.TestCase):
+    def test_learned_period(self):
+        clock = ReplayClock(1492442591.0)
+        element = Element('mycomputer', 'testcarbon', 10, clock=clock, adaptive=True)
+        commands = []
+        # the source reports every 30 s, its 3 metrics arrive in 0.2 s
+        for batch in range(6):
+            for idx, name in enumerate(('toto', 'titi', 'tata')):
+                clock.now = 1492442591.0 + batch * 30 + idx * 0.1
+                element.add_perf_data(name, [batch], clock.now)
+                command = element.get_command()
+                if command:
+                    commands.append((batch, idx))
+            # the next interval (10 s) doesn't send a partial set
+            clock.now += 10
+            self.assertIs(element.get_command(), None)
+        self.assertAlmostEqual(element.period, 30)
+        self.assertEqual(element.send_interval, element.period)
+        # each batch is sent when complete (the first ones are the warm-up)
+        self.assertEqual(commands, [(1, 2), (2, 2), (3, 2), (4, 2), (5, 2)])
+
+        # a missing metric: the partial set is sent after 1.5 periods
+        clock.now += 20
+        element.add_perf_data('toto', [6], clock.now)
+        self.assertIs(element.get_command(), None)
+        clock.now += 46
+        self.assertIsNot(element.get_command(), None)
+
+
+class TestCacheAging(unittest.TestCase):
+    def test_path_matcher_age(self):
+        matcher = PathMatcher()
+        matcher.match("mycomputer.testcarbon.toto")
+        matcher.match("gone.testcarbon.toto")
+        matcher.age()
+        # a path matched between two agings is kept
+        self.assertEqual(matcher.match("mycomputer.testcarbon.toto"),
+                         ("mycomputer", "testcarbon", None, "toto", None))
+        matcher.age()
+        self.assertEqual(list(matcher._old), ["mycomputer.testcarbon.toto"])
+        matcher.age()
+        self.assertEqual(matcher._old, {})
+
+    def test_age_caches(self):
+        arbiter = CarbonArbiter(Module({'module_name': 'carbon', 'module_type': 'carbon'}),
+                                {}, {}, 10)
+        reader = arbiter.reader = ShinkenCarbonReader({}, {}, **arbiter.reader_options())
+        path = "agedhost.agedplugin.toto"
+        arbiter._read_carbon_packet(reader, path + " 10 1492442591")
+        arbiter._purge_elements(time.time() + 3600)
+        self.assertEqual(arbiter.elements, {})
+        self.assertNotIn("agedplugin", intern_pool)
+        # still cached by the reader until it's aged out
+        self.assertIn(path, reader.path_matcher._cache)
+        arbiter._age_caches()
+        arbiter._age_caches()
+        self.assertNotIn(path, reader.path_matcher._cache)
+        self.assertNotIn(path, reader.path_matcher._old)
+
+
+class TestStatsd(unittest.TestCase):
+    def test_aggregates(self):
+        aggregator = StatsdAggregator(parse_percentiles('50, 99.9'))
+        packet = '\n'.join(['hits:1|c', 'hits:3|c|@0.5', 'temp:20|g', 'temp:-5|g',
+                            'users:alice|s:bob|s:alice|s', 'bad', 'nope:1|x'] +
+                           ['latency:%d|ms' % ms for ms in (30, 10, 20, 40)])
+        data = bytearray(packet)
+        aggregator.add_packet(data, len(data))
+        self.assertEqual(aggregator.stats(), '11 samples, 2 bad lines')
+        points = dict((name, value) for name, value, ts, tags in aggregator.flush(100.0, 10))
+        self.assertEqual(points, {
+            'hits': 7.0, 'hits_rate': 0.7, 'temp': 15, 'users': 2,
+            'latency_count': 4, 'latency_mean': 25.0, 'latency_min': 10, 'latency_max': 40,
+            'latency_p50': 20, 'latency_p99_9': 40})
+        # only the updated metrics are flushed, the relative gauges use the previous value
+        data = bytearray('temp:+1|g')
+        aggregator.add_packet(data, len(data))
+        self.assertEqual(aggregator.flush(110.0, 10), [('temp', 16, 110.0, None)])
+
+    def test_flush_to_elements(self):
+        arbiter = get_instance(Module(dict(basic_dict_modconf, use_statsd='1',
+                                           statsd_flush_interval='5')))
+        self.assertEqual(arbiter.statsd, {'host': '0.0.0.0', 'port': 8125})
+        self.assertEqual(arbiter.statsd_flush_interval, 5)
+        arbiter.reader = ShinkenCarbonReader({}, {}, **arbiter.reader_options())
+        data = bytearray('mystatsdhost.app.requests:2|c\nmystatsdhost.app.latency:12|ms')
+        arbiter.reader.statsd_aggregator.add_packet(data, len(data))
+        arbiter._flush_statsd(5)
+        elem = arbiter.elements['mystatsdhost;app']
+        self.assertEqual(sorted(elem.perf_datas), [
+            'latency_count', 'latency_max', 'latency_mean', 'latency_min', 'latency_p90',
+            'requests', 'requests_rate'])
+        self.assertEqual(elem.perf_datas['requests_rate'][0].val, [0.4])
+
+    def test_bad_names(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        arbiter = get_instance(Module(dict(basic_dict_modconf, use_statsd='1',
+                                           snapshot_file=path)))
+        arbiter.reader = ShinkenCarbonReader({}, {}, **arbiter.reader_options())
+        bad_lines.report()
+        data = bytearray(b'h\xe9.app.count:1|c\nh;a=b.app.count:1|c\nmyhost.app.count:1|c|@x\n'
+                         b'myhost.app.count:1|c\n')
+        arbiter.reader.statsd_aggregator.add_packet(data, len(data), source='10.0.0.2')
+        self.assertEqual(bad_lines.by_category, {'invalid name': 2, 'non-numeric value': 1})
+        self.assertEqual(bad_lines.by_source, {'10.0.0.2': 3})
+        arbiter._flush_statsd(10)
+        self.assertEqual(list(arbiter.elements), ['myhost;app'])
+        self.assertIsInstance(arbiter.elements['myhost;app'].host_name, unicode)
+        arbiter._write_snapshot()
+        self.assertTrue(os.path.getsize(path))
+
+
+class TestUnixSockets(unittest.TestCase):
+    def test_stream_and_dgram(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        config = parse_config(Module(dict(basic_dict_modconf,
+                                          unix_stream_path=os.path.join(tmpdir, 'stream.sock'),
+                                          unix_dgram_path=os.path.join(tmpdir, 'dgram.sock'),
+                                          unix_socket_mode='600')))
+        # a stale socket file is replaced
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        stale.bind(config['unix_dgram']['path'])
+        stale.close()
+        reader = ShinkenCarbonReader({}, {}, unix_stream=config['unix_stream'],
+                                     unix_dgram=config['unix_dgram'])
+        for path in (config['unix_stream']['path'], config['unix_dgram']['path']):
+            self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(config['unix_stream']['path'])
+        client.sendall('mycomputer.testcarbon.toto 10 1492442591\n')
+        client.close()
+        values = list(reader.interpret())
+        self.assertEqual([(vl.host, vl.plugin, vl.type, vl[0]) for vl in values],
+                         [('mycomputer', 'testcarbon', 'toto', 10)])
+
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        client.sendto('mycomputer.testcarbon.titi 20 1492442591\n',
+                      config['unix_dgram']['path'])
+        client.close()
+        values = list(reader.interpret())
+        self.assertEqual([(vl.type, vl[0]) for vl in values], [('titi', 20)])
+
+        reader.close()
+        self.assertEqual(os.listdir(tmpdir), [])
+
+
+class TestChangeOnly(unittest.TestCase):
+    def test_heartbeat(self):
+        clock = ReplayClock(1492442591.0)
+        element = Element('mycomputer', 'testcarbon', 10, clock=clock, max_silence=60)
+        sent = []
+        for step in range(1, 20):
+            clock.now = 1492442591.0 + step * 10
+            # the value changes once, at the 14th step
+            element.add_perf_data('toto', [1 if step < 14 else 2], clock.now)
+            if element.get_command():
+                sent.append(step)
+        # the element is ready every other step: the first command, a heartbeat 60 s after it,
+        # the change, and nothing after
+        self.assertEqual(sent, [4, 10, 14])
+        self.assertEqual(element.n_suppressed, 5)
+
+    def test_config(self):
+        arbiter = get_instance(Module(dict(basic_dict_modconf, change_only='1')))
+        self.assertEqual(arbiter.element_max_silence, 300)
+        reader = ShinkenCarbonReader({}, {}, **arbiter.reader_options())
+        arbiter._read_carbon_packet(reader, 'mychangehost.testcarbon.toto 1 %d' % time.time())
+        self.assertEqual(arbiter.elements['mychangehost;testcarbon'].max_silence, 300)
+
+
+class TestThresholds(unittest.TestCase):
+    def test_nagios_ranges(self):
+        for spec, alerts, no_alerts in (('10', (-1, 11), (0, 10)),
+                                        ('10:', (9.9,), (10, 1e9)),
+                                        ('~:10', (11,), (-1e9, 10)),
+                                        ('10:20', (9, 21), (10, 20)),
+                                        ('@10:20', (10, 20), (9, 21))):
+            nagios_range = NagiosRange(spec)
+            self.assertEqual([nagios_range.alert(value) for value in alerts + no_alerts],
+                             [True] * len(alerts) + [False] * len(no_alerts), spec)
+        self.assertRaises(ValueError, NagiosRange, '20:10')
+        self.assertRaises(ValueError, parse_thresholds, 'load/* 5')
+
+    def test_check_result(self):
+        rules = ThresholdRules(parse_thresholds(
+            'load/shortterm 5 10 0, load/* - ~:20, df-*/percent_bytes-used 80 90 0 100'))
+        self.assertIs(rules.match('df-root', 'percent_bytes-free'), None)
+        clock = ReplayClock(1492442591.0)
+        element = Element('mycomputer', 'load', 10, clock=clock, thresholds=rules)
+        clock.now += 30
+        element.add_perf_data('shortterm', [6.5], clock.now)
+        element.add_perf_data('midterm', [2], clock.now)
+        element.add_perf_data('other', [1], clock.now)
+        clock.now += 11
+        self.assertEqual(element.get_command(),
+                         '[1492442621] PROCESS_SERVICE_CHECK_RESULT;mycomputer;load;1;'
+                         'Carbon WARNING: shortterm=6.500000|midterm=2;;~:20 other=1;;~:20 '
+                         'shortterm=6.500000;5;10;0 ')
+
+        element = Element('mycomputer', 'cpu', 10, clock=clock, thresholds=rules)
+        clock.now += 30
+        element.add_perf_data('idle', [90], clock.now)
+        clock.now += 11
+        self.assertIn('PROCESS_SERVICE_OUTPUT;mycomputer;cpu;Carbon|idle=90 ',
+                      element.get_command())
+
+
+class TestHostLiveness(unittest.TestCase):
+    def test_up_and_down(self):
+        liveness = HostLiveness(60, down_after=120, down_state=UNREACHABLE)
+        sent = []
+        for tick in range(20):
+            now = 1000 + tick * 15
+            # host1 always sends, host2 stops after 1 min and comes back at the end
+            liveness.seen('host1')
+            if tick < 4 or tick >= 18:
+                liveness.seen('host2')
+            for command in liveness.commands(now):
+                host, state = command.split(';')[1:3]
+                sent.append((now, host, int(state)))
+        self.assertEqual(sorted(sent), [
+            (1000, 'host1', 0), (1000, 'host2', 0), (1060, 'host1', 0), (1120, 'host1', 0),
+            (1165, 'host2', 2), (1180, 'host1', 0), (1240, 'host1', 0), (1270, 'host2', 0)])
+        self.assertEqual(len(liveness), 2)
+
+    def test_arbiter(self):
+        arbiter = get_instance(Module(dict(basic_dict_modconf, host_up_every='60')))
+        reader = ShinkenCarbonReader({}, {}, **arbiter.reader_options())
+        arbiter._read_carbon_packet(reader, 'mylivehost.testcarbon.toto 1 %d' % time.time())
+        self.assertEqual(arbiter.liveness.commands(1492442591.0), [
+            '[1492442591] PROCESS_HOST_CHECK_RESULT;mylivehost;0;Carbon: metrics received'])
+        self.assertRaises(ValueError, parse_config,
+                          Module(dict(basic_dict_modconf, host_down_state='gone')))
+
+
+class TestSummary(unittest.TestCase):
+    def test_instance_matrix(self):
+        matrix = InstanceMatrix()
+        for instance in range(20):
+            matrix.set('cpu-%d-user' % instance, 'cpu-user', str(instance), instance + 1)
+            if instance % 2:
+                matrix.set('cpu-%d-idle' % instance, 'cpu-idle', str(instance), 50)
+        matrix.remove('cpu-19-user')
+        self.assertEqual(matrix.aggregates(), [('cpu-user', [190.0, 10.0, 19, 19]),
+                                               ('cpu-idle', [500.0, 50.0, 50, 50])])
+
+    def test_instances_churn(self):
+        matrix = InstanceMatrix()
+        for instance in range(100):
+            # e.g. a per process plugin, the instances come and go
+            matrix.set('ps-%d-rss' % instance, 'rss', str(instance), instance)
+            matrix.set('ps-%d-vm' % instance, 'vm-%d' % instance, str(instance), instance)
+            if instance >= 2:
+                matrix.remove('ps-%d-rss' % (instance - 2))
+                matrix.remove('ps-%d-vm' % (instance - 2))
+        self.assertEqual(matrix.width, 3)
+        self.assertEqual(len(matrix.keys), 4)
+        self.assertEqual(len(matrix.values), 12)
+        matrix.set('ps-99-rss', 'rss', '99', 10 ** 400)
+        self.assertEqual(matrix.aggregates()[0][1][2], float('inf'))
+        matrix.set('ps-99-rss', 'rss', '99', 99)
+        self.assertEqual(sorted(matrix.aggregates()), [
+            ('rss', [197.0, 98.5, 99, 99]), ('vm-98', [98.0, 98.0, 98, 98]),
+            ('vm-99', [99.0, 99.0, 99, 99])])
+
+    def test_summarized_command(self):
+        clock = ReplayClock(1492442591.0)
+        arbiter = CarbonArbiter(Module(basic_dict_modconf), {}, {}, 10, clock=clock,
+                                grouped_collectd_plugins=['cpu'], summarized_plugins=['cpu'])
+        reader = ShinkenCarbonReader({}, {}, **arbiter.reader_options())
+        for _ in range(2):
+            for instance in range(4):
+                for state, value in (('user', instance * 10), ('idle', 100 - instance * 10)):
+                    arbiter._read_carbon_packet(reader, 'mysummaryhost.cpu-%d.cpu-%s %d %d' % (
+                        instance, state, value, clock.now))
+            arbiter._read_carbon_packet(reader, 'mysummaryhost.load.shortterm 1 %d' % clock.now)
+            clock.now += 25
+        self.assertEqual(sorted(arbiter._get_commands()), [
+            '[1492442616] PROCESS_SERVICE_OUTPUT;mysummaryhost;cpu;Carbon|'
+            'cpu-idle_max=100.000000 cpu-idle_mean=85.000000 cpu-idle_p95=100.000000 '
+            'cpu-idle_sum=340.000000 cpu-user_max=30.000000 cpu-user_mean=15.000000 '
+            'cpu-user_p95=30.000000 cpu-user_sum=60.000000 ',
+            '[1492442616] PROCESS_SERVICE_OUTPUT;mysummaryhost;load;Carbon|shortterm=1 '])
+
+    def test_restored_summary(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        config = dict(grouped_collectd_plugins=['cpu'], summarized_plugins=['cpu'])
+        arbiter = CarbonArbiter(Module(basic_dict_modconf), {}, {}, 10, **config)
+        reader = ShinkenCarbonReader({}, {}, **arbiter.reader_options())
+        for instance in range(4):
+            arbiter._read_carbon_packet(reader, 'myrestoredhost.cpu-%d.cpu-user %d 1492442591' % (
+                instance, instance * 10))
+        write_snapshot(path, dump_elements(arbiter.elements))
+
+        arbiter = CarbonArbiter(Module(basic_dict_modconf), {}, {}, 10, snapshot_file=path,
+                                **config)
+        arbiter._load_snapshot()
+        reader = ShinkenCarbonReader({}, {}, **arbiter.reader_options())
+        # only one instance reports again, the others are summarized from the snapshot
+        arbiter._read_carbon_packet(reader, 'myrestoredhost.cpu-0.cpu-user 50 1492442601')
+        elem = arbiter.elements['myrestoredhost;cpu']
+        self.assertEqual(elem.summary.aggregates(), [('cpu-user', [110.0, 27.5, 50, 50])])
+        self.assertEqual(sorted(elem._summarized_perf_datas()), [
+            'cpu-user_max', 'cpu-user_mean', 'cpu-user_p95', 'cpu-user_sum'])
+        arbiter._close_snapshot()
+
+
+class TestHistory(unittest.TestCase):
+    def test_ring_buffer(self):
+        ring = RingBuffer(3)
+        for mtime in range(5):
+            ring.add(mtime, mtime * 10)
+        self.assertEqual(ring.points(), [(2, 20), (3, 30), (4, 40)])
+        self.assertEqual(ring.points(since=3), [(4, 40)])
+
+    def test_eviction(self):
+        history = History(2, max_series=3)
+        for idx in range(5):
+            history.add(('host', 'load', 'metric%d' % idx), 1, idx)
+        history.discard(('host', 'load', 'metric4'))
+        self.assertEqual(sorted(history.query('host/load/*')),
+                         ['host/load/metric2', 'host/load/metric3'])
+
+    def test_recreated_series(self):
+        history = History(2, max_series=2)
+        history.add(('host', 'load', 'a'), 1, 1)
+        history.discard(('host', 'load', 'a'))
+        history.add(('host', 'load', 'b'), 1, 2)
+        # re-created: its stale eviction entry doesn't evict it
+        history.add(('host', 'load', 'a'), 2, 10 ** 400)
+        history.add(('host', 'load', 'c'), 2, 3)
+        self.assertEqual(history.query('host/load/*'), {
+            'host/load/a': [(2, float('inf'))], 'host/load/c': [(2, 3)]})
+
+    def test_query_server(self):
+        arbiter = CarbonArbiter(Module(basic_dict_modconf), {}, {}, 10, history_points=5)
+        reader = ShinkenCarbonReader({}, {}, **arbiter.reader_options())
+        for mtime in range(1492442591, 1492442601):
+            arbiter._read_carbon_packet(reader, 'myhistoryhost.load.shortterm %d %d' % (
+                mtime % 10, mtime))
+        arbiter._read_carbon_packet(reader, 'myhistoryhost.cpu.idle 90 1492442600')
+        server = HistoryServer(arbiter.history, port=0)
+        server.start()
+        self.addCleanup(server.stop)
+        url = 'http://%s:%d/history?pattern=myhistoryhost/load/*&since=1492442597' % server.address
+        self.assertEqual(json.loads(urllib2.urlopen(url).read()), {
+            'myhistoryhost/load/shortterm': [[1492442598, 8], [1492442599, 9], [1492442600, 0]]})
+
+        # the series of a purged element are removed
+        arbiter._purge_elements(time.time() + 3600)
+        self.assertEqual(len(arbiter.history), 0)
+
+
+class TestLifecycleLog(unittest.TestCase):
+    def test_sampling(self):
+        log = LifecycleLog(samples=3)
+        for idx in range(100):
+            log.event('new perfdata', 'host%d/load' % (idx % 10), 'metric%d' % idx)
+        log.event('purged', 'host0/load')
+        report = log.report()
+        self.assertEqual(len(report), 2)
+        self.assertTrue(report[0].startswith('100 new perfdata across 10 elements, samples: '))
+        self.assertEqual(report[0].count('metric'), 3)
+        self.assertEqual(report[1], '1 purged across 1 elements, samples: host0/load')
+        self.assertEqual(log.report(), [])
+
+    def test_arbiter_events(self):
+        arbiter = CarbonArbiter(Module(basic_dict_modconf), {}, {}, 10,
+                                lifecycle_log_samples=2)
+        self.addCleanup(arbiter._set_lifecycle_log, 5, False)
+        reader = ShinkenCarbonReader({}, {}, **arbiter.reader_options())
+        lifecycle_log.report()
+        for host in range(4):
+            for metric in ('shortterm', 'midterm'):
+                arbiter._read_carbon_packet(reader, 'myeventhost%d.load.%s 1 1492442600' % (
+                    host, metric))
+        arbiter._purge_elements(time.time() + 3600)
+        report = dict(line.split(' across ') for line in lifecycle_log.report())
+        self.assertEqual(sorted(report), ['4 created', '4 purged', '8 new perfdata',
+                                          '8 purged perfdata'])
+        self.assertTrue(report['8 new perfdata'].startswith('4 elements, samples: myeventhost'))
+        self.assertEqual(report['8 new perfdata'].count('term'), 2)
+
+
+class TestBadLines(unittest.TestCase):
+    def test_categories(self):
+        bad_lines.report()
+        lines = [b"myhost.load.shortterm",
+                 b"myhost.load.shortterm abc 1492442600",
+                 b"myhost.load.shortterm 1 yesterday",
+                 b"myhost.load.shortterm 1 nan",
+                 b"myhost.load.shortterm 1 " + b"1" * 400,
+                 b"myhost.\xff.shortterm 1",
+                 b"myhost.load.shortterm -1.5e3 1492442600",
+                 b"myhost.load.shortterm -2 1492442600.5",
+                 b"myhost.load.shortterm nan"]
+        packet = b"\n".join(lines) + b"\n"
+        data = bytearray(packet)
+        values = list(decode_plaintext_buffer(data, len(packet) - 1, source='10.0.0.1'))
+        self.assertEqual([value[1:3] for value in values[:2]],
+                         [(-1500.0, 1492442600.0), (-2, 1492442600.5)])
+        self.assertIsInstance(values[1][1], int)
+        self.assertNotEqual(values[2][1], values[2][1])
+        self.assertEqual(bad_lines.by_category, {
+            'too few fields': 1, 'non-numeric value': 1, 'bad timestamp': 2,
+            'oversize line': 1, 'invalid name': 1})
+        self.assertEqual(bad_lines.by_source, {'10.0.0.1': 6})
+
+    def test_report(self):
+        bad = BadLines(samples=2)
+        for idx in range(10):
+            bad.add('non-numeric value', '10.0.0.%d' % (idx % 3), 'line%d' % idx)
+        bad.add('bad timestamp', None, 'line10')
+        report = bad.report()
+        self.assertEqual(report[0], '11 bad lines: 1 bad timestamp, 10 non-numeric value; '
+                                    'top sources: 10.0.0.0 (4), 10.0.0.1 (3), 10.0.0.2 (3), '
+                                    'local (1)')
+        self.assertEqual(len(report), 3)
+        self.assertEqual(bad.report(), [])
+
+    def test_huge_integer(self):
+        arbiter = CarbonArbiter(Module(basic_dict_modconf), {}, {}, 10, history_points=5,
+                                grouped_collectd_plugins=['cpu'], summarized_plugins=['cpu'])
+        reader = ShinkenCarbonReader({}, {}, **arbiter.reader_options())
+        bad_lines.report()
+        arbiter._read_carbon_packet(reader, 'myhugehost.cpu-0.user %s 1492439949' % ('9' * 320))
+        arbiter._read_carbon_packet(reader, 'myhugehost.cpu-1.user -%s 1492439949' % ('9' * 320))
+        arbiter._read_carbon_packet(reader, 'myhugehost.cpu-2.user 1 %s' % ('9' * 320))
+        perf_datas = arbiter.elements['myhugehost;cpu'].perf_datas
+        # converted to a float (infinite), like carbon does
+        self.assertEqual(sorted((mname, met_values[0].val) for mname, met_values in
+                                perf_datas.iteritems()),
+                         [('user-0', [float('inf')]), ('user-1', [float('-inf')])])
+        self.assertEqual(bad_lines.by_category, {'bad timestamp': 1})
+
+
+    def test_arbiter_survives(self):
+        arbiter = CarbonArbiter(Module(basic_dict_modconf), {}, {}, 10)
+        reader = ShinkenCarbonReader({}, {}, **arbiter.reader_options())
+        bad_lines.report()
+        arbiter._read_carbon_packet(reader, 'mybadhost.load\nmybadhost.load.shortterm 1 1492442600')
+        self.assertEqual(list(arbiter.elements), ['mybadhost;load'])
+        self.assertEqual(bad_lines.by_category, {'too few fields': 1})
+
+
 class TestElement(unittest.TestCase):
     def test_get_command(self):
         ts = 1492442591